@@ -1,14 +1,23 @@
 import collections
 import contextlib
+import cStringIO
+import difflib
+import multiprocessing
 import os
+import posixpath
 import re
 import shutil
 import sys
 import tempfile
+import time
 
+from plypatch import blobs
 from plypatch import exc
+from plypatch import fast_apply
 from plypatch import fixup_patch
 from plypatch import git
+from plypatch import journal
+from plypatch import metrics
 from plypatch import utils
 from plypatch import version
 
@@ -16,6 +25,29 @@ from plypatch import version
 __version__ = version.__version__
 
 RE_PATCH_IDENTIFIER = re.compile('Ply-Patch: (.*)')
+RE_BASED_ON = re.compile('Ply-Based-On: (.*)')
+RE_AUTHOR = re.compile('^(.+) <(.*)> (\d+ [+-]\d{4})$')
+RE_MBOX_FROM = re.compile('^From ([0-9a-f]{40}) Mon Sep 17 00:00:00 2001$')
+
+# Default for the format.filenameMaxLength git config
+FORMAT_PATCH_NAME_MAX = 64
+
+EXPORT_FORMATS = ('tar', 'tar.gz', 'dir')
+PATCH_EXPORT_FORMATS = ('combined', 'mbox')
+
+# Where patch-annotations can be kept, see `WorkingRepo.annotations`
+ANNOTATION_BACKENDS = ('message', 'notes')
+NOTES_REF = 'refs/notes/ply'
+
+# Number of restore results to remember in the restore-cache
+RESTORE_CACHE_SIZE = 16
+
+# Seconds to wait for another ply process to release the patch-repo lock
+PATCH_REPO_LOCK_TIMEOUT = 120
+
+# A parallel save splits the commits into this many chunks per job so that
+# slow chunks don't hold up the pool
+SAVE_CHUNKS_PER_JOB = 4
 
 
 class Repo(git.Repo):
@@ -37,9 +69,146 @@ class WorkingRepo(Repo):
     """
     fetch_remotes = True
 
+    # Called with a dict for each progress event of a restore; see
+    # `plypatch.jobs`
+    progress = None
+
+    # A `threading.Event` that, once set, stops a restore before its next
+    # patch
+    cancel_event = None
+
+    def _emit(self, event, **fields):
+        if self.progress is not None:
+            fields.update(event=event, time=time.time())
+            self.progress(fields)
+
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        """Emit how long the block took as a phase of the restore."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._emit('phase', phase=phase, duration=time.time() - start)
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise exc.Cancelled
+
+    @property
+    def annotations(self):
+        """Where patch-annotations are kept, set by the `ply.annotations` git
+        config:
+
+            message - a Ply-Patch line in each commit message (default)
+            notes - git notes in the refs/notes/ply ref
+        """
+        if not hasattr(self, '_annotations'):
+            backend = self._get_config('ply.annotations') or 'message'
+            if backend not in ANNOTATION_BACKENDS:
+                raise exc.UnknownAnnotationBackend(backend)
+            self._annotations = backend
+        return self._annotations
+
+    @property
+    def _patch_notes(self):
+        """Return {commit_hash: patch_name} for every commit annotated in the
+        notes ref, including notes that haven't been written out yet.
+        """
+        if not hasattr(self, '_patch_notes_cache'):
+            notes = {}
+            entries = self.notes_list(ref=NOTES_REF)
+            if entries:
+                patch_names = {}
+                cat_file = self.cat_file_batch()
+                try:
+                    for note_hash, commit_hash in entries:
+                        if note_hash not in patch_names:
+                            patch_names[note_hash] = cat_file.read(
+                                note_hash)[2].strip()
+                        notes[commit_hash] = patch_names[note_hash]
+                finally:
+                    cat_file.close()
+
+            self._patch_notes_cache = notes
+            self._pending_notes = {}
+
+        return self._patch_notes_cache
+
+    def _queue_patch_note(self, commit_hash, patch_name):
+        """Annotate a commit in the notes ref; the note is only written out by
+        `_flush_patch_notes`.
+        """
+        self._patch_notes[commit_hash] = patch_name
+        self._pending_notes[commit_hash] = patch_name
+
+    def _flush_patch_notes(self):
+        """Write all queued notes to the notes ref as a single commit.
+
+        Notes for commits that have since been rolled back or rewritten are
+        dropped at the same time, so the number of notes tracks the series
+        rather than every restore ever performed.
+        """
+        pending = getattr(self, '_pending_notes', None)
+        if not pending:
+            return
+
+        self._pending_notes = {}
+
+        try:
+            parent = self.rev_parse(NOTES_REF)
+        except git.exc.GitException:
+            parent = None
+
+        notes = self._patch_notes
+        stale = []
+        if parent:
+            try:
+                stale = self.unreachable_commits(
+                    [commit_hash for commit_hash in notes
+                     if commit_hash not in pending])
+            except git.exc.GitException:
+                # Leave pruning to a later flush rather than lose the notes
+                stale = []
+
+        for commit_hash in stale:
+            del notes[commit_hash]
+
+        message = 'Notes added by ply\n'
+
+        fast_import = self.fast_import()
+        try:
+            fast_import.write('commit %s\n' % NOTES_REF)
+            fast_import.write('committer %s\n'
+                              % self.var('GIT_COMMITTER_IDENT'))
+            fast_import.write('data %d\n%s\n' % (len(message), message))
+            if parent:
+                fast_import.write('from %s\n' % parent)
+
+            # fast-import can't delete a single note without knowing the
+            # fanout of the notes tree, so start over with the survivors
+            if stale:
+                fast_import.write('deleteall\n')
+                pending = notes
+
+            for commit_hash, patch_name in sorted(pending.iteritems()):
+                note = '%s\n' % patch_name
+                fast_import.write('N inline %s\ndata %d\n%s\n' % (
+                    commit_hash, len(note), note))
+
+            fast_import.write('\n')
+        except Exception:
+            fast_import.abort()
+            raise
+
+        fast_import.close()
+
     def _add_patch_annotation(self, patch_name):
         """Add a patch annotation to the last commit."""
-        self._add_annotation('Ply-Patch', patch_name)
+        if self.annotations == 'notes':
+            self._queue_patch_note(self.get_head_commit_hash(), patch_name)
+        else:
+            self._add_annotation('Ply-Patch', patch_name)
 
     def _get_patch_annotation(self, description):
         """Return the Ply-Patch annotation if present.
@@ -71,6 +240,14 @@ class WorkingRepo(Repo):
 
     def _get_commit_hash_and_patch_name(self, cmd_arg=None, count=1,
                                         skip=None):
+        if self.annotations == 'notes':
+            commit_hash = self.log(cmd_arg, count=count, pretty='%H',
+                                   skip=skip).strip()
+            if not commit_hash:
+                return None, None
+
+            return commit_hash, self._patch_notes.get(commit_hash)
+
         value = self.log(cmd_arg, count=count, pretty='%H %B',
                          skip=skip).split(' ', 1)
 
@@ -100,16 +277,8 @@ class WorkingRepo(Repo):
         """
         applied = []
 
-        skip = 0
-        while True:
-            commit_hash, patch_name = self._get_commit_hash_and_patch_name(
-                None, skip=skip)
-
-            skip += 1
-
-            if not commit_hash:
-                break
-
+        for commit_hash, patch_name in self._annotated_commits(
+                new_upper_bound):
             if patch_name:
                 # Patch found, must be within A
                 applied.append((commit_hash, patch_name))
@@ -125,6 +294,30 @@ class WorkingRepo(Repo):
 
         return applied
 
+    def _annotated_commits(self, new_upper_bound):
+        """Yield (commit_hash, patch_name) for each commit walking back from
+        HEAD, with a patch_name of None for commits without an annotation.
+        """
+        if self.annotations == 'notes':
+            # No commit bodies to look at, so fetch every commit the search
+            # could possibly need in one go
+            count = len(self._patch_notes) + new_upper_bound + 1
+            for commit_hash in self.log(count=count, pretty='%H').split():
+                yield commit_hash, self._patch_notes.get(commit_hash)
+            return
+
+        skip = 0
+        while True:
+            commit_hash, patch_name = self._get_commit_hash_and_patch_name(
+                None, skip=skip)
+
+            skip += 1
+
+            if not commit_hash:
+                return
+
+            yield commit_hash, patch_name
+
     @property
     def patch_repo_path(self):
         try:
@@ -149,17 +342,194 @@ class WorkingRepo(Repo):
 
         return self._patch_repo
 
+    def _state_path(self, filename):
+        """Return the path to a file holding in-progress ply state.
+
+        State lives in the git dir rather than the working tree so that each
+        linked worktree gets its own copy and concurrent restores in separate
+        worktrees don't collide.
+        """
+        state_dir = os.path.join(self.git_dir, 'ply')
+        if not os.path.exists(state_dir):
+            os.mkdir(state_dir)
+        return os.path.join(state_dir, filename)
+
+    @property
+    def _journal_path(self):
+        return self._state_path('restore-journal')
+
+    def _load_journal(self):
+        restore_journal = journal.RestoreJournal.load(self._journal_path)
+        if restore_journal is None:
+            restore_journal = self._convert_legacy_conflict()
+        return restore_journal
+
+    def _convert_legacy_conflict(self):
+        """Turn a conflict left by a ply that predates the restore journal
+        into a journal, so that it can still be resolved, skipped or
+        aborted.
+
+        That ply memorized the conflicting patch in `.patch-conflict` and the
+        commit message counters in `.restore-stats`, both in the root of the
+        checkout, and worked everything else out from the branch.
+        """
+        conflict_path = os.path.join(self.path, '.patch-conflict')
+        if not os.path.exists(conflict_path):
+            return None
+
+        with open(conflict_path) as f:
+            patch_name = f.read().strip()
+
+        updated, removed = 0, 0
+        stats_path = os.path.join(self.path, '.restore-stats')
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                updated, removed = map(int, f.read().split())
+
+        applied_patches = self._applied_patches()
+        if applied_patches:
+            base = self.rev_parse('%s^' % applied_patches[-1][0])
+        else:
+            base = self.get_head_commit_hash()
+
+        restore_journal = journal.RestoreJournal(
+            self._journal_path, base=base, series=self.patch_repo.series,
+            applied=[[applied_name, commit_hash] for commit_hash, applied_name
+                     in reversed(applied_patches)],
+            conflict=patch_name, updated=updated, removed=removed)
+        restore_journal.save()
+
+        os.unlink(conflict_path)
+        if os.path.exists(stats_path):
+            os.unlink(stats_path)
+
+        return restore_journal
+
+    def _patch_source(self, patch_rev=None):
+        """Return what the series is restored from: the patch-repo itself or
+        a revision of it.
+        """
+        if patch_rev:
+            return self.patch_repo.at(patch_rev)
+        return self.patch_repo
+
+    @property
+    def _partial_series_path(self):
+        return self._state_path('partial-series')
+
+    def _read_partial_series(self):
+        """Return the patches chosen by the last partial restore, or None if
+        the whole series was restored.
+        """
+        if not os.path.exists(self._partial_series_path):
+            return None
+        with open(self._partial_series_path) as f:
+            return [line.rstrip('\n') for line in f]
+
+    def _record_partial_series(self, restore_journal):
+        if not restore_journal.partial:
+            self._clear_partial_series()
+            return
+
+        with utils.atomic_write(self._partial_series_path) as f:
+            for patch_name in restore_journal.series:
+                f.write('%s\n' % patch_name)
+
+    def _clear_partial_series(self):
+        if os.path.exists(self._partial_series_path):
+            os.unlink(self._partial_series_path)
+
+    def _unapplied_patches(self):
+        """Return the patches a partial restore left out of the branch."""
+        partial_series = self._read_partial_series()
+        if partial_series is None:
+            return []
+        partial_series = set(partial_series)
+        return [patch_name for patch_name in self.patch_repo.series
+                if patch_name not in partial_series]
+
     @property
-    def _patch_conflict_path(self):
-        return os.path.join(self.path, '.patch-conflict')
+    def _applied_blobs_path(self):
+        return self._state_path('applied-blobs')
+
+    def _read_applied_blobs(self):
+        """Return a dict mapping applied commits to the blob hash of the
+        patch each was made from.
+        """
+        blobs = {}
+        if os.path.exists(self._applied_blobs_path):
+            with open(self._applied_blobs_path) as f:
+                for line in f:
+                    commit_hash, blob = line.split()
+                    blobs[commit_hash] = blob
+        return blobs
+
+    def _record_applied_blobs(self, patch_source, commits=None):
+        """Remember which version of its patch each applied commit was made
+        from, so a delta restore can tell which commits are still current.
+
+        Only `commits` are recorded afresh when given; the other applied
+        commits keep whatever was recorded for them before.
+        """
+        applied = self._applied_patches()
+        if commits is None:
+            commits = [commit_hash for commit_hash, _ in applied]
+        commits = set(commits)
+
+        recorded = self._read_applied_blobs()
+        blobs = patch_source.patch_blobs(
+            [patch_name for commit_hash, patch_name in applied
+             if commit_hash in commits])
+
+        with utils.atomic_write(self._applied_blobs_path) as f:
+            for commit_hash, patch_name in reversed(applied):
+                if commit_hash in commits:
+                    blob = blobs.get(patch_name)
+                else:
+                    blob = recorded.get(commit_hash)
+                if blob:
+                    f.write('%s %s\n' % (commit_hash, blob))
+
+    def _unchanged_patches(self, patch_rev=None, selection=None):
+        """Return the applied patches, oldest first, along with how many of
+        them come before the first one that was reordered, changed or
+        removed in the series, or in `selection` of it.
+        """
+        applied = list(reversed(self._applied_patches()))
+        if not applied:
+            return applied, 0
+
+        patch_source = self._patch_source(patch_rev)
+        try:
+            series = patch_source.series if selection is None else selection
+            blobs = patch_source.patch_blobs(series[:len(applied)])
+        finally:
+            if patch_source is not self.patch_repo:
+                patch_source.close()
+
+        recorded = self._read_applied_blobs()
+
+        kept = 0
+        for (commit_hash, patch_name), series_patch_name in zip(applied,
+                                                                series):
+            if patch_name != series_patch_name:
+                break
+            blob = recorded.get(commit_hash)
+            if not blob or blob != blobs.get(patch_name):
+                break
+            kept += 1
 
-    def _create_conflict_file(self, patch_name):
-        """The conflict-file gives us a way to memorize the patch-name of the
-        conflicting patch so that we can apply the patch-annotation after the
-        user resolves the conflict.
+        return applied, kept
+
+    def _reset_to_unchanged_patches(self, applied, kept):
+        """Reset the branch to the last of the `kept` applied commits, as
+        worked out by `_unchanged_patches`.
         """
-        with open(self._patch_conflict_path, 'w') as f:
-            f.write('%s\n' % patch_name)
+        if kept < len(applied):
+            if kept:
+                self.reset(applied[kept - 1][0], hard=True)
+            else:
+                self.reset('%s^' % applied[0][0], hard=True)
 
     def _resolve_conflict(self, method):
         """Resolve a conflict using one of the following methods:
@@ -167,26 +537,28 @@ class WorkingRepo(Repo):
             1. Abort
             2. Skip
             3. Resolve
+
+        Returns the restore journal and the name of the conflicting patch.
         """
-        if not os.path.exists(self._patch_conflict_path):
+        restore_journal = self._load_journal()
+        if not restore_journal or not restore_journal.conflict:
             raise exc.NothingToResolve
 
         kwargs = {method: True}
         self.am(**kwargs)
 
-        with open(self._patch_conflict_path) as f:
-            patch_name = f.read().strip()
-
-        os.unlink(self._patch_conflict_path)
-        return patch_name
+        patch_name = restore_journal.conflict
+        restore_journal.conflict = None
+        restore_journal.save()
+        return restore_journal, patch_name
 
     def abort(self):
         """Abort a failed merge.
 
         NOTE: this doesn't rollback commits that have successfully applied.
         """
-        self._resolve_conflict('abort')
-        os.unlink(self._restore_stats_path)
+        restore_journal = self._resolve_conflict('abort')[0]
+        restore_journal.delete()
         self.rollback(lose_uncommitted=True)
 
     def link(self, patch_repo_path):
@@ -210,6 +582,42 @@ class WorkingRepo(Repo):
         self.config('add', config_key='ply.patchrepo',
                     config_value=patch_repo_path)
 
+    def worktree(self, path, base=None):
+        """Return a working-repo for a dedicated git worktree at `path`.
+
+        The worktree is created (detached at `base`, or HEAD) if it doesn't
+        exist yet, otherwise it's reused and, if `base` is given, reset to it.
+        Since worktrees share the repo's config, the new working-repo is
+        linked to the same patch-repo.
+
+        An existing `path` must be one of this repo's linked worktrees;
+        anything else, like a plain directory inside the checkout, would
+        have git resolve to the main worktree and restore there instead.
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+
+        if not os.path.exists(path):
+            self.worktree_add(path, commit_ish=base or 'HEAD', detach=True)
+        elif os.path.realpath(path) not in [
+                os.path.realpath(worktree_path)
+                for worktree_path in self.worktree_list()[1:]]:
+            raise exc.NotAWorktree(path)
+
+        working_repo = self.__class__(path, quiet=self.quiet,
+                                      supress_warnings=self.supress_warnings)
+        working_repo.NON_INTERACTIVE = self.NON_INTERACTIVE
+        working_repo.fetch_remotes = self.fetch_remotes
+
+        if base and working_repo.get_head_commit_hash() != self.rev_parse(
+                '%s^{commit}' % base):
+            if working_repo.rebase_in_progress():
+                raise exc.RestoreInProgress
+            if working_repo.uncommitted_changes():
+                raise exc.UncommittedChanges
+            working_repo.reset(base, hard=True)
+
+        return working_repo
+
     def unlink(self):
         """Unlink a working-repo from a patch-repo."""
         if not self.patch_repo_path:
@@ -223,9 +631,18 @@ class WorkingRepo(Repo):
         This is useful if the patch is no longer relevant because a similar
         change was made upstream.
         """
-        patch_name = self._resolve_conflict('skip')
-        self.patch_repo.remove_patch(patch_name)
-        self.restore(fetch_remotes=False)  # Apply remaining patches
+        restore_journal, patch_name = self._resolve_conflict('skip')
+        restore_journal.skipped.append(patch_name)
+        if not restore_journal.patch_rev:
+            restore_journal.removed_patches.append(patch_name)
+        restore_journal.save()
+
+        if not restore_journal.patch_rev:
+            self.patch_repo.remove_patch(patch_name)
+            metrics.count('patches_removed')
+        self._emit('patch-removed', patch=patch_name, reason='skipped')
+
+        self._run_restore(restore_journal)  # Apply remaining patches
 
     def resolve(self):
         """Resolves a commit and refreshes the affected patch in the
@@ -235,49 +652,39 @@ class WorkingRepo(Repo):
         patch, which would make for a rather chatty history, we instead commit
         one time after all of the patches have been applied.
         """
-        patch_name = self._resolve_conflict('resolved')
-        source_paths, parent_patch_name = self._create_patches('HEAD^')
-        if len(source_paths) > 1:
-            raise Exception("Too many patches generated")
+        restore_journal, patch_name = self._resolve_conflict('resolved')
 
-        self.patch_repo.sync_patches(source_paths, parent_patch_name,
-                                     last_patch_name=patch_name)
+        if restore_journal.patch_rev:
+            self.warn("Restoring from a patch-repo revision, so the refreshed"
+                      " '%s' isn't saved; use `ply save` for that"
+                      % patch_name)
+        else:
+            with self._blob_staging() as blob_staging:
+                patches, parent_patch_name = self._create_patches(
+                    'HEAD^', blob_staging=blob_staging)
+                if len(patches) > 1:
+                    raise Exception("Too many patches generated")
+
+                if restore_journal.deferred or restore_journal.partial:
+                    # HEAD^ may be a patch that follows this one in the
+                    # series, or one a few patches before it in a partial
+                    # restore
+                    series = self.patch_repo.series
+                    idx = series.index(patch_name)
+                    parent_patch_name = series[idx - 1] if idx else None
+
+                self.patch_repo.sync_patches(patches, parent_patch_name,
+                                             last_patch_name=patch_name,
+                                             blob_staging=blob_staging)
+            metrics.count('patches_updated')
 
         self._add_patch_annotation(patch_name)
-        self.restore(fetch_remotes=False)  # Apply remaining patches
-
-    @property
-    def _restore_stats_path(self):
-        return os.path.join(self.path, '.restore-stats')
-
-    def _update_restore_stats(self, delta_updated=0, delta_removed=0):
-        """Restore-Stats allows us to craft a more useful commit message,
-        containing the number of patches updated and removed during a restore.
-
-        The data is stored in a temp file that is cleared when the restore is
-        either finished or aborted.
-
-        Diffstat was not used because it is line-oriented as opposed to
-        file-oriented. Moreover, a `git log --stat` would provide that info
-        already, so the commit msg would be duplicating info.
-        """
-        updated, removed = self._get_restore_stats()
-
-        updated += delta_updated
-        removed += delta_removed
-
-        with open(self._restore_stats_path, 'w') as f:
-            f.write('%d %d\n' % (updated, removed))
-
-    def _get_restore_stats(self):
-        updated = 0
-        removed = 0
-
-        if os.path.exists(self._restore_stats_path):
-            with open(self._restore_stats_path, 'r') as f:
-                updated, removed = map(int, f.read().strip().split(' '))
+        self._flush_patch_notes()
+        restore_journal.add_applied(patch_name, self.get_head_commit_hash())
+        metrics.count('patches_applied')
+        self._emit('patch-applied', patch=patch_name)
 
-        return updated, removed
+        self._run_restore(restore_journal)  # Apply remaining patches
 
     def _get_config(self, key):
         try:
@@ -285,6 +692,44 @@ class WorkingRepo(Repo):
         except git.exc.GitException:
             return None
 
+    def _get_all_config(self, key):
+        try:
+            return self.config('get-all', config_key=key)
+        except git.exc.GitException:
+            return []
+
+    def fetch_upstream(self, background=False):
+        """Fetch upstream, scoped by these git configs:
+
+            ply.fetch.remotes - remotes to fetch (default: all of them)
+            ply.fetch.refspec - what to fetch, when there's a single remote
+            ply.fetch.filter - partial-clone filter, for example blob:none
+            ply.fetch.jobs - number of remotes fetched in parallel
+
+        With `background`, the fetch is left running and returned so its
+        `wait` can be called once there's nothing else to do.
+        """
+        remotes = []
+        for value in self._get_all_config('ply.fetch.remotes'):
+            remotes.extend(value.split())
+
+        refspecs = self._get_all_config('ply.fetch.refspec')
+        if refspecs and len(remotes) != 1:
+            raise exc.FetchConfigInvalid(
+                'ply.fetch.refspec needs a single remote in ply.fetch.remotes')
+
+        jobs = self._get_config('ply.fetch.jobs')
+        kwargs = dict(jobs=int(jobs) if jobs else None,
+                      filter=self._get_config('ply.fetch.filter'),
+                      background=background)
+
+        if len(remotes) == 1:
+            return self.fetch(remote=remotes[0], refspecs=refspecs, **kwargs)
+        elif remotes:
+            return self.fetch(remotes=remotes, **kwargs)
+        else:
+            return self.fetch(all=True, **kwargs)
+
     def _ensure_name_and_email_set(self):
         email = self._get_config('user.email')
         if not email:
@@ -294,92 +739,178 @@ class WorkingRepo(Repo):
         if not name:
             raise exc.GitConfigRequired('user.name')
 
-    def restore(self, three_way_merge=True, commit_msg=None,
-                fetch_remotes=True, customize_commit_msg=False):
-        """Applies a series of patches to the working repo's current
-        branch.
-        """
-        #####################################################################
-        #
-        #                          Reentrant-Section
-        #
-        # This bit of code is called repeatedly until all of the patches have
-        # been successfully applied, skipped, or we've aborted the restore.
-        #
-        #####################################################################
-        self._ensure_name_and_email_set()
+    def _apply_with_am(self, restore_journal, patch_path, patch_name):
+        """Apply from mbox formatted patch, three possible outcomes here:
 
-        if self.rebase_in_progress():
-            raise exc.RestoreInProgress
+        1. Patch applies cleanly: move on to next patch
 
-        if self.uncommitted_changes():
-            raise exc.UncommittedChanges
+        2. Patch has conflicts: capture state, bail so user can fix
+           conflicts
 
-        if fetch_remotes and self.fetch_remotes:
-            self.fetch(all=True)
+        3. Patch was already applied: remove from patch-repo, move on to
+           next patch
+        """
+        try:
+            self.am(patch_path,
+                    three_way_merge=restore_journal.three_way_merge)
+        except git.exc.PatchDidNotApplyCleanly as e:
+            metrics.count('conflicts')
+            if restore_journal.keep_going and \
+                    not restore_journal.applying_deferred:
+                self.am(abort=True)
+                self._defer_patch(restore_journal, patch_name)
+                self._emit('patch-deferred', patch=patch_name)
+                return
+
+            # Memorize the patch-name that caused the conflict so that
+            # when we later resolve it, we can add the patch-annotation
+            restore_journal.conflict = patch_name
+            restore_journal.updated += 1
+            restore_journal.save()
+            self._emit('conflict', patch=patch_name,
+                       three_way_merged=not isinstance(
+                           e, git.exc.PatchBlobSHA1Invalid))
+            raise
+        except git.exc.PatchAlreadyApplied:
+            restore_journal.skipped.append(patch_name)
+            self._emit('patch-removed', patch=patch_name, reason='upstream')
+            if restore_journal.patch_rev:
+                restore_journal.save()
+                self.warn("Patch '%s' appears to be upstream" % patch_name)
+                return
+
+            # Journal the removal first so a resumed restore finishes it
+            restore_journal.removed_patches.append(patch_name)
+            restore_journal.removed += 1
+            restore_journal.save()
+
+            self.patch_repo.remove_patch(patch_name)
+            metrics.count('patches_removed')
+            self.warn("Patch '%s' appears to be upstream, removing from"
+                      " patch-repo" % patch_name)
+        else:
+            self._add_patch_annotation(patch_name)
+            restore_journal.add_applied(patch_name,
+                                        self.get_head_commit_hash())
+            metrics.count('patches_applied')
+            self._emit('patch-applied', patch=patch_name)
+
+    def _defer_patch(self, restore_journal, patch_name):
+        """Set a conflicting patch aside, along with every patch downstream
+        of it in the patch-repo's file-dependency graph, until the rest of
+        the series is applied.
+        """
+        dependents = collections.defaultdict(list)
+        for dependent, parent in self.patch_repo.patch_dependencies():
+            dependents[parent].append(dependent)
+
+        done = restore_journal.done
+        deferred = set(restore_journal.deferred)
+        newly_deferred = 0
+
+        patch_names = [patch_name]
+        while patch_names:
+            name = patch_names.pop()
+            if name in deferred or name in done:
+                continue
+            deferred.add(name)
+            newly_deferred += 1
+            patch_names.extend(dependents[name])
 
-        applied = set(pn for _, pn in self._applied_patches())
-        series = self.patch_repo.series
+        restore_journal.deferred = [name for name in restore_journal.series
+                                    if name in deferred]
+        restore_journal.save()
 
-        total_applied = len(applied)
+        self.warn("Patch '%s' did not apply cleanly, deferring it and %d"
+                  " dependent patches" % (patch_name, newly_deferred - 1))
 
-        for patch_name in series:
-            if patch_name in applied:
+    @property
+    def deferred_patches(self):
+        """Return the patches a keep-going restore set aside that still
+        have to be applied, in series order.
+        """
+        restore_journal = self._load_journal()
+        if not restore_journal:
+            return []
+        done = restore_journal.done
+        return [patch_name for patch_name in restore_journal.deferred
+                if patch_name not in done]
+
+    def _pending_patches(self, restore_journal):
+        """Yield the patches left to apply in series order, holding back
+        deferred patches until everything else has been applied.
+        """
+        done = restore_journal.done
+        for patch_name in restore_journal.series:
+            if patch_name in done:
                 continue
+            if patch_name in restore_journal.deferred and \
+                    not restore_journal.applying_deferred:
+                continue
+            yield patch_name
 
-            patch_path = os.path.join(self.patch_repo.path, patch_name)
-
-            # Apply from mbox formatted patch, three possible outcomes here:
-            #
-            # 1. Patch applies cleanly: move on to next patch
-            #
-            # 2. Patch has conflicts: capture state, bail so user can fix
-            #    conflicts
-            #
-            # 3. Patch was already applied: remove from patch-repo, move on to
-            #    next patch
-            try:
-                self.am(patch_path, three_way_merge=three_way_merge)
-            except git.exc.PatchDidNotApplyCleanly:
-                # Memorize the patch-name that caused the conflict so that
-                # when we later resolve it, we can add the patch-annotation
-                self._create_conflict_file(patch_name)
-                self._update_restore_stats(delta_updated=1)
-                raise
-            except git.exc.PatchAlreadyApplied:
-                self.patch_repo.remove_patch(patch_name)
-                self.warn("Patch '%s' appears to be upstream, removing from"
-                          " patch-repo" % patch_name)
-                self._update_restore_stats(delta_removed=1)
-            else:
-                self._add_patch_annotation(patch_name)
+        if restore_journal.deferred and \
+                not restore_journal.applying_deferred:
+            restore_journal.applying_deferred = True
+            restore_journal.save()
+            for patch_name in self._pending_patches(restore_journal):
+                yield patch_name
 
-            total_applied += 1
+    def _restore_series_order(self, restore_journal):
+        """Put the commits of a keep-going restore, which applied deferred
+        patches after the ones that follow them, back in series order.
+        """
+        position = dict((patch_name, idx) for idx, patch_name
+                        in enumerate(restore_journal.series))
+        applied = restore_journal.applied
+        ordered = sorted(applied, key=lambda a: position.get(a[0], -1))
+        if ordered == applied:
+            return
 
-            sys.stdout.write('\rRestoring %d/%d' % (total_applied,
-                                                    len(series)))
-            sys.stdout.flush()
+        start = 0
+        while applied[start] == ordered[start]:
+            start += 1
 
-        ######################################################################
-        #
-        #                              Endgame
-        #
-        # This bit of code is only reached after all patches have been applied
-        # sucessfully or have been skipped. To finish up, we commit any
-        # changes we're holding in the patch-repo and peform any necessary
-        # housekeeping (removing tempfiles, etc.)
-        #
-        ######################################################################
-        sys.stdout.write('\n')
+        base = applied[start - 1][1] if start else restore_journal.base
+        new_commits = self._reorder_patch_commits(
+            base, [commit_hash for _, commit_hash in ordered[start:]],
+            reflog_message='ply: restore')
+
+        if new_commits is None:
+            self.warn('Unable to put deferred patches back in series order')
+            return
+
+        reordered = [[patch_name, commit_hash] for (patch_name, _), commit_hash
+                     in zip(ordered[start:], new_commits)]
+        if self.annotations == 'notes':
+            for patch_name, commit_hash in reordered:
+                self._queue_patch_note(commit_hash, patch_name)
+            self._flush_patch_notes()
+
+        restore_journal.applied = ordered[:start] + reordered
+        restore_journal.save()
+
+    def _commit_patch_repo(self, updated, removed, commit_msg=None,
+                           customize_commit_msg=False, based_on=None):
+        """Commit any changes held in the patch-repo, annotated with the
+        upstream commit the series is based on.
 
-        updated, removed = self._get_restore_stats()
-        if os.path.exists(self._restore_stats_path):
-            os.unlink(self._restore_stats_path)
+        Callers that already know `based_on` should pass it in, sparing us a
+        walk over the applied patches.
+        """
+        with self.patch_repo.lock():
+            self._commit_patch_repo_locked(
+                updated, removed, commit_msg=commit_msg,
+                customize_commit_msg=customize_commit_msg, based_on=based_on)
 
-        # Commit to patch repo
+    def _commit_patch_repo_locked(self, updated, removed, commit_msg=None,
+                                  customize_commit_msg=False, based_on=None):
         if not self.patch_repo.uncommitted_changes():
+            self._cache_restore_result(based_on)
             return
-        based_on = self._last_upstream_commit_hash()
+
+        if not based_on:
+            based_on = self._last_upstream_commit_hash()
 
         template = None
 
@@ -412,121 +943,1328 @@ class WorkingRepo(Repo):
                 os.unlink(template)
 
         self.patch_repo._add_annotation('Ply-Based-On', based_on)
+        self._cache_restore_result(based_on)
 
-    def rollback(self, lose_uncommitted=False):
-        """Rollback to that last upstream commit."""
-        if self.uncommitted_changes() and not lose_uncommitted:
-            raise exc.UncommittedChanges
+    def restore(self, three_way_merge=True, commit_msg=None,
+                fetch_remotes=True, customize_commit_msg=False,
+                patch_rev=None, resume=False, delta=False,
+                keep_going=False, sparse=False, sparse_paths=(), upto=None,
+                only=None):
+        """Applies a series of patches to the working repo's current
+        branch.
 
-        based_on = self._last_upstream_commit_hash()
+        With `patch_rev`, the series is read from that revision of the
+        patch-repo's git objects instead of its checkout, which is left
+        alone. The patch-repo isn't changed by such a restore: refreshed
+        patches aren't saved and skipped patches aren't removed.
+
+        With `resume`, a restore that was interrupted, say by being killed,
+        carries on from its journal with the same series, options and base,
+        without fetching or looking through the branch for applied patches.
+
+        With `delta`, patches already applied to the branch are kept up to
+        the first one that no longer matches the series, by name and
+        contents; only the commits from there on are rolled back and
+        reapplied.
+
+        With `keep_going`, a patch that doesn't apply cleanly is set aside
+        along with the patches that depend on it, by the files they touch,
+        and the rest of the series is applied first. The deferred patches are
+        then applied, stopping at each conflict as usual, and the commits
+        are put back in series order at the end.
+
+        With `sparse`, the checkout is first limited to the directories of
+        the files the series touches, plus `sparse_paths`, so files outside
+        of them are never written; `rollback(full=True)` undoes it.
+
+        With `upto`, only the series up to and including that patch is
+        applied. With `only`, a list of patch names and directory prefixes,
+        just those patches are applied, along with the earlier patches they
+        depend on by the files they touch. The patches left out are kept
+        in the patch-repo by a later `save`.
+        """
+        if keep_going and patch_rev:
+            raise ValueError('keep_going needs the patch-repo checkout for'
+                             ' its dependency graph')
 
-        if based_on:
-            # If any patches successfully applied, roll them back
-            self.reset(based_on, hard=True)
+        if upto and only:
+            raise ValueError('upto and only can not be combined')
+
+        self._ensure_name_and_email_set()
+
+        if resume:
+            with self._phase('recover'):
+                restore_journal = self._recover_journal()
         else:
-            # If no patches applied successfully applied, then just trash the
-            # in-progress changes
-            self.reset('HEAD', hard=True)
+            # Fetching only moves remote refs, so the read-only preparation
+            # is done while the fetch is in flight. Nothing touches the
+            # checkout until the fetch is in, so a failed fetch leaves it as
+            # it was.
+            fetch = None
+            if fetch_remotes and self.fetch_remotes:
+                fetch = self.fetch_upstream(background=True)
 
-    def _create_patches(self, since):
+            try:
+                with self._phase('prepare'):
+                    if self.rebase_in_progress():
+                        raise exc.RestoreInProgress
+
+                    if self.uncommitted_changes():
+                        raise exc.UncommittedChanges
+
+                    if sparse:
+                        directories = self._sparse_checkout_directories(
+                            patch_rev, sparse_paths)
+
+                    selection = None
+                    if upto or only:
+                        selection = self._select_patches(patch_rev, upto,
+                                                         only)
+
+                    if delta:
+                        applied, kept = self._unchanged_patches(patch_rev,
+                                                                selection)
+            except Exception:
+                # The fetch is of no use now, and mustn't hide why we failed
+                exc_info = sys.exc_info()
+                if fetch:
+                    try:
+                        fetch.wait()
+                    except Exception:
+                        pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            if fetch:
+                with self._phase('fetch'):
+                    fetch.wait()
+
+            with self._phase('reset'):
+                if sparse:
+                    self.sparse_checkout_set(directories)
+
+                if delta:
+                    self._reset_to_unchanged_patches(applied, kept)
+
+                restore_journal = self._start_journal(
+                    patch_rev, selection=selection,
+                    three_way_merge=three_way_merge, commit_msg=commit_msg,
+                    customize_commit_msg=customize_commit_msg,
+                    keep_going=keep_going)
+
+        self._run_restore(restore_journal)
+
+    def _sparse_checkout_directories(self, patch_rev=None, extra_paths=()):
+        """Return the directories holding the files the series touches,
+        along with `extra_paths`, which is what a sparse checkout is limited
+        to.
         """
-        The default output of format-patch isn't ideally suited for our
-        purposes since it contains extraneous info as well as text that
-        changes even if the underlying patch doesn't change.
+        patch_source = self._patch_source(patch_rev)
+        try:
+            changed_files = set()
+            for patch_name in patch_source.series:
+                changed_files.update(
+                    patch_source._changed_files_for_patch(patch_name))
+        finally:
+            if patch_source is not self.patch_repo:
+                patch_source.close()
 
-        The following options are used to correct this:
+        # Top-level files are always part of the cone
+        directories = set(os.path.dirname(filename)
+                          for filename in changed_files)
+        directories.update(path.strip('/') for path in extra_paths)
+        directories.discard('')
 
-        --keep-subject - remove unecessary [PATCH] prefix
-        --no-stat - remove unecessary diffstat
-        --no-numbered - remove number of patches in set from subject line
+        return sorted(directories)
 
-        In addition, we need to rewrite the first-line of the patch-file to
-        remove an unecessary commit-hash. On refresh, this would change even
-        if the actual patch was the same, leading to very noisy diffs.
+    def _select_patches(self, patch_rev=None, upto=None, only=None):
+        """Return the patches of the series to apply in a partial restore, in
+        series order.
+
+        `upto` names the last patch to apply. `only` lists patch names and
+        directory prefixes to apply; the patches they depend on in the
+        file-dependency graph are pulled in as well so they apply cleanly.
         """
-        filenames = self.format_patch(
-            since, keep_subject=True, no_numbered=True, no_stat=True)
+        patch_source = self._patch_source(patch_rev)
+        try:
+            series = patch_source.series
+
+            if upto:
+                if upto not in series:
+                    raise exc.PatchNotInSeries(upto)
+                return series[:series.index(upto) + 1]
+
+            patch_names = []
+            for name in only:
+                prefix = '%s/' % name.rstrip('/')
+                matched = [patch_name for patch_name in series
+                           if patch_name == name or
+                           patch_name.startswith(prefix)]
+                if not matched:
+                    raise exc.PatchNotInSeries(name)
+                patch_names.extend(matched)
+
+            parents = collections.defaultdict(list)
+            for dependent, parent in patch_source.patch_dependencies():
+                parents[dependent].append(parent)
+        finally:
+            if patch_source is not self.patch_repo:
+                patch_source.close()
 
-        source_paths = []
-        for filename in filenames:
-            from_path = os.path.join(self.path, filename)
-            with tempfile.NamedTemporaryFile(delete=False) as to_file:
-                with open(from_path) as from_file:
-                    original = from_file.read()
-                    fixed = fixup_patch.fixup_patch(original)
-                    to_file.write(fixed)
+        selected = set()
+        while patch_names:
+            patch_name = patch_names.pop()
+            if patch_name not in selected:
+                selected.add(patch_name)
+                patch_names.extend(parents[patch_name])
 
-            # Strip 0001- prefix that git-format-patch uses
-            source_path = os.path.join(self.path, filename.split('-', 1)[1])
-            shutil.move(to_file.name, source_path)
-            os.unlink(from_path)
+        return [patch_name for patch_name in series if patch_name in selected]
 
-            source_paths.append(source_path)
+    def _start_journal(self, patch_rev=None, selection=None, **options):
+        """Start a restore's journal, picking up any patches that are
+        already applied.
 
-        parent_patch_name = self._get_commit_hash_and_patch_name(
-            since)[1]
+        `selection` limits the restore to those patches of the series.
+        """
+        old_journal = self._load_journal()
+        if old_journal and old_journal.conflict:
+            raise exc.RestoreInProgress
 
-        return source_paths, parent_patch_name
+        applied_patches = self._applied_patches()
+        if applied_patches:
+            base = self.rev_parse('%s^' % applied_patches[-1][0])
+        else:
+            base = self.get_head_commit_hash()
 
-    def save(self, since=None):
-        """Save a series of commits as patches into the patch-repo."""
-        if self.uncommitted_changes() or self.patch_repo.uncommitted_changes():
-            raise exc.UncommittedChanges
+        if patch_rev:
+            patch_rev = self.patch_repo.rev_parse('%s^{commit}' % patch_rev)
 
-        if not since:
-            since = self._last_upstream_commit_hash()
+        restore_journal = journal.RestoreJournal(
+            self._journal_path, base=base, patch_rev=patch_rev,
+            applied=[[patch_name, commit_hash] for commit_hash, patch_name
+                     in reversed(applied_patches)],
+            **options)
 
-        if not since:
-            raise exc.NoPatchesApplied
+        patch_source = self._patch_source(restore_journal.patch_rev)
+        try:
+            with self.patch_repo.lock(exclusive=False):
+                restore_journal.series = patch_source.series
+        finally:
+            if patch_source is not self.patch_repo:
+                patch_source.close()
+
+        if selection is not None:
+            restore_journal.partial = selection != restore_journal.series
+            restore_journal.series = selection
+
+        # What a partial restore applied needn't be the start of this series,
+        # in which case it has to be applied again from the upstream commit
+        applied_names = [patch_name for patch_name, _
+                         in restore_journal.applied]
+        if self._read_partial_series() is not None and applied_names != \
+                restore_journal.series[:len(applied_names)]:
+            self.reset(base, hard=True)
+            restore_journal.applied = []
+
+        restore_journal.save()
+        return restore_journal
+
+    def _recover_journal(self):
+        """Load the journal of an interrupted restore and bring it up to date
+        with whatever happened after it was last written.
+        """
+        restore_journal = self._load_journal()
+        if not restore_journal:
+            raise exc.NothingToResume
 
-        if '..' in since:
-            raise ValueError(".. not supported at the moment")
+        if restore_journal.conflict:
+            raise exc.RestoreInProgress
 
-        source_paths, parent_patch_name = self._create_patches(since)
+        # A `git am` or a fast-apply that was cut short
+        if self.rebase_in_progress():
+            self.am(abort=True)
 
-        added, updated, skipped, removed = self.patch_repo.sync_patches(
-            source_paths, parent_patch_name)
+        try:
+            self.rev_parse(fast_apply.FAST_APPLY_REF)
+        except git.exc.GitException:
+            pass
+        else:
+            self.update_ref(fast_apply.FAST_APPLY_REF, delete=True)
 
-        # Rollback and reapply patches so that working repo has
-        # patch-annotations for latest saved patches
-        num_patches = len(self.patch_repo.series)
-        self.reset('HEAD~%d' % num_patches, hard=True)
+        if self.uncommitted_changes():
+            raise exc.UncommittedChanges
 
-        commit_msg = "Saving patches: added %d, updated %d, removed %d" % (
-            len(added), len(updated), len(removed))
+        # Patches that were committed after the journal was last written
+        last_commit = restore_journal.last_commit
+        head = self.get_head_commit_hash()
+        if head != last_commit:
+            commits = self.rev_list('%s..%s' % (last_commit, head),
+                                    reverse=True)
+            if not commits or \
+                    self.rev_parse('%s^' % commits[0]) != last_commit:
+                raise exc.CannotResume
 
-        # We have to commit to the patch-repo AFTER rolling-back and
-        # reapplying so that we have the patch-annotations necessary to figure
-        # out the correct Ply-Based-On annotation in the patch-repo.
-        self.restore(commit_msg=commit_msg, fetch_remotes=False,
-                     customize_commit_msg=not self.NON_INTERACTIVE)
+            done = restore_journal.done
+            pending = [patch_name for patch_name in restore_journal.series
+                       if patch_name not in done]
 
-    @property
-    def status(self):
-        """Return the status of the working-repo."""
-        if os.path.exists(self._patch_conflict_path):
-            return 'restore-in-progress'
+            for commit_hash in commits:
+                if not pending:
+                    raise exc.CannotResume
 
-        if len(self._applied_patches()) == 0:
-            return 'no-patches-applied'
+                patch_name = self._get_commit_hash_and_patch_name(
+                    commit_hash)[1]
 
-        return 'all-patches-applied'
+                if patch_name is None and commit_hash == head:
+                    # Applied but killed before it could be annotated
+                    patch_name = pending[0]
+                    self._add_patch_annotation(patch_name)
+                    self._flush_patch_notes()
+                    commit_hash = self.get_head_commit_hash()
 
-    def check_patch_repo(self):
-        return self.patch_repo.check()
+                if patch_name != pending.pop(0):
+                    raise exc.CannotResume
 
+                restore_journal.applied.append([patch_name, commit_hash])
 
-class PatchRepo(Repo):
-    """Represents a git repo containing versioned patch files."""
+            restore_journal.save()
 
-    def check(self):
-        """Sanity check the patch-repo.
+        return restore_journal
 
-        This ensures that the number of patches in the patch-repo matches the
-        series file.
+    def _run_restore(self, restore_journal):
+        patch_source = self._patch_source(restore_journal.patch_rev)
+        try:
+            self._restore(restore_journal, patch_source)
+        finally:
+            if patch_source is not self.patch_repo:
+                patch_source.close()
+
+    def _restore(self, restore_journal, patch_source):
+        #####################################################################
+        #
+        #                          Reentrant-Section
+        #
+        # This bit of code is called repeatedly until all of the patches have
+        # been successfully applied, skipped, or we've aborted the restore.
+        #
+        #####################################################################
+        series = restore_journal.series
+        self._emit('restore-started', total=len(series),
+                   done=len(restore_journal.done))
+
+        fast_applier = None
+        if fast_apply.FastApplier.supported(self):
+            def fallback(patch_path, patch_name):
+                # The fast path's copy of the patch may be gone by now
+                with patch_source.patch_path(patch_name) as patch_path:
+                    self._apply_with_am(restore_journal, patch_path,
+                                        patch_name)
+
+            fast_applier = fast_apply.FastApplier(
+                self, annotate=self.annotations == 'message',
+                fallback=fallback)
+
+        # Journal the patches the fast path has landed on HEAD
+        journaled = [0]
+
+        def journal_fast_applied():
+            if not fast_applier:
+                return
+            landed = fast_applier.applied[journaled[0]:]
+            if not landed:
+                return
+            if self.annotations == 'notes':
+                for commit_hash, patch_name in landed:
+                    self._queue_patch_note(commit_hash, patch_name)
+            restore_journal.applied.extend(
+                [patch_name, commit_hash] for commit_hash, patch_name
+                in landed)
+            restore_journal.save()
+            journaled[0] = len(fast_applier.applied)
+            metrics.count('patches_applied', len(landed))
+
+        with self._phase('apply'):
+            try:
+                for patch_name in self._pending_patches(restore_journal):
+                    self._check_cancelled()
+                    self._emit('patch-started', patch=patch_name)
+
+                    with patch_source.patch_path(patch_name) as patch_path:
+                        metrics.count('patch_bytes_read',
+                                      os.path.getsize(patch_path))
+
+                        # Patches that apply exactly are committed
+                        # in-process and only hit the worktree when we next
+                        # flush
+                        if fast_applier and fast_applier.apply(patch_path,
+                                                               patch_name):
+                            journal_fast_applied()
+                            self._emit('patch-applied', patch=patch_name)
+                            continue
+
+                        if fast_applier:
+                            fast_applier.flush()
+                            journal_fast_applied()
+
+                        self._apply_with_am(restore_journal, patch_path,
+                                            patch_name)
+            finally:
+                try:
+                    if fast_applier:
+                        fast_applier.close()
+                finally:
+                    journal_fast_applied()
+                    self._flush_patch_notes()
+
+        ######################################################################
+        #
+        #                              Endgame
+        #
+        # This bit of code is only reached after all patches have been applied
+        # sucessfully or have been skipped. To finish up, we commit any
+        # changes we're holding in the patch-repo and peform any necessary
+        # housekeeping (removing the journal, etc.)
+        #
+        ######################################################################
+        with self._phase('commit'):
+            self._finish_restore(restore_journal, patch_source)
+
+        self._emit('restore-finished')
+
+    def _finish_restore(self, restore_journal, patch_source):
+        if restore_journal.deferred:
+            self._restore_series_order(restore_journal)
+
+        self._record_partial_series(restore_journal)
+
+        if restore_journal.patch_rev:
+            # Nothing was written to the patch-repo, so there's nothing to
+            # commit
+            self._cache_restore_result(restore_journal.base,
+                                       patch_head=restore_journal.patch_rev)
+            self._record_applied_blobs(patch_source)
+            restore_journal.delete()
+            return
+
+        # Finish removals a killed restore may not have got to
+        series = self.patch_repo.series
+        for patch_name in restore_journal.removed_patches:
+            if patch_name in series:
+                self.patch_repo.remove_patch(patch_name)
+
+        self._commit_patch_repo(
+            restore_journal.updated, restore_journal.removed,
+            commit_msg=restore_journal.commit_msg,
+            customize_commit_msg=restore_journal.customize_commit_msg,
+            based_on=restore_journal.base)
+
+        self._record_applied_blobs(patch_source)
+        restore_journal.delete()
+
+    def rollback(self, lose_uncommitted=False, full=False):
+        """Rollback to that last upstream commit.
+
+        With `full`, a sparse checkout left by a sparse restore is switched
+        back to a full one.
         """
-        series = set(self.series)
-        patch_names = set(self.patch_names)
+        if self.uncommitted_changes() and not lose_uncommitted:
+            raise exc.UncommittedChanges
+
+        based_on = self._last_upstream_commit_hash()
+
+        if based_on:
+            # If any patches successfully applied, roll them back
+            self.reset(based_on, hard=True)
+        else:
+            # If no patches applied successfully applied, then just trash the
+            # in-progress changes
+            self.reset('HEAD', hard=True)
+
+        self._clear_partial_series()
+
+        if full and self.sparse_checkout_enabled():
+            self.sparse_checkout_disable()
+
+    def _patch_subjects(self, revision_range):
+        """Return {commit_hash: sanitized_subject} for the commits in
+        `revision_range`; format-patch names its files after these.
+        """
+        subjects = {}
+        for line in self.log(cmd_arg=revision_range,
+                             pretty='%H %f').split('\n'):
+            if line:
+                commit_hash, subject = line.split(' ', 1)
+                subjects[commit_hash] = subject
+        return subjects
+
+    @contextlib.contextmanager
+    def _blob_staging(self):
+        """Yield a scratch directory binary payloads are stored in while
+        patches are formatted.
+
+        Blobs only reach the patch-repo's store once `sync_patches` writes
+        the patches referring to them, under the patch-repo lock; until then
+        another working-repo's save could drop them as unreferenced.
+        """
+        path = tempfile.mkdtemp(prefix='ply-blobs-')
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path)
+
+    def _normalize_patches(self, revision_range, first_number=1,
+                           blob_staging=None):
+        """Read `format-patch --stdout` for `revision_range` and normalize
+        each patch into a spooled temporary file.
+
+        Patches are named the way format-patch names its files, minus the
+        0001- prefix; `first_number` is the number format-patch would give
+        the first patch in the range.
+
+        With the `ply.binaryblobs` git config set, binary payloads are moved
+        into a blob store in the `blob_staging` directory along the way.
+
+        Returns a list of (patch_name, patch_file) tuples in series order.
+        """
+        subjects = self._patch_subjects(revision_range)
+
+        store_blobs = utils.config_true(self._get_config('ply.binaryblobs'))
+
+        name_max = int(self._get_config('format.filenamemaxlength') or
+                       FORMAT_PATCH_NAME_MAX) - len('.patch') - 1
+
+        patches = []
+        normalizer = None
+        deflater = None
+        separator = None
+        for line in self.format_patch_lines(
+                revision_range, keep_subject=True, no_numbered=True,
+                no_stat=True):
+            matches = RE_MBOX_FROM.match(line)
+            boundary = matches and matches.group(1) in subjects
+
+            # With --stdout, messages are separated by an extra blank line
+            # that isn't part of either patch, so hold blank lines back until
+            # we know whether a new message follows
+            if separator is not None:
+                if not boundary:
+                    normalizer.feed(separator)
+                separator = None
+
+            if line == '\n' and normalizer:
+                separator = line
+                continue
+
+            if boundary:
+                if normalizer:
+                    normalizer.close()
+                if deflater:
+                    deflater.close()
+
+                filename = '%04d-%s' % (first_number + len(patches),
+                                        subjects.pop(matches.group(1)))
+                patch_name = '%s.patch' % filename[:name_max].split('-', 1)[1]
+
+                patch_file = tempfile.SpooledTemporaryFile(
+                    max_size=fixup_patch.SPOOL_MAX_SIZE)
+                output = patch_file
+                if store_blobs:
+                    output = deflater = blobs.Deflater(patch_file,
+                                                       blob_staging)
+                normalizer = fixup_patch.PatchNormalizer(output)
+                patches.append((patch_name, patch_file))
+
+            normalizer.feed(line)
+
+        if separator is not None:
+            normalizer.feed(separator)
+
+        if normalizer:
+            normalizer.close()
+        if deflater:
+            deflater.close()
+
+        return patches
+
+    def _create_patches(self, since, blob_staging=None):
+        """
+        The default output of format-patch isn't ideally suited for our
+        purposes since it contains extraneous info as well as text that
+        changes even if the underlying patch doesn't change.
+
+        The following options are used to correct this:
+
+        --keep-subject - remove unecessary [PATCH] prefix
+        --no-stat - remove unecessary diffstat
+        --no-numbered - remove number of patches in set from subject line
+
+        In addition, we need to rewrite the first-line of the patch-file to
+        remove an unecessary commit-hash. On refresh, this would change even
+        if the actual patch was the same, leading to very noisy diffs.
+
+        Patches are read from `format-patch --stdout` and normalized into
+        spooled temporary files rather than written into the working-repo,
+        so that `sync_patches` only has to touch the patch-repo for patches
+        that actually changed. Returns a list of (patch_name, patch_file)
+        tuples in series order.
+        """
+        patches = self._normalize_patches('%s..HEAD' % since,
+                                          blob_staging=blob_staging)
+
+        parent_patch_name = self._get_commit_hash_and_patch_name(
+            since)[1]
+
+        return patches, parent_patch_name
+
+    def _create_patches_parallel(self, since, jobs, blob_staging=None):
+        """Like `_create_patches` but spreads formatting and normalization
+        of the commits across a pool of `jobs` processes.
+
+        The commits are split into contiguous chunks which are handed out
+        with `Pool.map`, so results come back in series order. Classifying
+        the patches against the patch-repo is left to `sync_patches`, which
+        does it under the patch-repo lock.
+
+        Falls back to a serial `_create_patches` when the range contains
+        merges, since those can't be split into contiguous ranges.
+        """
+        revision_range = '%s..HEAD' % since
+        commits = self.rev_list(revision_range, reverse=True)
+
+        if jobs < 2 or len(commits) < 2 or \
+                self.rev_list(revision_range, merges=True):
+            return self._create_patches(since, blob_staging=blob_staging)
+
+        num_chunks = min(len(commits), jobs * SAVE_CHUNKS_PER_JOB)
+        chunk_size = -(-len(commits) // num_chunks)
+
+        chunks = []
+        for start in xrange(0, len(commits), chunk_size):
+            end = min(start + chunk_size, len(commits))
+            chunk_since = commits[start - 1] if start else since
+            chunks.append((self.path,
+                           '%s..%s' % (chunk_since, commits[end - 1]),
+                           start + 1, blob_staging))
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_create_patches_worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        patches = []
+        for chunk_results in results:
+            for patch_name, data in chunk_results:
+                patches.append((patch_name, cStringIO.StringIO(data)))
+
+        parent_patch_name = self._get_commit_hash_and_patch_name(
+            since)[1]
+
+        return patches, parent_patch_name
+
+    def save(self, since=None, jobs=1):
+        """Save a series of commits as patches into the patch-repo.
+
+        `jobs` greater than 1 formats the patches using a pool of that many
+        processes.
+        """
+        if self.uncommitted_changes() or self.patch_repo.uncommitted_changes():
+            raise exc.UncommittedChanges
+
+        # When saving everything above the upstream commit, that's also what
+        # the series is based on
+        based_on = None
+        if not since:
+            since = based_on = self._last_upstream_commit_hash()
+
+        if not since:
+            raise exc.NoPatchesApplied
+
+        if '..' in since:
+            raise ValueError(".. not supported at the moment")
+
+        with self._blob_staging() as blob_staging:
+            if jobs > 1:
+                patches, parent_patch_name = self._create_patches_parallel(
+                    since, jobs, blob_staging=blob_staging)
+            else:
+                patches, parent_patch_name = self._create_patches(
+                    since, blob_staging=blob_staging)
+
+            # Hold the lock from writing the patches until they're committed
+            # so that a concurrent save or restore can't interleave with us
+            with self.patch_repo.lock():
+                unapplied = self._unapplied_patches()
+                added, updated, skipped, removed = \
+                    self.patch_repo.sync_patches(
+                        patches, parent_patch_name, unapplied=unapplied,
+                        blob_staging=blob_staging)
+                metrics.count('patches_updated', len(added) + len(updated))
+                metrics.count('patches_removed', len(removed))
+
+                commit_msg = "Saving patches: added %d, updated %d," \
+                    " removed %d" % (len(added), len(updated), len(removed))
+
+                # We have to commit to the patch-repo AFTER the working repo
+                # has patch-annotations for the latest saved patches so that
+                # we can figure out the correct Ply-Based-On annotation in the
+                # patch-repo.
+                if self._annotate_saved_commits(
+                        since, [patch_name for patch_name, _ in patches]):
+                    self._commit_patch_repo(
+                        0, 0, commit_msg=commit_msg,
+                        customize_commit_msg=not self.NON_INTERACTIVE,
+                        based_on=based_on)
+                    self._record_applied_blobs(
+                        self.patch_repo,
+                        commits=self.rev_list('%s..HEAD' % since))
+                    return
+
+                # Rollback and reapply patches so that working repo has
+                # patch-annotations for latest saved patches
+                unapplied = set(unapplied)
+                applied = [patch_name
+                           for patch_name in self.patch_repo.series
+                           if patch_name not in unapplied]
+                self.reset('HEAD~%d' % len(applied), hard=True)
+
+                self.restore(commit_msg=commit_msg, fetch_remotes=False,
+                             customize_commit_msg=not self.NON_INTERACTIVE,
+                             only=applied if unapplied else None)
+
+    def _annotate_saved_commits(self, since, patch_names):
+        """Add patch-annotations to the commits just saved by rewriting their
+        commit messages in place.
+
+        Each commit keeps its tree and author, so neither the index nor the
+        worktree needs touching and HEAD is moved once at the end. Commits
+        that already carry the right annotation on an unchanged parent are
+        reused as-is.
+
+        Returns False, leaving HEAD alone, if the range can't be rewritten
+        this way (merges, re-encoded messages, commits format-patch skipped)
+        and the caller needs to reapply the patches instead.
+        """
+        revision_range = '%s..HEAD' % since
+        if self.rev_list(revision_range, merges=True):
+            return False
+
+        commits = self.rev_list(revision_range, reverse=True)
+        if not commits or len(commits) != len(patch_names):
+            return False
+
+        if self.annotations == 'notes':
+            # Nothing to rewrite, the commits are fine as they are
+            for commit_hash, patch_name in zip(commits, patch_names):
+                self._queue_patch_note(commit_hash, patch_name)
+            self._flush_patch_notes()
+            return True
+
+        return self._rewrite_patch_commits(
+            commits, patch_names, annotate_message=True,
+            reflog_message='ply: save') is not None
+
+    def _read_commit(self, cat_file, commit_hash):
+        """Return a tuple of the parent, tree, author and message of a commit
+        read through `cat_file`, or None for merges, root commits and
+        re-encoded messages.
+        """
+        headers, _, message = cat_file.read(commit_hash)[2].partition('\n\n')
+
+        header_lines = [line for line in headers.split('\n')
+                        if not line.startswith(' ')]
+        fields = dict(line.split(' ', 1) for line in header_lines)
+
+        parents = [line for line in header_lines
+                   if line.startswith('parent ')]
+        if len(parents) != 1 or 'encoding' in fields:
+            return None
+
+        matches = RE_AUTHOR.match(fields['author'])
+        if not matches:
+            return None
+
+        return fields['parent'], fields['tree'], matches.groups(), message
+
+    def _reorder_patch_commits(self, base, commits, reflog_message):
+        """Recreate the linear run of commits from `base` to HEAD in the
+        order given by `commits`.
+
+        The commits have to commute, touching different files, so HEAD's
+        tree stays the same. Each commit's diff is applied in a scratch
+        index, so neither the index nor the worktree is touched and HEAD is
+        moved once at the end.
+
+        Returns the list of new commit hashes, or None, leaving HEAD alone,
+        if the commits can't be reordered this way.
+        """
+        head = self.get_head_commit_hash()
+
+        cat_file = self.cat_file_batch()
+        try:
+            infos = []
+            for commit_hash in commits:
+                commit = self._read_commit(cat_file, commit_hash)
+                if commit is None:
+                    return None
+                infos.append((commit_hash, ) + commit)
+        finally:
+            cat_file.close()
+
+        new_head = base
+        new_commits = []
+        with self._scratch_index() as index_file:
+            self.read_tree(base, index_file=index_file)
+
+            for commit_hash, parent, tree, author, message in infos:
+                if parent == new_head:
+                    new_head = commit_hash
+                    self.read_tree(commit_hash, index_file=index_file)
+                    new_commits.append(new_head)
+                    continue
+
+                with tempfile.NamedTemporaryFile(suffix='.patch') as f:
+                    self.diff_tree(parent, commit_hash, binary=True,
+                                   stdout=f)
+                    f.flush()
+                    try:
+                        self.apply(f.name, cached=True,
+                                   index_file=index_file)
+                    except git.exc.GitException:
+                        return None
+
+                new_head = self.commit_tree(
+                    self.write_tree(index_file=index_file),
+                    parents=[new_head], message=message, author=author)
+                new_commits.append(new_head)
+
+        if self.rev_parse('%s^{tree}' % new_head) != \
+                self.rev_parse('%s^{tree}' % head):
+            return None
+
+        if new_head != head:
+            self.update_ref('HEAD', new_head, old_value=head,
+                            message=reflog_message)
+
+        return new_commits
+
+    def _rewrite_patch_commits(self, commits, patch_names, annotate_message,
+                               reflog_message):
+        """Rewrite the messages of a linear run of commits ending at HEAD.
+
+        Ply-Patch lines are removed from the message of each commit with a
+        patch_name and, if `annotate_message` is set, replaced with an
+        annotation for that patch_name; commits whose patch_name is None keep
+        their message. Trees and authors are kept, so neither the index nor
+        the worktree is touched and HEAD is moved once at the end. Commits
+        whose message doesn't change and whose parent wasn't rewritten are
+        reused as-is.
+
+        Returns the list of new commit hashes, or None, leaving HEAD alone,
+        if the commits can't be rewritten this way (merges, root commits,
+        re-encoded messages).
+        """
+        cat_file = self.cat_file_batch()
+        try:
+            rewrites = []
+            for commit_hash, patch_name in zip(commits, patch_names):
+                commit = self._read_commit(cat_file, commit_hash)
+                if commit is None:
+                    return None
+
+                parent, tree, author, message = commit
+                rewrites.append((commit_hash, parent, patch_name, tree,
+                                 author, message))
+        finally:
+            cat_file.close()
+
+        new_head = rewrites[0][1]
+        new_commits = []
+        for commit_hash, parent, patch_name, tree, author, message in rewrites:
+            new_message = message
+            if patch_name is not None:
+                lines = [line for line in message.split('\n')
+                         if 'Ply-Patch:' not in line]
+                if annotate_message:
+                    # Mirror what `_add_annotation` does with `git commit
+                    # --amend`
+                    lines.extend(['', 'Ply-Patch: %s' % patch_name])
+                new_message = utils.stripspace('\n'.join(lines))
+
+            if new_message == message and new_head == parent:
+                new_head = commit_hash
+            else:
+                new_head = self.commit_tree(tree, parents=[new_head],
+                                            message=new_message,
+                                            author=author)
+
+            new_commits.append(new_head)
+
+        if new_head != commits[-1]:
+            self.update_ref('HEAD', new_head, old_value=commits[-1],
+                            message=reflog_message)
+
+        return new_commits
+
+    def migrate_annotations(self, backend):
+        """Move the patch-annotations of the applied patches to `backend`
+        ('message' or 'notes') and make it the configured backend.
+
+        The applied commits, and any new commits on top of them, are
+        rewritten with their annotations added to or removed from their
+        messages, so their hashes change. Returns the number of applied
+        patches migrated.
+        """
+        if backend not in ANNOTATION_BACKENDS:
+            raise exc.UnknownAnnotationBackend(backend)
+
+        if self._restore_in_progress() or self.rebase_in_progress():
+            raise exc.RestoreInProgress
+
+        if backend == self.annotations:
+            return 0
+
+        applied = list(reversed(self._applied_patches()))
+        patch_names = dict(applied)
+
+        commits = []
+        new_commits = []
+        if applied:
+            commits = self.rev_list('%s^..HEAD' % applied[0][0],
+                                    reverse=True)
+            new_commits = self._rewrite_patch_commits(
+                commits, [patch_names.get(c) for c in commits],
+                annotate_message=backend == 'message',
+                reflog_message='ply: migrate annotations')
+            if new_commits is None:
+                raise exc.CannotRewriteCommits
+
+        if backend == 'notes':
+            for old_hash, new_hash in zip(commits, new_commits):
+                if old_hash in patch_names:
+                    self._queue_patch_note(new_hash, patch_names[old_hash])
+            self._flush_patch_notes()
+        else:
+            try:
+                self.rev_parse(NOTES_REF)
+            except git.exc.GitException:
+                pass
+            else:
+                self.update_ref(NOTES_REF, delete=True)
+
+            if hasattr(self, '_patch_notes_cache'):
+                del self._patch_notes_cache
+
+        self.config('set', config_key='ply.annotations', config_value=backend)
+        self._annotations = backend
+
+        return len(applied)
+
+    def _restore_in_progress(self):
+        """Return whether a restore is waiting on a conflict to be resolved,
+        skipped or aborted.
+        """
+        restore_journal = self._load_journal()
+        return bool(restore_journal and restore_journal.conflict)
+
+    @property
+    def status(self):
+        """Return the status of the working-repo."""
+        if self._restore_in_progress():
+            return 'restore-in-progress'
+
+        if len(self._applied_patches()) == 0:
+            return 'no-patches-applied'
+
+        if self._read_partial_series() is not None:
+            return 'some-patches-applied'
+
+        return 'all-patches-applied'
+
+    def check_patch_repo(self):
+        return self.patch_repo.check()
+
+    @property
+    def _restore_cache_path(self):
+        # Shared between worktrees so an export from one checkout can reuse a
+        # restore performed in another
+        return os.path.join(self.git_common_dir, 'ply-restore-cache')
+
+    def _read_restore_cache(self):
+        entries = []
+        if os.path.exists(self._restore_cache_path):
+            with open(self._restore_cache_path) as f:
+                for line in f:
+                    entries.append(tuple(line.split()))
+        return entries
+
+    def _cache_restore_result(self, base=None, patch_head=None):
+        """Remember the tree produced by a completed restore.
+
+        The entry is keyed by the upstream commit and the patch-repo commit
+        it was produced from, so this must only be called once both repos
+        have been committed. The tree of a partial restore isn't cached.
+        """
+        if self._read_partial_series() is not None:
+            return
+
+        if not base:
+            base = self._last_upstream_commit_hash() or \
+                self.get_head_commit_hash()
+        if not patch_head:
+            patch_head = self.patch_repo.get_head_commit_hash()
+        entry = (base, patch_head, self.rev_parse('HEAD^{tree}'))
+
+        entries = [e for e in self._read_restore_cache() if e[:2] != entry[:2]]
+        entries.append(entry)
+
+        # Worktrees share the cache, so never leave it half-written
+        with utils.atomic_write(self._restore_cache_path) as f:
+            for e in entries[-RESTORE_CACHE_SIZE:]:
+                f.write('%s\n' % ' '.join(e))
+
+    def _cached_restore_tree(self, base, patch_head):
+        for entry_base, entry_patch_head, tree in self._read_restore_cache():
+            if (entry_base, entry_patch_head) != (base, patch_head):
+                continue
+            try:
+                # The tree may have been garbage collected since
+                return self.rev_parse('%s^{tree}' % tree)
+            except git.exc.GitException:
+                return None
+        return None
+
+    def _patched_tree(self, base):
+        """Return the hash of the tree produced by applying the patch series
+        on top of `base`.
+
+        A cached restore result is used when one exists, otherwise the restore
+        is simulated in a scratch index.
+        """
+        base = self.rev_parse('%s^{commit}' % base)
+
+        patch_head = None
+        if not self.patch_repo.uncommitted_changes():
+            patch_head = self.patch_repo.get_head_commit_hash()
+            tree = self._cached_restore_tree(base, patch_head)
+            if tree:
+                return tree
+
+        tree, results = self._simulate_restore(base)
+
+        conflicts = [pn for pn, r in results.iteritems() if r == 'conflict']
+        if conflicts:
+            raise exc.PatchesDidNotApply(conflicts)
+
+        for patch_name, result in results.iteritems():
+            if result == 'upstream':
+                self.warn("Patch '%s' appears to be upstream" % patch_name)
+
+        return tree
+
+    def export(self, format='tar', base=None, output=None, stdout=None):
+        """Export the patched tree without checking it out.
+
+        `format` is one of 'tar', 'tar.gz' or 'dir'. Archives are written to
+        the `output` path, or streamed to the `stdout` file object if no path
+        is given; 'dir' extracts into the `output` directory.
+
+        `base` defaults to the last upstream commit, or HEAD if no patches
+        are applied.
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError('unknown format %s' % format)
+
+        if not base:
+            base = self._last_upstream_commit_hash() or 'HEAD'
+
+        tree = self._patched_tree(base)
+
+        if output:
+            output = os.path.abspath(output)
+
+        if format != 'dir':
+            self.archive(tree, format=format, output=output, stdout=stdout)
+            return
+
+        if not output:
+            raise ValueError("format 'dir' requires an output path")
+
+        with self._scratch_index() as index_file:
+            self.read_tree(tree, index_file=index_file)
+            self.checkout_index(os.path.join(output, ''),
+                                index_file=index_file)
+
+    def export_patch(self, format, output=None, stdout=None):
+        """Export the whole patch series as a single file.
+
+        `format` is either 'combined', a single diff of the patched tree
+        against the Ply-Based-On commit, or 'mbox', every patch concatenated
+        in series order. The result is written to the `output` path, or to
+        the `stdout` file object if no path is given.
+        """
+        if format not in PATCH_EXPORT_FORMATS:
+            raise ValueError('unknown format %s' % format)
+
+        base = self.patch_repo.based_on
+        if not base:
+            raise exc.NoBasedOnAnnotation
+
+        if format == 'combined':
+            def generate(f):
+                tree = self._patched_tree(base)
+                self.diff_tree(base, tree, binary=True, stdout=f)
+        else:
+            generate = self.patch_repo.write_mbox
+
+        with self.patch_repo.cached_artifact(format, base, generate) as path:
+            with open(path) as src:
+                if output:
+                    with open(output, 'w') as dest:
+                        shutil.copyfileobj(src, dest)
+                else:
+                    shutil.copyfileobj(src, stdout)
+
+    @contextlib.contextmanager
+    def _scratch_index(self):
+        """Yield the path to a throwaway index file.
+
+        Pointing git at this with GIT_INDEX_FILE lets us build trees without
+        touching the user's index or working tree.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='ply-index-')
+        try:
+            yield os.path.join(tmpdir, 'index')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _simulate_restore(self, base):
+        """Apply the patch series on top of `base` in a scratch index.
+
+        Returns a tuple of the resulting tree hash and an ordered dict
+        mapping each patch_name to one of 'applied', 'conflict' or
+        'upstream'. Patches that conflict are left out of the tree so that
+        the remaining patches can still be tried.
+        """
+        results = collections.OrderedDict()
+        tree = self.rev_parse('%s^{tree}' % base)
+
+        with self._scratch_index() as index_file:
+            self.read_tree(tree, index_file=index_file)
+
+            for patch_name in self.patch_repo.series:
+                try:
+                    with self.patch_repo.patch_path(patch_name) as patch_path:
+                        self.apply(patch_path, cached=True,
+                                   three_way_merge=True,
+                                   index_file=index_file)
+                except git.exc.PatchDidNotApplyCleanly:
+                    # Throw away any conflict stages left in the index
+                    self.read_tree(tree, index_file=index_file)
+                    results[patch_name] = 'conflict'
+                    continue
+
+                new_tree = self.write_tree(index_file=index_file)
+                if new_tree == tree:
+                    results[patch_name] = 'upstream'
+                else:
+                    results[patch_name] = 'applied'
+                tree = new_tree
+
+        return tree, results
+
+    def bisect_upstream(self, good, bad):
+        """Find the upstream commits that broke patches between `good` and
+        `bad`.
+
+        Rather than performing a full restore for each upstream commit, we
+        binary-search the first-parent history between the two, simulating
+        the restore in a scratch index at each step. Patches that break at
+        different points are tracked independently, so each distinct
+        breakage costs roughly log2(N) simulations.
+
+        Returns a list of (commit_hash, [patch_name, ...]) in upstream order.
+        """
+        commits = self.rev_list('%s..%s' % (good, bad), first_parent=True,
+                                reverse=True)
+        if not commits:
+            return []
+
+        simulations = {}
+
+        def conflicts_at(idx):
+            if idx not in simulations:
+                rev = good if idx < 0 else commits[idx]
+                results = self._simulate_restore(rev)[1]
+                simulations[idx] = set(
+                    pn for pn, r in results.iteritems() if r == 'conflict')
+            return simulations[idx]
+
+        culprits = collections.defaultdict(set)
+
+        def bisect(lo, hi, patch_names):
+            # Invariant: `patch_names` apply at `lo` but conflict at `hi`
+            if hi - lo == 1:
+                culprits[commits[hi]].update(patch_names)
+                return
+
+            mid = (lo + hi) // 2
+            broken = patch_names & conflicts_at(mid)
+            if broken:
+                bisect(lo, mid, broken)
+            if patch_names - broken:
+                bisect(mid, hi, patch_names - broken)
+
+        newly_failing = conflicts_at(len(commits) - 1) - conflicts_at(-1)
+        if newly_failing:
+            bisect(-1, len(commits) - 1, newly_failing)
+
+        series = self.patch_repo.series
+        return [(commit_hash,
+                 sorted(culprits[commit_hash], key=series.index))
+                for commit_hash in commits if commit_hash in culprits]
+
+
+def _file_changes(series, changed_files_for_patch):
+    """Return {filename: [patch1, patch2, ...]} over `series`."""
+    file_changes = collections.defaultdict(list)
+    for patch_name in series:
+        changed_files = changed_files_for_patch(patch_name)
+        for filename in changed_files:
+            file_changes[filename].append(patch_name)
+
+    return file_changes
+
+
+def _dependency_graph(file_changes):
+    """Return {(dependent, parent): set(filenames)} linking each patch to
+    the previous patch that touched the same file.
+    """
+    graph = collections.defaultdict(set)
+    for filename, patch_names in file_changes.iteritems():
+        parent = None
+        for dependent in patch_names:
+            if parent:
+                graph[(dependent, parent)].add(filename)
+            parent = dependent
+    return graph
+
+
+def _interleave_saved_patches(entries, saved):
+    """Return the series `entries` with the `saved` patches in their new
+    order, and every other entry still following the entry it followed
+    before.
+    """
+    saved_names = set(saved)
+    followers = collections.defaultdict(list)
+    leader = None
+    for entry in entries:
+        if entry in saved_names:
+            leader = entry
+        else:
+            followers[leader].append(entry)
+
+    series = list(followers[None])
+    for patch_name in saved:
+        series.append(patch_name)
+        series.extend(followers[patch_name])
+    return series
+
+
+def _changed_files(lines):
+    """Return the set of files modified by the patch in `lines`."""
+    changed_files = set()
+    for line in lines:
+        line = line.strip()
+        if line.startswith('--- a/'):
+            line = line.replace('--- a/', '')
+        elif line.startswith('+++ b/'):
+            line = line.replace('+++ b/', '')
+        else:
+            continue
+        filename = line
+        if filename.startswith('/dev/null'):
+            continue
+        changed_files.add(filename)
+
+    return changed_files
+
+
+def _parse_series(lines):
+    """Return the non-blank entries of a series file."""
+    patch_names = []
+
+    for line in lines:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        patch_names.append(line)
+
+    return patch_names
+
+
+class PatchRepo(Repo):
+    """Represents a git repo containing versioned patch files."""
+    lock_timeout = PATCH_REPO_LOCK_TIMEOUT
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=True):
+        """Hold the patch-repo's reader/writer lock.
+
+        A patch-repo may be shared by many working-repos, so anything that
+        changes it takes the lock exclusively while reads share it. The lock
+        is reentrant, but a shared lock can't be upgraded: flock(2) drops it
+        while converting, so a reader could lose it without knowing.
+        """
+        held = getattr(self, '_lock_mode', None)
+        if held == 'shared' and exclusive:
+            raise ValueError("can't take the patch-repo lock exclusively"
+                             " while holding it shared")
+
+        if held is not None:
+            yield
+            return
+
+        git_dir = os.path.join(self.path, '.git')
+        if not os.path.isdir(git_dir):
+            # Not initialized yet, so there's nothing to race on
+            yield
+            return
+
+        self._lock_file = open(os.path.join(git_dir, 'ply-lock'), 'a')
+        try:
+            if not utils.flock(self._lock_file, exclusive=exclusive,
+                               timeout=self.lock_timeout):
+                raise exc.PatchRepoLocked(self.path)
+
+            self._lock_mode = 'exclusive' if exclusive else 'shared'
+            try:
+                yield
+            finally:
+                self._lock_mode = None
+        finally:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _add_annotation(self, prefix, value):
+        with self.lock():
+            super(PatchRepo, self)._add_annotation(prefix, value)
+
+    def commit(self, *args, **kwargs):
+        with self.lock():
+            super(PatchRepo, self).commit(*args, **kwargs)
+
+    def check(self):
+        """Sanity check the patch-repo.
+
+        This ensures that the number of patches in the patch-repo matches the
+        series file.
+        """
+        with self.lock(exclusive=False):
+            series = set(self.series)
+            patch_names = set(self.patch_names)
 
         # Has entry in series file but not actually present
         no_file = series - patch_names
@@ -540,6 +2278,70 @@ class PatchRepo(Repo):
         return ('failed', dict(no_file=no_file,
                                no_series_entry=no_series_entry))
 
+    @property
+    def based_on(self):
+        """Return the upstream commit hash from the most recent Ply-Based-On
+        annotation, or None if the patch-repo has never been restored.
+        """
+        commit_msg = self.log(count=1, pretty='%B', grep='^Ply-Based-On: ')
+        matches = re.search(RE_BASED_ON, commit_msg)
+        if not matches:
+            return None
+
+        return matches.group(1).strip()
+
+    def write_mbox(self, f):
+        """Write every patch in the series, in order, into file object `f`.
+
+        The patch files are already mbox formatted, so this is just a
+        concatenation.
+        """
+        for patch_name in self.series:
+            with open(os.path.join(self.path, patch_name)) as patch_file:
+                f.writelines(blobs.inflate(patch_file, self._read_blob))
+
+    @contextlib.contextmanager
+    def cached_artifact(self, kind, base, generate):
+        """Yield the path to an artifact derived from the patch series, such
+        as a combined diff or mbox bundle.
+
+        Artifacts are cached in the patch-repo's git dir, keyed by HEAD and
+        the upstream `base`, so repeated builds just stream the cached file.
+        On a miss, `generate` is called with a file object to write the
+        artifact into. Nothing is cached while the patch-repo has uncommitted
+        changes since HEAD wouldn't describe its contents.
+        """
+        if self.uncommitted_changes():
+            with tempfile.NamedTemporaryFile() as f:
+                generate(f)
+                f.flush()
+                yield f.name
+            return
+
+        cache_dir = os.path.join(self.git_dir, 'ply-cache')
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+
+        filename = '%s-%s-%s' % (kind, self.get_head_commit_hash(), base)
+        path = os.path.join(cache_dir, filename)
+
+        if not os.path.exists(path):
+            # Only the latest artifact of each kind is worth keeping
+            for stale in os.listdir(cache_dir):
+                if stale.startswith('%s-' % kind):
+                    os.unlink(os.path.join(cache_dir, stale))
+
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    generate(f)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+        yield path
+
     @property
     def patch_names(self):
         """Return all patch files in the patch-repo (recursively)."""
@@ -571,25 +2373,36 @@ class PatchRepo(Repo):
 
         self.add('series')
 
-    def _determine_what_changed(self, source_paths, parent_patch_name,
-                                last_patch_name=None):
+    def _classify_patch(self, patch_name, patch_file):
+        """Return whether a regenerated patch is 'added', 'updated' or
+        'skipped' (unchanged) relative to the patch-repo.
+        """
+        dest_path = os.path.join(self.path, patch_name)
+        if not utils.path_exists_case_sensitive(dest_path):
+            return 'added'
+
+        # For simplicity, we regenerate all patches, however some will be the
+        # same, so perform a file compare so we keep accurate counts of which
+        # were truly updatd
+        if utils.meaningful_diff(patch_file, dest_path):
+            return 'updated'
+
+        return 'skipped'
+
+    def _determine_what_changed(self, patches, parent_patch_name,
+                                last_patch_name=None, unapplied=()):
         added = set()
         updated = set()
-        skipped = set()
-
-        for source_path in source_paths:
-            patch_name = os.path.basename(source_path)
-            dest_path = os.path.join(self.path, patch_name)
-            if utils.path_exists_case_sensitive(dest_path):
-                # For simplicity, we regenerate all patches, however some will
-                # be the same, so perform a file compare so we keep accurate
-                # counts of which were truly updatd
-                if utils.meaningful_diff(source_path, dest_path):
-                    updated.add(patch_name)
-                else:
-                    skipped.add(patch_name)
-            else:
+        skipped = set(unapplied)
+
+        for patch_name, patch_file in patches:
+            status = self._classify_patch(patch_name, patch_file)
+            if status == 'added':
                 added.add(patch_name)
+            elif status == 'updated':
+                updated.add(patch_name)
+            else:
+                skipped.add(patch_name)
 
         skip_before = True
         skip_after = False
@@ -614,13 +2427,14 @@ class PatchRepo(Repo):
 
         return added, updated, skipped, removed
 
-    def sync_patches(self, source_paths, parent_patch_name,
-                     last_patch_name=None):
+    def sync_patches(self, patches, parent_patch_name,
+                     last_patch_name=None, unapplied=(), blob_staging=None):
         """Sync patches into working repo, adding, updating, and removing
         patches as necessary.
 
         `patches` is a list of tuples representing `patch_name` and
-        `source_path`.
+        `patch_file`, a file object holding the patch. Only added and updated
+        patches are written out.
 
         `parent_patch_name` represents where in the `series` file we should
         insert the new patch set.
@@ -631,59 +2445,119 @@ class PatchRepo(Repo):
 
         `None` indicates that the patch-set doesn't have a parent so it should
         be inserted at the beginning of the series file.
-        """
-        added, updated, skipped, removed = self._determine_what_changed(
-            source_paths, parent_patch_name, last_patch_name=last_patch_name)
 
-        source_lookup = {}
-        dest_lookup = {}
-        for source_path in source_paths:
-            patch_name = os.path.basename(source_path)
-            source_lookup[patch_name] = source_path
-            dest_lookup[patch_name] = os.path.join(self.path, patch_name)
+        `unapplied` lists the patches a partial restore left out, which are
+        kept, each following the patch it followed before.
 
-        # Toss the skipped patches
-        for patch_name in skipped:
-            if patch_name in source_lookup:
-                os.unlink(source_lookup[patch_name])
+        `blob_staging` is where the patches' binary payloads were stored
+        when they were formatted; the blobs of the patches written out are
+        moved into the patch-repo's store.
+        """
+        with self.lock():
+            return self._sync_patches(patches, parent_patch_name,
+                                      last_patch_name=last_patch_name,
+                                      unapplied=unapplied,
+                                      blob_staging=blob_staging)
+
+    def _sync_patches(self, patches, parent_patch_name, last_patch_name=None,
+                      unapplied=(), blob_staging=None):
+        added, updated, skipped, removed = self._determine_what_changed(
+            patches, parent_patch_name, last_patch_name=last_patch_name,
+            unapplied=unapplied)
 
-        # Remove any patches that should no longer be present
+        # Remove any patches that should no longer be present. This has to
+        # happen first so that, on a case-insensitive filesystem, a patch
+        # whose name only changed case isn't removed after being written.
         for patch_name in removed:
             self.rm(patch_name, force=True)
 
-        # Move the added and updated patches
-        for patch_name in added | updated:
-            shutil.move(source_lookup[patch_name],
-                        dest_lookup[patch_name])
-            self.add(patch_name)
+        # Write out the added and updated patches
+        for patch_name, patch_file in patches:
+            if patch_name in added or patch_name in updated:
+                patch_file.seek(0)
+                with open(os.path.join(self.path, patch_name), 'w') as f:
+                    shutil.copyfileobj(patch_file, f)
+                    metrics.count('patch_bytes_written', f.tell())
+                self.add(patch_name)
+
+                if blob_staging:
+                    patch_file.seek(0)
+                    self._import_blobs(blobs.references(patch_file),
+                                       blob_staging)
 
         # Update series file
         with self._mutate_series_file() as entries:
             for patch_name in removed:
                 entries.remove(patch_name)
 
-            if parent_patch_name:
-                base = entries.index(parent_patch_name) + 1
+            if unapplied:
+                entries[:] = _interleave_saved_patches(
+                    entries, [patch_name for patch_name, _ in patches])
             else:
-                base = 0
+                if parent_patch_name:
+                    base = entries.index(parent_patch_name) + 1
+                else:
+                    base = 0
+
+                for idx, (patch_name, _) in enumerate(patches):
+                    if patch_name in entries:
+                        # Already exists, reorder patch by removing it from
+                        # current location and inserting it into the new
+                        # location.
+                        entries.remove(patch_name)
 
-            for idx, source_path in enumerate(source_paths):
-                patch_name = os.path.basename(source_path)
-                if patch_name in entries:
-                    # Already exists, reorder patch by removing it from
-                    # current location and inserting it into the new location.
-                    entries.remove(patch_name)
+                    entries.insert(base + idx, patch_name)
 
-                entries.insert(base + idx, patch_name)
+        self._sync_blobs()
 
         return added, updated, skipped, removed
 
+    def _sync_blobs(self):
+        """Track the blobs the series refers to and drop the rest."""
+        blobs_path = os.path.join(self.path, blobs.BLOBS_DIR)
+        if not os.path.isdir(blobs_path):
+            return
+
+        referenced = set()
+        for patch_name in self.series:
+            patch_path = os.path.join(self.path, patch_name)
+            if os.path.exists(patch_path):
+                with open(patch_path) as f:
+                    referenced.update(blobs.references(f))
+
+        tracked = set(self.ls_files(blobs.BLOBS_DIR))
+        for blob_hash in os.listdir(blobs_path):
+            name = blobs.blob_name(blob_hash)
+            if blob_hash in referenced:
+                if name not in tracked:
+                    self.add(name)
+            elif name in tracked:
+                self.rm(name, quiet=True, force=True)
+            else:
+                os.unlink(os.path.join(blobs_path, blob_hash))
+
+    def _import_blobs(self, blob_hashes, staging_path):
+        """Copy blobs staged in `staging_path` into the blob store."""
+        for blob_hash in blob_hashes:
+            staged_path = os.path.join(staging_path,
+                                       blobs.blob_name(blob_hash))
+            if os.path.exists(staged_path):
+                with open(staged_path) as f:
+                    blobs.put(self.path, f.read())
+
+    def _read_blob(self, blob_hash):
+        with open(os.path.join(self.path, blobs.blob_name(blob_hash))) as f:
+            return f.read()
+
     def remove_patch(self, patch_name):
-        with self._mutate_series_file() as entries:
-            # If there were any local changes and it's not in the series
-            # file, we still want to remove it, hence force=True
-            self.rm(patch_name, force=True)
-            entries.remove(patch_name)
+        with self.lock():
+            with self._mutate_series_file() as entries:
+                # If there were any local changes and it's not in the series
+                # file, we still want to remove it, hence force=True
+                self.rm(patch_name, force=True)
+                entries.remove(patch_name)
+
+            self._sync_blobs()
 
     def initialize(self):
         """Initialize the patch repo (create series file and git-init)."""
@@ -701,18 +2575,8 @@ class PatchRepo(Repo):
         return os.path.join(self.path, 'series')
 
     def _non_recursive_series(self, series_path):
-        patch_names = []
-
         with open(series_path) as f:
-            for line in f:
-                line = line.strip()
-
-                if not line:
-                    continue
-
-                patch_names.append(line)
-
-        return patch_names
+            return _parse_series(f)
 
     def _recursive_series(self, series_path):
         """Emit patch_names from series file, handling -i recursion."""
@@ -733,27 +2597,154 @@ class PatchRepo(Repo):
 
     @property
     def series(self):
+        """Return the patches in the series.
+
+        Callers reading the series alongside the patches, or more than once,
+        should hold the lock to get a consistent view.
+        """
         return list(self._recursive_series(self.series_path))
 
+    @contextlib.contextmanager
+    def patch_path(self, patch_name):
+        """Yield the path to a patch file; see `PatchRepoRevision`.
+
+        A patch referring to blobs is inflated into a temporary copy.
+        """
+        patch_path = os.path.join(self.path, patch_name)
+
+        has_blobs = False
+        if os.path.isdir(os.path.join(self.path, blobs.BLOBS_DIR)):
+            with open(patch_path) as f:
+                has_blobs = bool(blobs.references(f))
+
+        if not has_blobs:
+            yield patch_path
+            return
+
+        with open(patch_path) as f, \
+                tempfile.NamedTemporaryFile(suffix='.patch') as inflated:
+            inflated.writelines(blobs.inflate(f, self._read_blob))
+            inflated.flush()
+            yield inflated.name
+
+    def patch_blobs(self, patch_names):
+        """Return a dict mapping each of `patch_names` that exists to the
+        blob hash of its contents.
+        """
+        patch_names = [patch_name for patch_name in patch_names
+                       if os.path.exists(os.path.join(self.path, patch_name))]
+        if not patch_names:
+            return {}
+        return dict(zip(patch_names, self.hash_object(*patch_names)))
+
+    def at(self, rev):
+        """Return a read-only view of the patch-repo at `rev`."""
+        return PatchRepoRevision(self, rev)
+
+    def range_diff(self, rev1, rev2, jobs=1):
+        """Return how the series changed between two patch-repo revisions,
+        leaving out the context and index-hash churn `ply save` produces.
+
+        Both series and their patches are read from git objects. Patches are
+        matched by name, then by patch-id, so a renamed patch isn't reported
+        as removed and added. Returns a list of (status, patch_name, detail)
+        tuples, removed patches first and then in `rev2` series order:
+
+            ('removed', patch_name, None)
+            ('added', patch_name, None)
+            ('renamed', patch_name, old_patch_name)
+            ('reordered', patch_name, None)
+            ('changed', patch_name, hunks)
+
+        where `hunks` are the meaningful hunks between the two versions of
+        the patch file, as lists of lines. The classification is spread
+        across a pool of `jobs` processes.
+        """
+        old, new = self.at(rev1), self.at(rev2)
+        try:
+            old_series, new_series = old.series, new.series
+            old_blobs = old.patch_blobs(old_series)
+            new_blobs = new.patch_blobs(new_series)
+
+            old_names, new_names = set(old_series), set(new_series)
+            removed = [patch_name for patch_name in old_series
+                       if patch_name not in new_names]
+            added = [patch_name for patch_name in new_series
+                     if patch_name not in old_names]
+
+            # {new_patch_name: old_patch_name}
+            renamed = {}
+            if removed and added:
+                removed_ids = {}
+                for patch_name in removed:
+                    patch_id = self.patch_id(old.read_patch(patch_name))
+                    if patch_id is not None:
+                        removed_ids.setdefault(patch_id, patch_name)
+                for patch_name in added:
+                    old_name = removed_ids.pop(
+                        self.patch_id(new.read_patch(patch_name)), None)
+                    if old_name is not None:
+                        renamed[patch_name] = old_name
+
+            modified = [patch_name for patch_name in new_series
+                        if patch_name in old_names and
+                        old_blobs.get(patch_name) != new_blobs.get(patch_name)]
+            args = [(old.read_patch(patch_name), new.read_patch(patch_name))
+                    for patch_name in modified]
+        finally:
+            old.close()
+            new.close()
+
+        if jobs > 1 and len(args) > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(_range_diff_worker, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_range_diff_worker, args)
+        changed = dict((patch_name, hunks)
+                       for patch_name, hunks in zip(modified, results)
+                       if hunks)
+
+        # Patches kept in both series are reordered when they fall outside
+        # of the longest run of them that stayed in the same order
+        renamed_from = set(renamed.values())
+        old_order = [patch_name for patch_name in old_series
+                     if patch_name in new_names or
+                     patch_name in renamed_from]
+        new_order = [renamed.get(patch_name, patch_name)
+                     for patch_name in new_series
+                     if patch_name not in added or patch_name in renamed]
+        in_order = set()
+        matcher = difflib.SequenceMatcher(None, old_order, new_order,
+                                          autojunk=False)
+        for i, _, size in matcher.get_matching_blocks():
+            in_order.update(old_order[i:i + size])
+
+        diff = [('removed', patch_name, None) for patch_name in removed
+                if patch_name not in renamed_from]
+        for patch_name in new_series:
+            if patch_name in renamed:
+                diff.append(('renamed', patch_name, renamed[patch_name]))
+            elif patch_name not in old_names:
+                diff.append(('added', patch_name, None))
+                continue
+
+            if renamed.get(patch_name, patch_name) not in in_order:
+                diff.append(('reordered', patch_name, None))
+
+            if patch_name in changed:
+                diff.append(('changed', patch_name, changed[patch_name]))
+
+        return diff
+
     def _changed_files_for_patch(self, patch_name):
         """Returns a set of files that were modified by specified patch."""
-        changed_files = set()
         patch_path = os.path.join(self.path, patch_name)
         with open(patch_path) as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('--- a/'):
-                    line = line.replace('--- a/', '')
-                elif line.startswith('+++ b/'):
-                    line = line.replace('+++ b/', '')
-                else:
-                    continue
-                filename = line
-                if filename.startswith('/dev/null'):
-                    continue
-                changed_files.add(filename)
-
-        return changed_files
+            return _changed_files(f)
 
     def _changes_by_filename(self):
         """Return a breakdown of what patches modifiied a given file over the
@@ -761,13 +2752,7 @@ class PatchRepo(Repo):
 
         {filename: [patch1, patch2, ...]}
         """
-        file_changes = collections.defaultdict(list)
-        for patch_name in self.series:
-            changed_files = self._changed_files_for_patch(patch_name)
-            for filename in changed_files:
-                file_changes[filename].append(patch_name)
-
-        return file_changes
+        return _file_changes(self.series, self._changed_files_for_patch)
 
     def patch_dependencies(self):
         """Returns a graph representing the file-dependencies between patches.
@@ -782,24 +2767,135 @@ class PatchRepo(Repo):
 
             {(dependent, parent): set(file_both_touch1, file_both_touch2, ...)}
         """
-        graph = collections.defaultdict(set)
-        for filename, patch_names in self._changes_by_filename().iteritems():
-            parent = None
-            for dependent in patch_names:
-                if parent:
-                    graph[(dependent, parent)].add(filename)
-                parent = dependent
-        return graph
+        return _dependency_graph(self._changes_by_filename())
 
     def patch_dependency_dot_graph(self):
         """Return a DOT version of the dependency graph."""
         lines = ['digraph patchdeps {']
 
-        for (dependent, parent), changed_files in\
-                self.patch_dependencies().iteritems():
+        with self.lock(exclusive=False):
+            dependencies = self.patch_dependencies()
+
+        for (dependent, parent), changed_files in dependencies.iteritems():
             label = ', '.join(sorted(changed_files))
             lines.append('"%s" -> "%s" [label="%s"];' % (
                 dependent, parent, label))
 
         lines.append('}')
         return '\n'.join(lines)
+
+
+class PatchRepoRevision(object):
+    """A read-only view of a patch-repo at a given revision.
+
+    The series file, including `-i` child series, and the patches are read
+    straight from git objects through a single `cat-file --batch` pipe, so
+    nothing needs to be checked out. Any number of restores can therefore
+    read different revisions of the same patch-repo, even a bare one, at
+    once.
+    """
+
+    def __init__(self, patch_repo, rev):
+        self.patch_repo = patch_repo
+        self.commit_hash = patch_repo.rev_parse('%s^{commit}' % rev)
+        self._cat_file = None
+
+    def _read(self, path):
+        if self._cat_file is None:
+            self._cat_file = self.patch_repo.cat_file_batch()
+
+        result = self._cat_file.read('%s:%s' % (self.commit_hash,
+                                                posixpath.normpath(path)))
+        if not result or result[1] != 'blob':
+            raise exc.PathNotFound(path)
+
+        return result[2]
+
+    def _recursive_series(self, series_rel_path):
+        """Emit patch_names from series file, handling -i recursion."""
+        contents = self._read(series_rel_path)
+        for patch_name in _parse_series(contents.split('\n')):
+            if not patch_name.startswith('-i '):
+                yield patch_name
+                continue
+
+            child_series_rel_path = patch_name.split(' ', 1)[1].strip()
+            patch_dir = os.path.dirname(child_series_rel_path)
+            for child_patch_name in self._recursive_series(
+                    child_series_rel_path):
+                yield os.path.join(patch_dir, child_patch_name)
+
+    @property
+    def series(self):
+        return list(self._recursive_series('series'))
+
+    def read_patch(self, patch_name):
+        return self._read(patch_name)
+
+    def _changed_files_for_patch(self, patch_name):
+        return _changed_files(self.read_patch(patch_name).split('\n'))
+
+    def patch_dependencies(self):
+        """Return the file-dependency graph of the series at this revision;
+        see `PatchRepo.patch_dependencies`.
+        """
+        return _dependency_graph(
+            _file_changes(self.series, self._changed_files_for_patch))
+
+    def patch_blobs(self, patch_names):
+        """Return a dict mapping each of `patch_names` that exists at this
+        revision to its blob hash.
+        """
+        blobs = dict((path, object_hash) for _, object_type, object_hash, path
+                     in self.patch_repo.ls_tree(self.commit_hash,
+                                                recursive=True)
+                     if object_type == 'blob')
+        return dict((patch_name, blobs[posixpath.normpath(patch_name)])
+                    for patch_name in patch_names
+                    if posixpath.normpath(patch_name) in blobs)
+
+    @contextlib.contextmanager
+    def patch_path(self, patch_name):
+        """Yield the path to a temporary copy of a patch, for the commands
+        that want a file.
+        """
+        def read_blob(blob_hash):
+            return self._read(blobs.blob_name(blob_hash))
+
+        with tempfile.NamedTemporaryFile(suffix='.patch') as f:
+            f.writelines(blobs.inflate(
+                self.read_patch(patch_name).splitlines(True), read_blob))
+            f.flush()
+            yield f.name
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.close()
+            self._cat_file = None
+
+
+def _range_diff_worker(args):
+    """Return the meaningful hunks between two versions of a patch."""
+    old_patch, new_patch = args
+    return utils.meaningful_hunks(old_patch, new_patch)
+
+
+def _create_patches_worker(args):
+    """Format and normalize one chunk of a parallel save.
+
+    This runs in a pool process, so it takes and returns plain data: a list
+    of (patch_name, data) tuples.
+    """
+    path, revision_range, first_number, blob_staging = args
+
+    working_repo = WorkingRepo(path, quiet=True, supress_warnings=True)
+
+    results = []
+    for patch_name, patch_file in working_repo._normalize_patches(
+            revision_range, first_number=first_number,
+            blob_staging=blob_staging):
+        patch_file.seek(0)
+        results.append((patch_name, patch_file.read()))
+        patch_file.close()
+
+    return results
@@ -0,0 +1,134 @@
+"""
+Binary patches make up most of the size of a patch-repo that carries them,
+and every save, graph and comparison has to wade through their base85. With
+the `ply.binaryblobs` git config set, `ply save` moves the payload of each
+`GIT binary patch` section into a content-addressed store in the patch-repo,
+`blobs/<sha1>`, leaving a one-line reference in its place:
+
+    GIT binary patch
+    ply-blob 0f1e8a9c3a4d1b8b1b2c1f3bd2c9fd7ac2f4a9e1
+
+An unchanged binary is always given the same reference, so re-saving and
+comparing it costs nothing and its blob is only written once. Patches are
+inflated back before they're applied.
+
+Payloads are first stored in a scratch directory laid out the same way and
+only copied into the patch-repo along with the patches referring to them,
+while the patch-repo is locked.
+"""
+import errno
+import hashlib
+import os
+import re
+
+from plypatch import utils
+
+
+BLOBS_DIR = 'blobs'
+
+BINARY_PATCH = 'GIT binary patch'
+REFERENCE_PREFIX = 'ply-blob '
+RE_REFERENCE = re.compile('^ply-blob ([0-9a-f]{40})$')
+
+
+def blob_name(blob_hash):
+    """Return the path of a blob relative to its store."""
+    return '%s/%s' % (BLOBS_DIR, blob_hash)
+
+
+def put(store_path, payload):
+    """Store `payload` in the blob store under `store_path`, unless it's
+    already there, and return its hash.
+    """
+    blob_hash = hashlib.sha1(payload).hexdigest()
+    path = os.path.join(store_path, blob_name(blob_hash))
+    if os.path.exists(path):
+        return blob_hash
+
+    try:
+        os.mkdir(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    with utils.atomic_write(path) as f:
+        f.write(payload)
+
+    return blob_hash
+
+
+def references(lines):
+    """Return the hashes of the blobs the patch in `lines` refers to."""
+    blob_hashes = []
+    for line in lines:
+        if line.startswith(REFERENCE_PREFIX):
+            matches = RE_REFERENCE.match(line.rstrip('\n'))
+            if matches:
+                blob_hashes.append(matches.group(1))
+    return blob_hashes
+
+
+def inflate(lines, read_blob):
+    """Yield the lines of a patch with each blob reference replaced by the
+    payload it stands for, as returned by `read_blob(blob_hash)`.
+    """
+    binary = False
+    for line in lines:
+        if binary:
+            binary = False
+            matches = RE_REFERENCE.match(line.rstrip('\n'))
+            if matches:
+                yield read_blob(matches.group(1))
+                continue
+
+        binary = line.rstrip('\n') == BINARY_PATCH
+        yield line
+
+
+class Deflater(object):
+    """File-like object that writes a patch to `output` with its binary
+    payloads moved into the blob store under `store_path`.
+
+    A payload runs from the line after `GIT binary patch` up to the next
+    `diff --git` line or the signature, so that inflating the reference
+    gives back exactly the original text. `close` must be called once the
+    whole patch has been written.
+    """
+
+    def __init__(self, output, store_path):
+        self.output = output
+        self.store_path = store_path
+        self._partial = ''
+        self._payload = None
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._write_line('%s\n' % line)
+
+    def close(self):
+        if self._partial:
+            self._write_line(self._partial)
+            self._partial = ''
+        self._end_payload()
+
+    def _write_line(self, line):
+        if self._payload is not None:
+            if not (line.startswith('diff --git ') or line == '-- \n'):
+                self._payload.append(line)
+                return
+            self._end_payload()
+
+        self.output.write(line)
+
+        if line == '%s\n' % BINARY_PATCH:
+            self._payload = []
+
+    def _end_payload(self):
+        if self._payload is None:
+            return
+
+        payload, self._payload = ''.join(self._payload), None
+        blob_hash = put(self.store_path, payload)
+        self.output.write('%s%s\n' % (REFERENCE_PREFIX, blob_hash))
@@ -5,7 +5,11 @@ import argparse
 import sys
 
 import plypatch
+from plypatch import daemon
 from plypatch import git
+from plypatch import jobs
+from plypatch import metrics
+from plypatch import watch
 
 
 def die(msg):
@@ -17,7 +21,7 @@ def exit(msg, code=0):
     sys.exit(code)
 
 
-def die_on_conflicts(threeway_merged=True):
+def die_on_conflicts(threeway_merged=True, deferred=None):
     print "Patch did not apply cleanly.",
     if threeway_merged:
         print "Threeway-merge was completed but resulted in conflicts. To fix:"
@@ -32,9 +36,32 @@ def die_on_conflicts(threeway_merged=True):
     print "\n\t2) `git add` affected files"
     print "\n\t3) Run `ply resolve` to refresh the patch and"\
           " apply the rest\n\t   of the patches in the series."
+    if deferred:
+        print "\nDeferred patches, in the order they'll be applied:\n"
+        for patch_name in deferred:
+            print "\t%s" % patch_name
     sys.exit(1)
 
 
+def run_job(args, working_repo, operation, **kwargs):
+    """Run a restore, resolve or skip as a job, reporting its progress as
+    asked for with `--progress`.
+    """
+    job = jobs.Job(working_repo, operation, **kwargs)
+    reporter = jobs.PROGRESS_REPORTERS.get(args.progress)
+    if reporter:
+        job.subscribe(reporter(sys.stdout))
+
+    result = job.run()
+    if result.status == 'conflict':
+        if args.progress == 'jsonl':
+            sys.exit(1)
+        die_on_conflicts(threeway_merged=result.three_way_merged,
+                         deferred=result.deferred)
+    elif result.status == 'cancelled':
+        die('Cancelled, run `ply restore --resume` to carry on')
+
+
 def die_on_uncommitted_changes():
     die('Uncommitted changes, commit or discard before continuing.')
 
@@ -75,6 +102,36 @@ class AbortCommand(CLICommand):
             exit('Nothing to abort')
 
 
+class BisectUpstreamCommand(CLICommand):
+    __command__ = 'bisect-upstream'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('good', action='store',
+                               help='Upstream ref the series applies to')
+        subparser.add_argument('bad', action='store',
+                               help='Upstream ref the series breaks on')
+
+    def do(self, args):
+        """Find the upstream commits that caused patches to stop applying"""
+        try:
+            culprits = self.working_repo.bisect_upstream(args.good, args.bad)
+        except plypatch.exc.NoLinkedPatchRepo:
+            die('Not linked to a patch-repo')
+        except plypatch.git.exc.GitException:
+            die('Unable to resolve upstream range %s..%s'
+                % (args.good, args.bad))
+
+        if not culprits:
+            exit('No patches broken between %s and %s'
+                 % (args.good, args.bad))
+
+        for commit_hash, patch_names in culprits:
+            print self.working_repo.log(cmd_arg=commit_hash, count=1,
+                                        pretty='%h %s').strip()
+            for patch_name in patch_names:
+                print '\t- %s' % patch_name
+
+
 class CheckCommand(CLICommand):
     __command__ = 'check'
 
@@ -101,6 +158,86 @@ class CheckCommand(CLICommand):
                 print '\t- %s' % patch_name
 
 
+class DaemonCommand(CLICommand):
+    __command__ = 'daemon'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('--idle-timeout', type=float, default=None,
+                               metavar='SECONDS',
+                               help='Exit after SECONDS without a request')
+
+    def do(self, args):
+        """Serve status, check and graph from a long-running process"""
+        server = daemon.Daemon(self.working_repo.path, build_parser,
+                               idle_timeout=args.idle_timeout)
+        try:
+            server.serve_forever()
+        except plypatch.exc.DaemonAlreadyRunning:
+            die('A ply daemon is already running for this repo')
+
+
+class ExportCommand(CLICommand):
+    __command__ = 'export'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('--format', choices=plypatch.EXPORT_FORMATS,
+                               default='tar', help='Output format')
+        subparser.add_argument('--base', metavar='REF',
+                               help='Upstream ref to apply the series to')
+        subparser.add_argument('-o', '--output', metavar='PATH',
+                               help='Write to PATH instead of stdout')
+
+    def do(self, args):
+        """Export the patched tree without checking it out"""
+        if args.format == 'dir' and not args.output:
+            die("--format=dir requires --output")
+
+        # Make sure nothing we've printed ends up after the archive
+        sys.stdout.flush()
+
+        try:
+            self.working_repo.export(format=args.format, base=args.base,
+                                     output=args.output, stdout=sys.stdout)
+        except plypatch.exc.NoLinkedPatchRepo:
+            die('Not linked to a patch-repo')
+        except plypatch.exc.PatchesDidNotApply as e:
+            print >> sys.stderr, 'Patches did not apply cleanly:'
+            for patch_name in e.patch_names:
+                print >> sys.stderr, '\t- %s' % patch_name
+            sys.exit(1)
+
+
+class ExportPatchCommand(CLICommand):
+    __command__ = 'export-patch'
+
+    def add_arguments(self, subparser):
+        group = subparser.add_mutually_exclusive_group(required=True)
+        group.add_argument('--combined', dest='format', action='store_const',
+                           const='combined',
+                           help='Single diff of the whole series against'
+                                ' its Ply-Based-On commit')
+        group.add_argument('--mbox', dest='format', action='store_const',
+                           const='mbox',
+                           help='All patches in series order in one mbox')
+        subparser.add_argument('-o', '--output', metavar='PATH',
+                               help='Write to PATH instead of stdout')
+
+    def do(self, args):
+        """Export the patch series as a combined diff or mbox bundle"""
+        try:
+            self.working_repo.export_patch(args.format, output=args.output,
+                                           stdout=sys.stdout)
+        except plypatch.exc.NoLinkedPatchRepo:
+            die('Not linked to a patch-repo')
+        except plypatch.exc.NoBasedOnAnnotation:
+            die('Patch-repo has no Ply-Based-On annotation, restore first')
+        except plypatch.exc.PatchesDidNotApply as e:
+            print >> sys.stderr, 'Patches did not apply cleanly:'
+            for patch_name in e.patch_names:
+                print >> sys.stderr, '\t- %s' % patch_name
+            sys.exit(1)
+
+
 class GraphCommand(CLICommand):
     __command__ = 'graph'
 
@@ -139,6 +276,96 @@ class LinkCommand(CLICommand):
                 % e.patch_repo_path)
 
 
+class MetricsCommand(CLICommand):
+    __command__ = 'metrics'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('--prometheus', metavar='PATH',
+                               help='Write the aggregates to PATH in'
+                                    ' node-exporter textfile format')
+        subparser.add_argument('--summary', action='store_true',
+                               help='Print wall time percentiles per'
+                                    ' command (default)')
+
+    def do(self, args):
+        """Report what ply commands have cost over time"""
+        records = metrics.read(
+            self.working_repo._state_path(metrics.METRICS_NAME))
+
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus, records)
+            if not args.summary:
+                return
+
+        if not records:
+            exit('No metrics recorded yet')
+
+        print '%-20s %6s %8s %8s %8s %6s %6s' % (
+            'command', 'runs', 'p50', 'p90', 'p99', 'git', 'failed')
+        for row in metrics.summary(records):
+            print '%-20s %6d %7.2fs %7.2fs %7.2fs %6d %6d' % (
+                row['command'], row['runs'], row['p50'], row['p90'],
+                row['p99'], row['git_commands'], row['failures'])
+
+
+class MigrateAnnotationsCommand(CLICommand):
+    __command__ = 'migrate-annotations'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('backend', action='store',
+                               choices=plypatch.ANNOTATION_BACKENDS,
+                               help='Where to keep patch-annotations')
+
+    def do(self, args):
+        """Move patch-annotations to commit messages or git notes"""
+        try:
+            migrated = self.working_repo.migrate_annotations(args.backend)
+        except plypatch.exc.RestoreInProgress:
+            die_on_restore_in_progress()
+        except plypatch.exc.CannotRewriteCommits:
+            die('Applied patches include merges or re-encoded commits, cannot'
+                ' migrate annotations')
+
+        print 'Migrated %d patch-annotations to %s' % (migrated, args.backend)
+
+
+class RangeDiffCommand(CLICommand):
+    __command__ = 'range-diff'
+
+    def add_arguments(self, subparser):
+        subparser.add_argument('rev1', help='Older patch-repo revision')
+        subparser.add_argument('rev2', help='Newer patch-repo revision')
+        subparser.add_argument('-j', '--jobs', type=int, default=1,
+                               help='Number of processes used to compare'
+                                    ' patches')
+
+    def do(self, args):
+        """Show the meaningful changes to the series between two patch-repo
+        revisions"""
+        if args.jobs < 1:
+            die('--jobs must be at least 1')
+
+        patch_repo = self.working_repo.patch_repo
+        try:
+            diff = patch_repo.range_diff(args.rev1, args.rev2,
+                                         jobs=args.jobs)
+        except plypatch.exc.PathNotFound as e:
+            die("'%s' not found in the patch-repo" % e)
+        except plypatch.git.exc.GitException:
+            die("Unknown patch-repo revision '%s' or '%s'"
+                % (args.rev1, args.rev2))
+
+        for status, patch_name, detail in diff:
+            if status == 'renamed':
+                print 'renamed: %s -> %s' % (detail, patch_name)
+            else:
+                print '%s: %s' % (status, patch_name)
+
+            if status == 'changed':
+                for hunk in detail:
+                    sys.stdout.write(''.join(hunk))
+
+
 class ResolveCommand(CLICommand):
     __command__ = 'resolve'
 
@@ -147,13 +374,9 @@ class ResolveCommand(CLICommand):
         rest of the patches in the series
         """
         try:
-            self.working_repo.resolve()
+            run_job(args, self.working_repo, 'resolve')
         except plypatch.exc.NothingToResolve:
             die('Nothing to resolve')
-        except plypatch.git.exc.PatchBlobSHA1Invalid:
-            die_on_conflicts(threeway_merged=False)
-        except plypatch.git.exc.PatchDidNotApplyCleanly:
-            die_on_conflicts(threeway_merged=True)
 
 
 class RestoreCommand(CLICommand):
@@ -162,31 +385,110 @@ class RestoreCommand(CLICommand):
     def add_arguments(self, subparser):
         subparser.add_argument('-m', '--message', action='store_true',
                                help='Prompt for a custom commit message')
+        subparser.add_argument('--worktree', metavar='PATH',
+                               help='Restore into a dedicated git worktree,'
+                                    ' creating it if necessary')
+        subparser.add_argument('--base', metavar='REF',
+                               help='Upstream ref to base the worktree on')
+        subparser.add_argument('--patch-rev', metavar='REV',
+                               help='Restore the series as of this'
+                                    ' patch-repo revision, read from git'
+                                    ' objects without a checkout')
+        subparser.add_argument('--delta', action='store_true',
+                               help='Keep applied patches up to the first'
+                                    ' one that changed in the series and'
+                                    ' reapply only from there')
+        subparser.add_argument('--keep-going', action='store_true',
+                               help='Set conflicting patches and their'
+                                    ' dependents aside and apply the rest'
+                                    ' of the series first')
+        subparser.add_argument('--resume', action='store_true',
+                               help='Carry on with a restore that was'
+                                    ' interrupted, without fetching')
+        partial = subparser.add_mutually_exclusive_group()
+        partial.add_argument('--upto', metavar='PATCH',
+                             help='Only apply the series up to and'
+                                  ' including PATCH')
+        partial.add_argument('--only', metavar='PATCH', nargs='+',
+                             help='Only apply these patches, or the patches'
+                                  ' under these directories, along with the'
+                                  ' patches they depend on')
+        subparser.add_argument('--sparse', action='store_true',
+                               help='Only check out the directories of the'
+                                    ' files the series touches')
+        subparser.add_argument('--sparse-path', metavar='DIR',
+                               dest='sparse_paths', action='append',
+                               default=[],
+                               help='Also check out DIR with --sparse; may'
+                                    ' be repeated')
 
     def do(self, args):
         """Apply the patch series to the the current branch of the
         working-repo"""
+        if args.base and not args.worktree:
+            die('--base requires --worktree')
+
+        if args.keep_going and args.patch_rev:
+            die('--keep-going can not be used with --patch-rev')
+
+        if args.sparse_paths and not args.sparse:
+            die('--sparse-path requires --sparse')
+
+        if args.resume and (args.patch_rev or args.message or args.delta or
+                            args.keep_going or args.sparse or args.upto or
+                            args.only):
+            die('--resume continues with the options the restore was'
+                ' started with')
+
         try:
-            self.working_repo.restore(customize_commit_msg=args.message)
+            working_repo = self.working_repo
+            if args.worktree:
+                working_repo = working_repo.worktree(args.worktree,
+                                                     base=args.base)
+            run_job(args, working_repo, 'restore',
+                    customize_commit_msg=args.message,
+                    patch_rev=args.patch_rev, resume=args.resume,
+                    delta=args.delta, keep_going=args.keep_going,
+                    sparse=args.sparse, sparse_paths=args.sparse_paths,
+                    upto=args.upto, only=args.only)
+        except plypatch.exc.FetchConfigInvalid as e:
+            die(str(e))
+        except plypatch.exc.CannotResume:
+            die('HEAD has moved since the restore was interrupted, roll back'
+                ' and restore again')
         except plypatch.exc.GitConfigRequired as e:
             die("Required git config '%s' is unset." % e)
+        except plypatch.exc.NotAWorktree as e:
+            die("'%s' is not a worktree of this repo" % e)
+        except plypatch.exc.NothingToResume:
+            die('No interrupted restore to resume')
+        except plypatch.exc.PatchNotInSeries as e:
+            die("No patch '%s' in the series" % e)
+        except plypatch.exc.PathNotFound as e:
+            die("'%s' not found at patch-repo revision %s"
+                % (e, args.patch_rev))
         except plypatch.exc.RestoreInProgress:
             die_on_restore_in_progress()
         except plypatch.exc.UncommittedChanges:
             die_on_uncommitted_changes()
-        except plypatch.git.exc.PatchBlobSHA1Invalid:
-            die_on_conflicts(threeway_merged=False)
-        except plypatch.git.exc.PatchDidNotApplyCleanly:
-            die_on_conflicts(threeway_merged=True)
+        except plypatch.git.exc.GitException:
+            if not args.patch_rev:
+                raise
+            die("Unknown patch-repo revision '%s'" % args.patch_rev)
 
 
 class RollbackCommand(CLICommand):
     __command__ = 'rollback'
 
+    def add_arguments(self, subparser):
+        subparser.add_argument('--full', action='store_true',
+                               help='Switch a sparse checkout back to a'
+                                    ' full one')
+
     def do(self, args):
         """Rollback to the last upstream commit"""
         try:
-            self.working_repo.rollback()
+            self.working_repo.rollback(full=args.full)
         except plypatch.exc.UncommittedChanges:
             die_on_uncommitted_changes()
 
@@ -196,11 +498,17 @@ class SaveCommand(CLICommand):
 
     def add_arguments(self, subparser):
         subparser.add_argument('-s', '--since')
+        subparser.add_argument('-j', '--jobs', type=int, default=1,
+                               help='Number of processes used to format'
+                                    ' patches')
 
     def do(self, args):
         """Save set of commits to patch-repo"""
+        if args.jobs < 1:
+            die('--jobs must be at least 1')
+
         try:
-            self.working_repo.save(args.since)
+            self.working_repo.save(args.since, jobs=args.jobs)
         except plypatch.exc.NoPatchesApplied:
             die('No patches applied, so cannot detect new patches to save')
         except plypatch.exc.UncommittedChanges:
@@ -214,12 +522,7 @@ class SkipCommand(CLICommand):
         """Skips current patch and removes it from patch-repo then continues by
         applying rest of the patches in the series
         """
-        try:
-            self.working_repo.skip()
-        except plypatch.git.exc.PatchBlobSHA1Invalid:
-            die_on_conflicts(threeway_merged=False)
-        except plypatch.git.exc.PatchDidNotApplyCleanly:
-            die_on_conflicts(threeway_merged=True)
+        run_job(args, self.working_repo, 'skip')
 
 
 class StatusCommand(CLICommand):
@@ -233,6 +536,8 @@ class StatusCommand(CLICommand):
             die('Restore in progress, use skip or resolve to continue')
         elif status == 'no-patches-applied':
             die('No patches applied')
+        elif status == 'some-patches-applied':
+            die('Some patches applied, restore to apply the rest')
         else:
             die('All patches applied')
 
@@ -248,34 +553,148 @@ class UnlinkCommand(CLICommand):
             die('Not linked to a patch-repo')
 
 
-COMMANDS = [AbortCommand, CheckCommand, GraphCommand, InitCommand,
-            LinkCommand, ResolveCommand, RestoreCommand, RollbackCommand,
-            SaveCommand, SkipCommand, StatusCommand, UnlinkCommand]
+class WatchCommand(CLICommand):
+    __command__ = 'watch'
 
+    def add_arguments(self, subparser):
+        subparser.add_argument('ref', action='store', nargs='?',
+                               help='Upstream ref to watch, defaults to the'
+                                    ' ply.watch.ref git config')
+        subparser.add_argument('--remote',
+                               help='Remote to fetch before each poll,'
+                                    ' defaults to the ply.watch.remote git'
+                                    ' config, otherwise all remotes')
+        subparser.add_argument('--interval', type=float, default=300,
+                               metavar='SECONDS',
+                               help='Time between polls')
+        subparser.add_argument('--max-queue', type=int,
+                               default=watch.MAX_QUEUE, metavar='N',
+                               help='Batches to queue before merging the'
+                                    ' oldest')
+        subparser.add_argument('--log', metavar='PATH',
+                               help='JSON-lines results log, defaults to'
+                                    ' ply/watch.jsonl in the git dir')
+        subparser.add_argument('--once', action='store_true',
+                               help='Poll once and exit')
 
-def main():
+    def do(self, args):
+        """Simulate restoring the patch series whenever upstream moves"""
+        working_repo = self.working_repo
+
+        ref = args.ref or working_repo._get_config('ply.watch.ref')
+        if not ref:
+            die('No upstream ref given and ply.watch.ref is unset')
+
+        remote = args.remote or working_repo._get_config('ply.watch.remote')
+
+        if args.max_queue < 2:
+            die('--max-queue must be at least 2')
+
+        if not working_repo.patch_repo_path:
+            die('Not linked to a patch-repo')
+
+        watcher = watch.Watcher(working_repo, ref, remote=remote,
+                                interval=args.interval,
+                                max_queue=args.max_queue,
+                                log_path=args.log)
+
+        def report(entry):
+            revision = entry['revision'][:7]
+            if entry['conflicts']:
+                print '%s: %d patches conflict (%d new commits)' % (
+                    revision, len(entry['conflicts']), entry['commits'])
+                for patch_name in entry['conflicts']:
+                    print '\t- %s' % patch_name
+            else:
+                print '%s: clean (%d new commits)' % (revision,
+                                                      entry['commits'])
+            sys.stdout.flush()
+
+        watcher.run(once=args.once, callback=report)
+
+
+COMMANDS = [AbortCommand, BisectUpstreamCommand, CheckCommand, DaemonCommand,
+            ExportCommand, ExportPatchCommand, GraphCommand, InitCommand,
+            LinkCommand, MetricsCommand, MigrateAnnotationsCommand,
+            RangeDiffCommand, ResolveCommand, RestoreCommand,
+            RollbackCommand, SaveCommand, SkipCommand, StatusCommand,
+            UnlinkCommand, WatchCommand]
+
+
+def build_parser(working_repo):
     parser = argparse.ArgumentParser(prog='ply', description=__doc__)
     parser.add_argument('--no-fetch', dest='fetch_remotes',
                         action='store_false', default=True,
                         help="Avoid fetching remotes before restore")
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="show verbose output")
+    parser.add_argument('--git-log', metavar='PATH',
+                        help="append every git command run and its output"
+                             " to PATH")
+    parser.add_argument('--progress', choices=['text', 'jsonl', 'none'],
+                        default='text',
+                        help="how restore, resolve and skip report progress;"
+                             " jsonl writes one JSON event per line")
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + plypatch.__version__)
 
     subparsers = parser.add_subparsers(help='Sub-commands')
 
-    working_repo = plypatch.WorkingRepo('.')
-
     for cmd_class in COMMANDS:
         cmd = cmd_class(working_repo)
         subparser = cmd._add_subparser(subparsers)
-        subparser.set_defaults(func=cmd.do)
+        subparser.set_defaults(func=cmd.do, command=cmd.__command__)
+
+    return parser
+
+
+def main():
+    working_repo = plypatch.WorkingRepo('.')
+
+    def metrics_path():
+        return working_repo._state_path(metrics.METRICS_NAME)
+
+    # Read-only commands are answered by `ply daemon` when one is running,
+    # before we pay for building the parser
+    argv = sys.argv[1:]
+    if len(argv) == 1 and argv[0] in daemon.READ_ONLY_COMMANDS:
+        with metrics.recording(argv[0], metrics_path) as recorder:
+            result = daemon.request(argv)
+            if result is not None:
+                code, output = result
+                sys.stdout.write(output)
+                sys.exit(code)
+
+            # Recorded below, when we run the command ourselves
+            recorder.discard()
 
+    parser = build_parser(working_repo)
     args = parser.parse_args()
 
     working_repo.quiet = not args.verbose
     working_repo.fetch_remotes = args.fetch_remotes
 
-    # Dispatch to command handler (`do`)
-    args.func(args)
+    if args.git_log:
+        git.set_log(open(args.git_log, 'a'))
+
+    # The daemon lives for as long as it's left running, and the commands
+    # it serves are recorded by the plys that asked for them
+    if args.command in (DaemonCommand.__command__,
+                        MetricsCommand.__command__):
+        dispatch(args)
+        return
+
+    with metrics.recording(args.command, metrics_path):
+        dispatch(args)
+
+
+def dispatch(args):
+    """Dispatch to command handler (`do`)"""
+    try:
+        args.func(args)
+    except plypatch.exc.PatchRepoLocked as e:
+        die("Timed out waiting for another ply to release the lock on"
+            " patch-repo '%s'" % e)
+    except plypatch.exc.UnknownAnnotationBackend as e:
+        die("Unknown ply.annotations '%s', expected one of: %s" % (
+            e.backend, ', '.join(plypatch.ANNOTATION_BACKENDS)))
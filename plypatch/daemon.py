@@ -0,0 +1,307 @@
+"""
+`ply daemon` answers read-only commands from a long-running process.
+
+Commands like `ply status` are cheap in themselves but each invocation pays
+for Python startup, building the argument parser and a cold look at git
+state. The daemon keeps a `WorkingRepo` (and with it the patch-repo, series
+and annotations) and the output of each command it has run, and serves them
+over a Unix socket in the working-repo's git dir.
+
+Cached results are invalidated by comparing a fingerprint of the files that
+could change the answer -- HEAD and the ref it points to, packed-refs, the
+git config, ply's state directory and the patch-repo's files -- against the
+one taken when the result was computed. Stat'ing a few dozen files is far
+cheaper than spawning git and needs no platform-specific file notification
+API.
+
+Clients that can't reach a daemon simply run the command in-process.
+"""
+import errno
+import os
+import socket
+import sys
+import threading
+import cStringIO
+
+import plypatch
+from plypatch import exc
+
+
+READ_ONLY_COMMANDS = ('check', 'graph', 'status')
+
+SOCKET_NAME = 'daemon.sock'
+
+# How long a client waits on the daemon before running the command itself
+CLIENT_TIMEOUT = 10
+
+# How often the accept loop wakes up to check whether it should stop
+POLL_INTERVAL = 0.2
+
+# Status code a daemon uses to tell the client to run the command itself
+FALLBACK = -1
+
+
+def _find_git_dir(path):
+    """Find the git dir for `path` without running git.
+
+    Returns None if there's none, or if GIT_DIR is set, since then we can't
+    be sure we'd find the same one git would.
+    """
+    if 'GIT_DIR' in os.environ:
+        return None
+
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+
+        if os.path.isdir(dot_git):
+            return dot_git
+
+        if os.path.isfile(dot_git):
+            # Linked worktrees and submodules point at their git dir
+            with open(dot_git) as f:
+                contents = f.read().strip()
+            if not contents.startswith('gitdir: '):
+                return None
+            return os.path.join(path, contents[len('gitdir: '):])
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def socket_path(git_dir):
+    return os.path.join(git_dir, 'ply', SOCKET_NAME)
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+
+def request(argv, path='.'):
+    """Run a command through the daemon for the repo at `path`.
+
+    Returns a tuple of (exit_code, output), or None if there's no daemon to
+    ask or it couldn't answer, in which case the caller should run the
+    command itself.
+    """
+    git_dir = _find_git_dir(path)
+    if not git_dir:
+        return None
+
+    path = socket_path(git_dir)
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        sock.connect(path)
+        sock.sendall('%s\n' % '\0'.join(argv))
+        sock.shutdown(socket.SHUT_WR)
+        response = _recv_all(sock)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+    header, sep, output = response.partition('\n')
+    if not sep:
+        return None
+
+    code, length = map(int, header.split())
+    if code == FALLBACK or len(output) != length:
+        return None
+
+    return code, output
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _ref_path(git_dir, common_dir):
+    """Return the path of the loose ref HEAD points to, if any."""
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except IOError:
+        return None
+
+    if not head.startswith('ref: '):
+        return None
+
+    return os.path.join(common_dir, head[len('ref: '):])
+
+
+class Daemon(object):
+    """Serve read-only ply commands for one working-repo.
+
+    `build_parser` is called with a WorkingRepo and must return an argparse
+    parser whose parsed args carry the command to run in `func`, as the CLI
+    builds it.
+    """
+
+    def __init__(self, path, build_parser, idle_timeout=None):
+        self.path = path
+        self.build_parser = build_parser
+        self.idle_timeout = idle_timeout
+        self.stopped = False
+        self.listening = threading.Event()
+        self._results = {}
+        self._load()
+        self._fingerprint = self.fingerprint()
+
+    def _load(self):
+        """(Re)create the warm repo objects."""
+        self.working_repo = plypatch.WorkingRepo(self.path)
+        self.parser = self.build_parser(self.working_repo)
+        self.git_dir = self.working_repo.git_dir
+        self.common_dir = self.working_repo.git_common_dir
+        self.patch_repo_path = self.working_repo.patch_repo_path
+        self.socket_path = self.working_repo._state_path(SOCKET_NAME)
+
+    def _watched_paths(self):
+        git_dir = self.git_dir
+        common_dir = self.common_dir
+
+        paths = [os.path.join(git_dir, 'HEAD'),
+                 os.path.join(git_dir, 'rebase-apply'),
+                 os.path.join(git_dir, 'ply'),
+                 os.path.join(common_dir, 'config'),
+                 os.path.join(common_dir, 'packed-refs'),
+                 os.path.join(common_dir, plypatch.NOTES_REF),
+                 _ref_path(git_dir, common_dir)]
+
+        patch_repo_path = self.patch_repo_path
+        if patch_repo_path and os.path.isdir(patch_repo_path):
+            patch_git_dir = os.path.join(patch_repo_path, '.git')
+            paths.extend([os.path.join(patch_git_dir, 'HEAD'),
+                          os.path.join(patch_git_dir, 'packed-refs'),
+                          _ref_path(patch_git_dir, patch_git_dir)])
+
+            for root, dirnames, filenames in os.walk(patch_repo_path):
+                if '.git' in dirnames:
+                    dirnames.remove('.git')
+                paths.append(root)
+                paths.extend(os.path.join(root, filename)
+                             for filename in filenames)
+
+        return [path for path in paths if path]
+
+    def fingerprint(self):
+        """Return a value that changes whenever a command's output might."""
+        return tuple((path, _stat(path)) for path in self._watched_paths())
+
+    def run(self, argv):
+        """Return (exit_code, output) for a read-only command, from the cache
+        if nothing it depends on has changed.
+        """
+        if not argv or argv[0] not in READ_ONLY_COMMANDS:
+            return FALLBACK, ''
+
+        # If anything changed, start over with fresh repo objects since their
+        # cached properties may be stale too
+        fingerprint = self.fingerprint()
+        if fingerprint != self._fingerprint:
+            self._load()
+            self._results.clear()
+            fingerprint = self._fingerprint = self.fingerprint()
+
+        key = tuple(argv)
+        if key not in self._results:
+            result = self._run_command(argv)
+            if result[0] == FALLBACK:
+                return result
+            self._results[key] = result
+
+        return self._results[key]
+
+    def _run_command(self, argv):
+        output = cStringIO.StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = output
+        try:
+            try:
+                args = self.parser.parse_args(argv)
+                args.func(args)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            return FALLBACK, ''
+        finally:
+            sys.stdout = orig_stdout
+
+        return code, output.getvalue()
+
+    def _handle(self, conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            argv = _recv_all(conn).rstrip('\n').split('\0')
+            code, output = self.run(argv)
+            conn.sendall('%d %d\n%s' % (code, len(output), output))
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def _bind(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                # Left behind by a daemon that didn't shut down cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise exc.DaemonAlreadyRunning
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(16)
+        sock.settimeout(POLL_INTERVAL)
+        self.listening.set()
+        return sock
+
+    def serve_forever(self):
+        """Answer requests until `stop` is called, the idle timeout passes or
+        we're interrupted.
+        """
+        sock = self._bind()
+        idle = 0.0
+        try:
+            while not self.stopped:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    idle += POLL_INTERVAL
+                    if self.idle_timeout and idle >= self.idle_timeout:
+                        break
+                    continue
+
+                idle = 0.0
+                self._handle(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self):
+        self.stopped = True
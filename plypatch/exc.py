@@ -16,6 +16,30 @@ class AlreadyLinkedToDifferentPatchRepo(AlreadyLinkedToPatchRepo):
     pass
 
 
+class Cancelled(PlyException):
+    pass
+
+
+class CannotResume(PlyException):
+    pass
+
+
+class CannotRewriteCommits(PlyException):
+    pass
+
+
+class DaemonAlreadyRunning(PlyException):
+    pass
+
+
+class FetchConfigInvalid(PlyException):
+    pass
+
+
+class NoBasedOnAnnotation(PlyException):
+    pass
+
+
 class NoLinkedPatchRepo(PlyException):
     pass
 
@@ -28,6 +52,28 @@ class NothingToResolve(PlyException):
     pass
 
 
+class NothingToResume(PlyException):
+    pass
+
+
+class NotAWorktree(PlyException):
+    pass
+
+
+class PatchesDidNotApply(PlyException):
+    def __init__(self, patch_names=None):
+        super(PatchesDidNotApply, self).__init__()
+        self.patch_names = patch_names or []
+
+
+class PatchNotInSeries(PlyException):
+    pass
+
+
+class PatchRepoLocked(PlyException):
+    pass
+
+
 class PathNotFound(PlyException):
     pass
 
@@ -36,6 +82,12 @@ class UncommittedChanges(PlyException):
     pass
 
 
+class UnknownAnnotationBackend(PlyException):
+    def __init__(self, backend=None):
+        super(UnknownAnnotationBackend, self).__init__()
+        self.backend = backend
+
+
 class RestoreInProgress(PlyException):
     pass
 
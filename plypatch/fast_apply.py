@@ -0,0 +1,678 @@
+"""
+In-process fast path for applying patches during a restore.
+
+Most patches in a series apply with exact context, yet each one would still
+cost a `git am` (which re-reads the index and rewrites the worktree) plus a
+`git commit --amend` to add the patch-annotation. For the simple cases we
+instead parse and apply the patch ourselves, stream the resulting blobs,
+trees and commits through a single `git fast-import`, and only update the
+index and worktree once, with a two-tree `git read-tree`, when we're done.
+
+The commits must be identical to the ones `git am` followed by `git commit
+--amend` would have produced, so anything we can't reproduce exactly --
+fuzz or offsets, binary content, renames, mode changes, encoded headers,
+hooks, and so on -- raises `Unsupported` and is handed to `git am --3way`
+as before.
+"""
+import email.utils
+import hashlib
+import os
+import posixpath
+import re
+import subprocess
+import time
+
+from plypatch import utils
+
+
+FAST_APPLY_REF = 'refs/ply/fast-apply'
+
+# Flush pending commits once we're holding this many bytes of file contents
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# Hooks `git am` and `git commit --amend` would run that we'd be skipping
+HOOKS = ('applypatch-msg', 'pre-applypatch', 'post-applypatch', 'pre-commit',
+         'prepare-commit-msg', 'commit-msg', 'post-commit', 'post-rewrite')
+
+RE_FROM = re.compile(r'^([^<>@"()]+) <([^<>\s]+@[^<>\s]+)>$')
+RE_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+RE_INBODY_HEADER = re.compile(r'^(from|subject|date)\s*:', re.IGNORECASE)
+
+# Characters git strips from the ends of names and emails in an ident
+IDENT_CRUD = '.,:;<>"\\\''
+
+# What git considers whitespace
+GIT_SPACE = ' \t\n\r'
+
+
+class Unsupported(Exception):
+    """The patch needs to go through `git am`."""
+    pass
+
+
+class FilePatch(object):
+    """The changes a patch makes to a single file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.status = 'M'   # 'A'dded, 'D'eleted or 'M'odified
+        self.mode = None
+        self.old_abbrev = None
+        self.new_abbrev = None
+        self.hunks = []
+
+
+class Hunk(object):
+    def __init__(self, old_start, new_start):
+        self.old_start = old_start
+        self.new_start = new_start
+        self.preimage = []
+        self.postimage = []
+        self.trailing = 0
+
+
+def blob_hash(contents):
+    """Return the hash git would give a blob with `contents`."""
+    return hashlib.sha1('blob %d\0%s' % (len(contents), contents)).hexdigest()
+
+
+def _is_crud(c):
+    return c <= ' ' or c in IDENT_CRUD
+
+
+def _format_tz(offset):
+    sign = '-' if offset < 0 else '+'
+    hours, minutes = divmod(abs(offset) // 60, 60)
+    return '%s%02d%02d' % (sign, hours, minutes)
+
+
+def _patchbreak(line):
+    """Whether `line` ends the commit message, as `git mailinfo` sees it."""
+    if line.startswith('diff -') or line.startswith('Index: '):
+        return True
+
+    if line.startswith('---'):
+        rest = line[3:]
+        if rest[:1] == ' ' and rest[1:2] and rest[1] not in GIT_SPACE:
+            return True
+        if not rest.strip(GIT_SPACE):
+            return True
+
+    return False
+
+
+def parse_mail(text):
+    """Parse an mbox formatted patch the way `git am` would.
+
+    Returns a tuple of (author_name, author_email, author_date, message,
+    patch_lines) where `author_date` is in git's raw '<timestamp> <tz>'
+    format and `message` is the commit message `git am` would record.
+    """
+    if '\r' in text:
+        # `git am` strips carriage returns, we don't
+        raise Unsupported('carriage return')
+
+    lines = text.split('\n')
+    if any(line.startswith('From ') for line in lines[1:]):
+        raise Unsupported('possible mbox separator')
+
+    idx = 1 if lines[0].startswith('From ') else 0
+
+    headers = {}
+    while True:
+        if idx >= len(lines):
+            raise Unsupported('no message body')
+
+        line = lines[idx]
+        idx += 1
+
+        if not line:
+            break
+
+        if line[0] in ' \t':
+            raise Unsupported('folded header')
+
+        if '=?' in line or any(ord(c) > 127 for c in line):
+            raise Unsupported('encoded header')
+
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise Unsupported('malformed header')
+
+        headers[name.strip().lower()] = value.strip()
+
+    content_type = headers.get('content-type', 'text/plain').lower()
+    if not content_type.startswith('text/plain'):
+        raise Unsupported('content-type')
+
+    if 'charset' in content_type and 'charset=utf-8' not in content_type \
+            and 'charset=us-ascii' not in content_type:
+        raise Unsupported('charset')
+
+    encoding = headers.get('content-transfer-encoding', '8bit').lower()
+    if encoding not in ('7bit', '8bit'):
+        raise Unsupported('content-transfer-encoding')
+
+    # Author
+    matches = RE_FROM.match(headers.get('from', ''))
+    if not matches:
+        raise Unsupported('from')
+
+    author_name, author_email = matches.groups()
+    if len(author_name) > 60 or '  ' in author_name or \
+            _is_crud(author_name[0]) or _is_crud(author_name[-1]) or \
+            _is_crud(author_email[0]) or _is_crud(author_email[-1]):
+        raise Unsupported('from')
+
+    parsed = email.utils.parsedate_tz(headers.get('date', ''))
+    if not parsed or parsed[9] is None:
+        raise Unsupported('date')
+
+    author_date = '%d %s' % (email.utils.mktime_tz(parsed),
+                             _format_tz(parsed[9]))
+
+    # `git am` cleans up the subject by removing leading brackets and Re:'s
+    # as well as surrounding whitespace; only accept subjects it would leave
+    # untouched
+    subject = headers.get('subject', '')
+    if not subject or subject[0] in '[:' or subject[:3].lower() == 're:':
+        raise Unsupported('subject')
+
+    # Message body
+    while idx < len(lines) and not lines[idx]:
+        idx += 1
+
+    if idx < len(lines):
+        first = lines[idx]
+        if RE_INBODY_HEADER.match(first) or first.startswith('>From') or \
+                first.startswith('[PATCH]'):
+            raise Unsupported('in-body header')
+
+    body = []
+    while idx < len(lines) and not _patchbreak(lines[idx]):
+        body.append('%s\n' % lines[idx])
+        idx += 1
+
+    if idx >= len(lines):
+        raise Unsupported('empty patch')
+
+    try:
+        ''.join(body).decode('utf-8')
+    except UnicodeDecodeError:
+        raise Unsupported('body encoding')
+
+    message = utils.stripspace('%s\n\n%s' % (subject, ''.join(body)))
+    return author_name, author_email, author_date, message, lines[idx:]
+
+
+def _parse_diff_header(line):
+    rest = line[len('diff --git '):]
+    path_len = (len(rest) - 5) // 2
+    path = rest[2:2 + path_len]
+    if not path or rest != 'a/%s b/%s' % (path, path) or \
+            any(c in GIT_SPACE or c == '"' for c in path):
+        raise Unsupported('diff header: %s' % line)
+    return FilePatch(path)
+
+
+def _parse_hunk(lines, idx):
+    """Parse the hunk starting at `lines[idx]`.
+
+    Returns the hunk and the index of the line following it.
+    """
+    matches = RE_HUNK_HEADER.match(lines[idx])
+    if not matches:
+        raise Unsupported('hunk header: %s' % lines[idx])
+
+    old_start, old_count, new_start, new_count = matches.groups()
+    old_remaining = 1 if old_count is None else int(old_count)
+    new_remaining = 1 if new_count is None else int(new_count)
+
+    hunk = Hunk(int(old_start), int(new_start))
+    idx += 1
+
+    while old_remaining > 0 or new_remaining > 0:
+        if idx >= len(lines) or not lines[idx]:
+            raise Unsupported('truncated hunk')
+
+        tag, text = lines[idx][0], '%s\n' % lines[idx][1:]
+        idx += 1
+
+        if tag == ' ':
+            hunk.preimage.append(text)
+            hunk.postimage.append(text)
+            old_remaining -= 1
+            new_remaining -= 1
+            hunk.trailing += 1
+        elif tag == '-':
+            hunk.preimage.append(text)
+            old_remaining -= 1
+            hunk.trailing = 0
+        elif tag == '+':
+            hunk.postimage.append(text)
+            new_remaining -= 1
+            hunk.trailing = 0
+        else:
+            raise Unsupported('hunk line: %s' % lines[idx - 1])
+
+        if idx < len(lines) and lines[idx].startswith('\\'):
+            # '\ No newline at end of file'
+            idx += 1
+            if tag in ' -':
+                hunk.preimage[-1] = hunk.preimage[-1][:-1]
+            if tag in ' +':
+                hunk.postimage[-1] = hunk.postimage[-1][:-1]
+
+    if old_remaining < 0 or new_remaining < 0:
+        raise Unsupported('hunk line counts')
+
+    return hunk, idx
+
+
+def parse_diff(lines):
+    """Parse the `git diff` portion of a patch into a list of FilePatches."""
+    file_patches = []
+    current = None
+    in_header = False
+    in_hunks = False
+
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx]
+
+        if line.startswith('diff --git '):
+            current = _parse_diff_header(line)
+            file_patches.append(current)
+            in_header = True
+            in_hunks = False
+            idx += 1
+            continue
+
+        if line.startswith('@@') and (in_header or in_hunks):
+            hunk, idx = _parse_hunk(lines, idx)
+            current.hunks.append(hunk)
+            in_header = False
+            in_hunks = True
+            continue
+
+        if line.startswith('@@'):
+            raise Unsupported('hunk without header')
+
+        idx += 1
+        in_hunks = False
+
+        if not in_header:
+            # Anything between files, like the signature, is ignored
+            continue
+
+        if line.startswith('index '):
+            parts = line.split()
+            abbrevs = parts[1].split('..')
+            if len(abbrevs) != 2 or len(parts) > 3:
+                raise Unsupported(line)
+            current.old_abbrev, current.new_abbrev = abbrevs
+            if len(parts) == 3:
+                current.mode = parts[2]
+        elif line.startswith('new file mode '):
+            current.status = 'A'
+            current.mode = line.split()[-1]
+        elif line.startswith('deleted file mode '):
+            current.status = 'D'
+            current.mode = line.split()[-1]
+        elif line.startswith('--- '):
+            if line not in ('--- a/%s' % current.path, '--- /dev/null'):
+                raise Unsupported(line)
+        elif line.startswith('+++ '):
+            if line not in ('+++ b/%s' % current.path, '+++ /dev/null'):
+                raise Unsupported(line)
+        else:
+            # Renames, copies, mode changes, binary patches...
+            raise Unsupported(line)
+
+    paths = [fp.path for fp in file_patches]
+    if len(set(paths)) != len(paths):
+        raise Unsupported('path patched twice')
+
+    for file_patch in file_patches:
+        if not file_patch.hunks and file_patch.status == 'M':
+            raise Unsupported('no hunks')
+
+    return file_patches
+
+
+def _split_lines(contents):
+    lines = contents.split('\n')
+    image = ['%s\n' % line for line in lines[:-1]]
+    if lines[-1]:
+        image.append(lines[-1])
+    return image
+
+
+def apply_hunks(contents, hunks):
+    """Apply `hunks` to `contents` exactly where `git apply` would.
+
+    Only exact matches at the position given in the hunk header (or the
+    beginning or end of the file for hunks anchored there) are accepted;
+    anything needing an offset or fuzz raises Unsupported.
+    """
+    image = _split_lines(contents)
+
+    for hunk in hunks:
+        preimage = hunk.preimage
+
+        def matches_at(pos):
+            return (0 <= pos and pos + len(preimage) <= len(image) and
+                    image[pos:pos + len(preimage)] == preimage)
+
+        # See apply_one_fragment() in git's apply.c
+        match_beginning = hunk.old_start <= 1
+        match_end = not hunk.trailing
+
+        found = None
+        if match_beginning or match_end:
+            pos = 0 if match_beginning else len(image) - len(preimage)
+            if matches_at(pos) and \
+                    (not match_end or pos + len(preimage) == len(image)):
+                found = pos
+
+        if found is None:
+            pos = hunk.new_start - 1 if hunk.new_start else 0
+            if matches_at(pos):
+                found = pos
+
+        if found is None:
+            raise Unsupported('hunk does not match exactly')
+
+        image[found:found + len(preimage)] = hunk.postimage
+
+    return ''.join(image)
+
+
+class FastApplier(object):
+    """Applies patches to a repo's current branch without `git am`.
+
+    Commits are accumulated in a fast-import stream and only land on HEAD,
+    along with the matching index and worktree changes, when `flush` is
+    called. Callers must flush before running any other git command that
+    looks at HEAD, such as falling back to `git am`.
+
+    With `annotate` set, a Ply-Patch annotation is added to each commit
+    message. Either way, `applied` lists (commit_hash, patch_name) for every
+    patch that has been flushed.
+
+    If the pending commits can't be checked out, for instance because an
+    untracked file is in the way, they're dropped and `fallback` is called
+    with the path and name of each pending patch, in order, so they can be
+    applied the slow way, which knows how to report a conflict.
+    """
+
+    def __init__(self, repo, annotate=True, fallback=None):
+        self.repo = repo
+        self.annotate = annotate
+        self.fallback = fallback
+        self.applied = []
+        self._cat_file = None
+        self._fast_import = None
+        self._committer = None
+        self._reset()
+
+    def _reset(self):
+        self._base = None
+        self._trees = {}
+        self._changed = {}
+        self._changed_bytes = 0
+        self._pending = []
+
+    @classmethod
+    def supported(cls, repo):
+        """Return whether the fast path can be used with `repo`.
+
+        The fast path can't honor hooks or settings that would alter the
+        commits `git am` produces, so it's disabled when any are present. It
+        can also be turned off with the `ply.fastapply` git config.
+        """
+        fast_apply = repo._get_config('ply.fastapply')
+        if fast_apply is not None and not utils.config_true(fast_apply):
+            return False
+
+        whitespace = repo._get_config('apply.whitespace')
+        if whitespace not in (None, 'nowarn', 'warn'):
+            return False
+
+        for key in ('am.keepcr', 'am.messageid', 'mailinfo.scissors',
+                    'commit.gpgsign'):
+            if utils.config_true(repo._get_config(key)):
+                return False
+
+        encoding = repo._get_config('i18n.commitencoding')
+        if encoding is not None and encoding.lower() not in ('utf-8',
+                                                             'utf8'):
+            return False
+
+        hooks_path = repo.git_path('hooks')
+        for hook in HOOKS:
+            if os.access(os.path.join(hooks_path, hook), os.X_OK):
+                return False
+
+        return True
+
+    def _committer_ident(self):
+        if self._committer is None:
+            self._committer = self.repo.var('GIT_COMMITTER_IDENT')
+
+        if 'GIT_COMMITTER_DATE' in os.environ:
+            return self._committer
+
+        ident, timestamp, tz = self._committer.rsplit(' ', 2)
+        return '%s %d %s' % (ident, int(time.time()), tz)
+
+    def _tree_entries(self, dirname):
+        """Return {name: (mode, object_hash)} for a directory at the base
+        commit.
+        """
+        if dirname not in self._trees:
+            if dirname:
+                rev = '%s:%s' % (self._base, dirname)
+            else:
+                rev = '%s^{tree}' % self._base
+
+            entries = {}
+            result = self._cat_file.read(rev)
+            if result:
+                object_hash, object_type, data = result
+                if object_type != 'tree':
+                    raise Unsupported('%s is not a directory' % dirname)
+
+                pos = 0
+                while pos < len(data):
+                    space = data.index(' ', pos)
+                    nul = data.index('\0', space)
+                    entries[data[space + 1:nul]] = (
+                        data[pos:space], data[nul + 1:nul + 21].encode('hex'))
+                    pos = nul + 21
+
+            self._trees[dirname] = entries
+
+        return self._trees[dirname]
+
+    def _lookup(self, path):
+        """Return (mode, contents) for `path` as of the last pending commit,
+        or None if it doesn't exist.
+        """
+        if path in self._changed:
+            return self._changed[path]
+
+        parent = posixpath.dirname(path)
+        while parent:
+            if self._changed.get(parent):
+                raise Unsupported('%s replaced a directory' % parent)
+            parent = posixpath.dirname(parent)
+
+        dirname, basename = posixpath.split(path)
+        entry = self._tree_entries(dirname).get(basename)
+        if entry is None:
+            return None
+
+        mode, object_hash = entry
+        if mode not in ('100644', '100755'):
+            raise Unsupported('%s has mode %s' % (path, mode))
+
+        return mode, self._cat_file.read(object_hash)[2]
+
+    def _apply_file_patch(self, file_patch):
+        current = self._lookup(file_patch.path)
+
+        if file_patch.status == 'A':
+            if current is not None:
+                raise Unsupported('%s already exists' % file_patch.path)
+            mode, old_contents = file_patch.mode, ''
+            verified = True
+        else:
+            if current is None:
+                raise Unsupported('%s does not exist' % file_patch.path)
+            mode, old_contents = current
+            if file_patch.mode and file_patch.mode != mode:
+                raise Unsupported('%s mode mismatch' % file_patch.path)
+            verified = bool(file_patch.old_abbrev) and blob_hash(
+                old_contents).startswith(file_patch.old_abbrev)
+
+        contents = apply_hunks(old_contents, file_patch.hunks)
+
+        if file_patch.status == 'D':
+            if contents:
+                raise Unsupported('%s not empty after delete'
+                                  % file_patch.path)
+            return file_patch.path, None, None
+
+        if mode not in ('100644', '100755'):
+            raise Unsupported('%s has mode %s' % (file_patch.path, mode))
+
+        # If we patched the exact blob the patch was made against, we must
+        # have produced the exact blob it resulted in
+        if verified and file_patch.new_abbrev and \
+                not blob_hash(contents).startswith(file_patch.new_abbrev):
+            raise Unsupported('%s result mismatch' % file_patch.path)
+
+        return file_patch.path, mode, contents
+
+    def apply(self, patch_path, patch_name):
+        """Apply and annotate a patch, returning False if it has to go
+        through `git am` instead.
+        """
+        with open(patch_path) as f:
+            text = f.read()
+
+        if self._cat_file is None:
+            self._cat_file = self.repo.cat_file_batch()
+
+        if self._base is None:
+            self._base = self.repo.get_head_commit_hash()
+
+        try:
+            author_name, author_email, author_date, message, patch_lines = \
+                parse_mail(text)
+            changes = [self._apply_file_patch(file_patch)
+                       for file_patch in parse_diff(patch_lines)]
+        except Unsupported:
+            return False
+
+        if not changes:
+            return False
+
+        # Mirror what `_add_annotation` does with `git commit --amend`
+        if self.annotate and 'Ply-Patch' not in message:
+            message = utils.stripspace('%s\n\nPly-Patch: %s' % (message,
+                                                               patch_name))
+
+        self._commit(author_name, author_email, author_date, message, changes)
+        self._pending.append((patch_path, patch_name))
+
+        if self._changed_bytes > MAX_PENDING_BYTES:
+            self.flush()
+
+        return True
+
+    def _commit(self, author_name, author_email, author_date, message,
+                changes):
+        if self._fast_import is None:
+            self._fast_import = self.repo.fast_import()
+
+        write = self._fast_import.write
+        write('commit %s\n' % FAST_APPLY_REF)
+        write('author %s <%s> %s\n' % (author_name, author_email,
+                                       author_date))
+        write('committer %s\n' % self._committer_ident())
+        write('data %d\n%s\n' % (len(message), message))
+
+        if not self._pending:
+            write('from %s\n' % self._base)
+
+        for path, mode, contents in changes:
+            if mode is None:
+                write('D %s\n' % path)
+                self._changed[path] = None
+            else:
+                write('M %s inline %s\n' % (mode, path))
+                write('data %d\n' % len(contents))
+                write(contents)
+                write('\n')
+                self._changed[path] = (mode, contents)
+                self._changed_bytes += len(contents)
+
+        write('\n')
+
+    def flush(self):
+        """Move HEAD, the index and the worktree to the last pending
+        commit.
+        """
+        if not self._pending:
+            self._reset()
+            return
+
+        fast_import, self._fast_import = self._fast_import, None
+        fast_import.close()
+
+        pending = self._pending
+        base = self._base
+        self._reset()
+
+        try:
+            new_head = self.repo.rev_parse(FAST_APPLY_REF)
+
+            # A two-tree read-tree only touches the files that changed
+            # between the two commits, but insists on stat information being
+            # fresh. It refuses, leaving everything alone, if that would
+            # clobber untracked or modified files.
+            self.repo.update_index(refresh=True)
+            try:
+                self.repo.read_tree(base, new_head, merge=True, update=True)
+            except subprocess.CalledProcessError:
+                if self.fallback is None:
+                    raise
+                new_head = None
+            else:
+                self.repo.update_ref('HEAD', new_head, old_value=base,
+                                     message='ply: fast-apply')
+        finally:
+            self.repo.update_ref(FAST_APPLY_REF, delete=True)
+
+        if new_head is None:
+            for patch_path, patch_name in pending:
+                self.fallback(patch_path, patch_name)
+            return
+
+        commits = self.repo.rev_list('%s..%s' % (base, new_head),
+                                     reverse=True)
+        self.applied.extend(zip(commits, [patch_name
+                                          for _, patch_name in pending]))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._fast_import is not None:
+                self._fast_import.abort()
+                self._fast_import = None
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
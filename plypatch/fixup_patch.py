@@ -1,80 +1,158 @@
+import collections
+import cStringIO
+import tempfile
+
+
 PATCH_GIT_VERSION = '1.8.3'
 FROM_SHA1_VALUE = 'ply'
 
+# Lines held back while looking for the git version are spooled to disk past
+# this many bytes
+SPOOL_MAX_SIZE = 1024 * 1024
 
-def _replace_from_sha1(lines):
-    """The SHA1 on the 'From' line of the patch will differ each time the
-    patch file is regenerated. To keep this from causing chatty diffs,
-    replace the SHA1 with a hardcoded value.
-    """
-    for line_idx, line in enumerate(lines):
-        if line.startswith('From'):
-            break
-    else:
-        raise Exception("Malformed patch: 'From' not found")
+READ_SIZE = 64 * 1024
 
-    parts = lines[line_idx].split(' ')
-    parts[1] = FROM_SHA1_VALUE
 
-    lines[line_idx] = ' '.join(parts)
+class PatchNormalizer(object):
+    """Normalize a patch so regenerating it doesn't cause chatty diffs.
 
+    Text is pushed in with `feed`, in chunks of any size, and the normalized
+    patch is written to `output` as it's produced; `close` must be called
+    once all of the input has been fed.
 
-def _replace_git_version(lines):
-    """The version of git is embedded in the patch which will differ causing
-    chatty-diffs and unecessary conflicts.
+    Each fixup is a stage holding only the lookahead it needs, run in this
+    order:
 
-    It's terribly evil, but hardcoding this is the easiest way to avoid these
-    conflicts.
+        1. From-SHA1: the SHA1 on the first 'From' line differs each time
+           the patch is regenerated, so it's replaced with a fixed value
+        2. Git version: the version of git that wrote the patch is replaced
+           with a fixed one; lines are held back until we know which
+           version-like line is the last one
+        3. Ply-Patch: annotation lines are dropped
+        4. Subject blank lines: git versions differ in the trailing blank
+           lines they leave after the subject, so only one is kept; the two
+           lines before the first `diff --git` are held
     """
-    for reverse_line_idx, line in enumerate(reversed(lines)):
-        if not line:
-            continue
-        if line[0].isdigit() and '.' in line:
-            break
-    else:
-        raise Exception("Malformed patch: Git version not found")
 
-    # The last line counting backwards (0) becomes -(0) - 1 which becomes -1
-    # counting foward
-    line_idx = -reverse_line_idx - 1
-    lines[line_idx] = PATCH_GIT_VERSION
+    def __init__(self, output):
+        self.output = output
+        self._partial = ''
+        self._first_output_line = True
 
+        # From-SHA1 stage
+        self._from_found = False
 
-def _remove_ply_patch_annotation(lines):
-    match_idxs = []
-    for idx, line in enumerate(lines):
-        if 'Ply-Patch:' in line:
-            match_idxs.append(idx)
+        # Git-version stage
+        self._version_line = None
+        self._held = None
 
-    for idx in reversed(match_idxs):
-        del lines[idx]
+        # Subject blank lines stage
+        self._diff_found = False
+        self._window = collections.deque()
 
+    def feed(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._replace_from_sha1(line)
 
-def _remove_trailing_extra_blank_lines_from_subject(lines):
-    """Different versions of git will output different amounts of trailing
-    whitespace at the end of a subject headers, so we normalize it by only
-    allowing a single trailing blank line.
-    """
-    for idx, line in enumerate(lines):
-        if line.startswith('diff --git'):
-            break
-    else:
-        return
+    def close(self):
+        self._replace_from_sha1(self._partial)
+        self._partial = ''
 
-    if idx < 2:
-        return
+        if not self._from_found:
+            raise Exception("Malformed patch: 'From' not found")
 
-    # If we have two blanks above first `diff --git` remove one of them
-    if not lines[idx - 1].strip() and not lines[idx - 2].strip():
-        del lines[idx - 1]
+        if self._version_line is None:
+            raise Exception("Malformed patch: Git version not found")
 
+        self._release_held(PATCH_GIT_VERSION)
 
-def fixup_patch(original):
-    lines = original.split('\n')
+        for line in self._window:
+            self._write(line)
+        self._window.clear()
+
+    def _replace_from_sha1(self, line):
+        if not self._from_found and line.startswith('From'):
+            self._from_found = True
+            parts = line.split(' ')
+            parts[1] = FROM_SHA1_VALUE
+            line = ' '.join(parts)
+
+        self._replace_git_version(line)
+
+    def _replace_git_version(self, line):
+        if not (line and line[0].isdigit() and '.' in line):
+            if self._held is None:
+                self._remove_ply_patch_annotation(line)
+            else:
+                self._held.write('%s\n' % line)
+            return
 
-    _replace_from_sha1(lines)
-    _replace_git_version(lines)
-    _remove_ply_patch_annotation(lines)
-    _remove_trailing_extra_blank_lines_from_subject(lines)
+        # A newer candidate means the previous one wasn't the git version
+        if self._version_line is not None:
+            self._release_held(self._version_line)
 
-    return '\n'.join(lines)
+        self._version_line = line
+        self._held = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def _release_held(self, version_line):
+        self._remove_ply_patch_annotation(version_line)
+
+        held, self._held = self._held, None
+        held.seek(0)
+        for line in held:
+            self._remove_ply_patch_annotation(line[:-1])
+        held.close()
+
+    def _remove_ply_patch_annotation(self, line):
+        if 'Ply-Patch:' not in line:
+            self._remove_trailing_extra_blank_lines_from_subject(line)
+
+    def _remove_trailing_extra_blank_lines_from_subject(self, line):
+        if self._diff_found:
+            self._write(line)
+            return
+
+        if line.startswith('diff --git'):
+            self._diff_found = True
+            if len(self._window) == 2 and not self._window[0].strip() and \
+                    not self._window[1].strip():
+                self._window.pop()
+            for held_line in self._window:
+                self._write(held_line)
+            self._window.clear()
+            self._write(line)
+            return
+
+        self._window.append(line)
+        if len(self._window) > 2:
+            self._write(self._window.popleft())
+
+    def _write(self, line):
+        if self._first_output_line:
+            self._first_output_line = False
+        else:
+            self.output.write('\n')
+        self.output.write(line)
+
+
+def fixup_patch_file(from_file, to_file):
+    """Normalize the patch read from `from_file` into `to_file` without
+    holding the whole patch in memory.
+    """
+    normalizer = PatchNormalizer(to_file)
+    while True:
+        data = from_file.read(READ_SIZE)
+        if not data:
+            break
+        normalizer.feed(data)
+    normalizer.close()
+
+
+def fixup_patch(original):
+    output = cStringIO.StringIO()
+    normalizer = PatchNormalizer(output)
+    normalizer.feed(original)
+    normalizer.close()
+    return output.getvalue()
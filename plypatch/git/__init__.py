@@ -1,12 +1,43 @@
+import errno
 import functools
 import os
+import select
 import subprocess
 import sys
+import time
 
+from plypatch import metrics
 from plypatch import utils
 from plypatch.git import exc
 
 
+# How long commands that take the index lock keep retrying while another git
+# process holds it
+INDEX_LOCK_TIMEOUT = 30
+
+# Seconds a git command may run before it's killed, so a hung hook can't
+# stall an unattended restore forever; set with PLY_GIT_TIMEOUT, commands
+# wait indefinitely by default. Commands that may open an editor are never
+# timed out.
+COMMAND_TIMEOUT = float(os.environ.get('PLY_GIT_TIMEOUT', 0)) or None
+
+# Bytes of a command's stderr kept around for error messages
+STDERR_LIMIT = 64 * 1024
+
+READ_SIZE = 32 * 1024
+
+# File object every command line and its output is teed into, if any
+_log = None
+
+
+def set_log(f):
+    """Tee every git command line and its output into the file object `f`;
+    None stops logging.
+    """
+    global _log
+    _log = f
+
+
 def cmd(fn):
     @functools.wraps(fn)
     def wrapper(self, *args, **kwargs):
@@ -15,6 +46,362 @@ def cmd(fn):
     return wrapper
 
 
+def _env(index_file=None):
+    """Return the environment for a git command, optionally pointing it at a
+    scratch index instead of the repo's real one.
+    """
+    if not index_file:
+        return None
+    env = os.environ.copy()
+    env['GIT_INDEX_FILE'] = index_file
+    return env
+
+
+class TailBuffer(object):
+    """Keep the last `limit` bytes written to it."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = ''
+
+    def write(self, data):
+        self.data = (self.data + data)[-self.limit:]
+
+    def getvalue(self):
+        return self.data
+
+
+class Command(object):
+    """A git command whose output is streamed as it's produced rather than
+    buffered whole.
+
+    stdout is captured (`capture`) to be read through `chunks`, `lines` or
+    `read`, handed to the `stdout` file object, or else inherited. stderr is
+    echoed as it arrives (`echo`) and only its last `STDERR_LIMIT` bytes are
+    kept, in `stderr`. Everything is teed into the log set with `set_log`.
+    `input` is fed to stdin a pipe-full at a time.
+
+    The command is killed once it has run for `timeout` seconds, defaulting
+    to `COMMAND_TIMEOUT`; 0 waits indefinitely. Commands that may open an
+    editor go through `check_call_interactive` instead.
+    """
+
+    def __init__(self, args, input=None, capture=True, stdout=None, env=None,
+                 timeout=None, echo=True):
+        self.args = args
+        self.echo = echo
+        self.stderr = TailBuffer(STDERR_LIMIT)
+        self.returncode = None
+
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+
+        if capture:
+            stdout = subprocess.PIPE
+
+        if _log:
+            _log.write('$ %s\n' % ' '.join(args))
+
+        self.proc = subprocess.Popen(
+            args, env=env, stdout=stdout, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if input is not None else None)
+
+        self._timer = metrics.git_command()
+        self._timer.__enter__()
+
+        self._input = input
+        self._input_offset = 0
+
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            self.proc.kill()
+            self._finish()
+            raise exc.CommandTimedOut((self.args, self.timeout))
+        return remaining
+
+    def _write_input(self):
+        chunk = self._input[self._input_offset:
+                            self._input_offset + select.PIPE_BUF]
+        try:
+            self._input_offset += os.write(self.proc.stdin.fileno(), chunk)
+        except OSError as e:
+            # The command stopped reading, it'll tell us why
+            if e.errno != errno.EPIPE:
+                raise
+            self._input_offset = len(self._input)
+
+        if self._input_offset >= len(self._input):
+            self.proc.stdin.close()
+            return False
+        return True
+
+    def chunks(self):
+        """Yield stdout as it's produced, then wait for the command.
+
+        Closing the generator early kills the command.
+        """
+        try:
+            for data in self._chunks():
+                yield data
+        except GeneratorExit:
+            self.close()
+            raise
+
+    def close(self):
+        if self.returncode is None:
+            self.proc.kill()
+            self._finish()
+
+    def _chunks(self):
+        readers = {self.proc.stderr.fileno(): 'stderr'}
+        if self.proc.stdout:
+            readers[self.proc.stdout.fileno()] = 'stdout'
+
+        writers = []
+        if self._input is not None:
+            if self._input:
+                writers.append(self.proc.stdin.fileno())
+            else:
+                self.proc.stdin.close()
+
+        while readers or writers:
+            try:
+                readable, writable, _ = select.select(
+                    list(readers), writers, [], self._remaining())
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if writable and not self._write_input():
+                writers = []
+
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    del readers[fd]
+                    continue
+
+                if _log:
+                    _log.write(data)
+
+                if readers[fd] == 'stdout':
+                    yield data
+                    continue
+
+                self.stderr.write(data)
+                if self.echo:
+                    sys.stderr.write(data)
+
+        while self.proc.poll() is None:
+            remaining = self._remaining()
+            time.sleep(min(0.01, remaining) if remaining else 0.01)
+
+        self._finish()
+
+    def _finish(self):
+        self.returncode = self.proc.wait()
+        for f in (self.proc.stdout, self.proc.stderr, self.proc.stdin):
+            if f and not f.closed:
+                f.close()
+        if self._timer:
+            self._timer.__exit__(None, None, None)
+            self._timer = None
+
+    def lines(self):
+        """Yield stdout a line at a time, then wait for the command."""
+        partial = ''
+        for data in self.chunks():
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+    def read(self):
+        """Return all of stdout once the command exits."""
+        return ''.join(self.chunks())
+
+    def wait(self):
+        for _ in self.chunks():
+            pass
+        return self.returncode
+
+
+def run(args, retry_index_lock=False, **kwargs):
+    """Run a git command to completion, returning a tuple of its return
+    code, stdout and the tail of its stderr.
+
+    With `retry_index_lock`, the command is retried with backoff while
+    another git process holds the index lock; its stderr is only echoed
+    once it's done, so the lock errors of the attempts that were retried
+    aren't.
+    """
+    echo = kwargs.pop('echo', True)
+    delays = utils.backoff(INDEX_LOCK_TIMEOUT)
+    while True:
+        command = Command(args, echo=echo and not retry_index_lock, **kwargs)
+        stdout = command.read()
+        stderr = command.stderr.getvalue()
+
+        if retry_index_lock and command.returncode != 0 and \
+                'index.lock' in stderr:
+            delay = next(delays, None)
+            if delay is not None:
+                time.sleep(delay)
+                continue
+
+        if retry_index_lock and echo:
+            sys.stderr.write(stderr)
+
+        return command.returncode, stdout, stderr
+
+
+def check_output(args, **kwargs):
+    """Return a git command's stdout, raising `GitException` if it fails."""
+    returncode, stdout, stderr = run(args, **kwargs)
+    if returncode != 0:
+        raise exc.GitException((returncode, stdout, stderr))
+    return stdout
+
+
+def check_call(args, **kwargs):
+    """Run a git command with its stdout inherited, or sent to a `stdout`
+    file object, raising like `subprocess.check_call` if it fails.
+    """
+    kwargs.setdefault('capture', False)
+    returncode = run(args, **kwargs)[0]
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def check_call_interactive(args):
+    """Run a git command that may open an editor or prompt the user.
+
+    The terminal is left to it: nothing is piped, it's never timed out and
+    it isn't retried, since whatever the user typed would be lost.
+    """
+    if _log:
+        _log.write('$ %s\n' % ' '.join(args))
+
+    with metrics.git_command():
+        returncode = subprocess.call(args)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+class BackgroundCommand(object):
+    """A git command left running while other work gets done.
+
+    Its output is inherited rather than piped, since nothing reads it until
+    `wait`; the timeout still counts from when it was started.
+    """
+
+    def __init__(self, args, timeout=None, **kwargs):
+        self.args = args
+
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+
+        if _log:
+            _log.write('$ %s\n' % ' '.join(args))
+
+        metrics.count('git_commands')
+        self.proc = subprocess.Popen(args, **kwargs)
+
+    def wait(self):
+        """Wait for the command, raising like `subprocess.check_call`."""
+        while self.proc.poll() is None:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.proc.kill()
+                self.proc.wait()
+                raise exc.CommandTimedOut((self.args, self.timeout))
+            time.sleep(0.01)
+
+        if self.proc.returncode != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode,
+                                                self.args)
+
+
+class CatFileBatch(object):
+    """A long-running `git cat-file --batch` process.
+
+    Reading objects through a single pipe avoids paying for a git process
+    (and a fresh look at the object database) per object.
+    """
+
+    def __init__(self, path):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     cwd=path,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+    def read(self, rev):
+        """Return a tuple of (object_hash, object_type, contents) for `rev`
+        or None if it doesn't exist.
+        """
+        if '\n' in rev:
+            raise ValueError('rev may not contain a newline')
+
+        self.proc.stdin.write('%s\n' % rev)
+        self.proc.stdin.flush()
+
+        header = self.proc.stdout.readline()
+        if not header:
+            raise exc.GitException('cat-file exited unexpectedly')
+
+        parts = header.split()
+        if parts[-1] == 'missing' or parts[-1] == 'ambiguous':
+            return None
+
+        object_hash, object_type, size = parts
+        contents = self.proc.stdout.read(int(size))
+        self.proc.stdout.read(1)  # Trailing LF
+        return object_hash, object_type, contents
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class FastImport(object):
+    """A `git fast-import` process used to write objects in bulk.
+
+    Objects written through the stream only become visible to other git
+    commands once `close` returns.
+    """
+
+    def __init__(self, path):
+        self.proc = subprocess.Popen(
+            ['git', 'fast-import', '--quiet', '--force', '--done'],
+            cwd=path,
+            stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.write('done\n')
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise exc.GitException(('fast-import', self.proc.returncode))
+
+    def abort(self):
+        """Kill the stream without updating any refs."""
+        self.proc.kill()
+        self.proc.wait()
+
+
 class Repo(object):
     """Represent a git repo."""
 
@@ -29,7 +416,7 @@ class Repo(object):
 
     @cmd
     def add(self, filename):
-        subprocess.check_call(['git', 'add', filename])
+        check_call(['git', 'add', filename], retry_index_lock=True)
 
     @cmd
     def am(self, *patch_paths, **kwargs):
@@ -54,16 +441,29 @@ class Repo(object):
         if abort:
             args.append('--abort')
 
-        proc = subprocess.Popen(args,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
+        if resolved:
+            # Carrying on may prompt, so the terminal is left to git
+            if quiet:
+                args.append('--quiet')
+            try:
+                check_call_interactive(args)
+            except subprocess.CalledProcessError:
+                raise exc.PatchDidNotApplyCleanly
+            return
+
+        # Conflict output can be huge, so it's shown as it comes and only
+        # its tail is kept to tell what happened
+        command = Command(args, echo=not quiet)
+        stdout = TailBuffer(STDERR_LIMIT)
+        for data in command.chunks():
+            stdout.write(data)
+            if not quiet:
+                sys.stdout.write(data)
 
-        if not quiet:
-            print stderr
-            print stdout
+        stdout = stdout.getvalue()
+        stderr = command.stderr.getvalue()
 
-        if proc.returncode == 0:
+        if command.returncode == 0:
             if 'atch already applied' in stdout:
                 raise exc.PatchAlreadyApplied
         else:
@@ -72,6 +472,47 @@ class Repo(object):
             else:
                 raise exc.PatchDidNotApplyCleanly
 
+    @cmd
+    def apply(self, patch_path, cached=False, check=False, reverse=False,
+              three_way_merge=False, index_file=None):
+        args = ['git', 'apply']
+
+        if cached:
+            args.append('--cached')
+
+        if check:
+            args.append('--check')
+
+        if reverse:
+            args.append('--reverse')
+
+        if three_way_merge:
+            args.append('--3way')
+
+        args.append(patch_path)
+
+        returncode, stdout, stderr = run(args, env=_env(index_file),
+                                         echo=False)
+        if returncode != 0:
+            raise exc.PatchDidNotApplyCleanly((returncode, stdout, stderr))
+
+    @cmd
+    def archive(self, treeish, format='tar', prefix=None, output=None,
+                stdout=None):
+        """Stream a tree as an archive into `output` (a path) or `stdout` (a
+        file object).
+        """
+        args = ['git', 'archive', '--format=%s' % format]
+
+        if prefix:
+            args.append('--prefix=%s' % prefix)
+
+        if output:
+            args.extend(['-o', output])
+
+        args.append(treeish)
+        check_call(args, stdout=stdout)
+
     @cmd
     def checkout(self, branch_name, create=False, create_and_reset=False):
         args = ['git', 'checkout']
@@ -87,11 +528,17 @@ class Repo(object):
             args.append('-B')
 
         args.append(branch_name)
-        subprocess.check_call(args)
+        check_call(args)
+
+    @cmd
+    def checkout_index(self, prefix, index_file=None):
+        """Write every file in the index out underneath `prefix`."""
+        check_call(['git', 'checkout-index', '-a', '--prefix=%s' % prefix],
+                   env=_env(index_file))
 
     # NOTE: clone shouldn't use cmd because directory doesn't exist yet
     def clone(self, path):
-        subprocess.check_call(['git', 'clone', path, self.path])
+        check_call(['git', 'clone', path, self.path])
 
     @cmd
     def commit(self, msgs=None, all=False, amend=False,
@@ -122,27 +569,54 @@ class Repo(object):
         if template:
             args.extend(['-t', template])
 
-        subprocess.check_call(args)
+        # Without a message git asks for one in an editor
+        if msgs or use_commit_object:
+            check_call(args, retry_index_lock=True)
+        else:
+            check_call_interactive(args)
+
+    @cmd
+    def commit_tree(self, tree, parents=None, message='', author=None):
+        """Create a commit object for `tree` without touching the index or
+        worktree and return its hash.
+
+        `author` is an optional (name, email, date) tuple, with the date in
+        any format git accepts.
+        """
+        args = ['git', 'commit-tree', tree]
+
+        for parent in parents or []:
+            args.extend(['-p', parent])
+
+        env = None
+        if author:
+            env = os.environ.copy()
+            env['GIT_AUTHOR_NAME'], env['GIT_AUTHOR_EMAIL'], \
+                env['GIT_AUTHOR_DATE'] = author
+
+        return check_output(args, input=message, env=env).strip()
 
     @cmd
     def config(self, cmd, config_key=None, config_value=None):
-        """Add/unset git configs"""
+        """Add/set/unset git configs"""
         args = ['git', 'config']
 
         if cmd == 'add':
             assert config_key and config_value
             args.extend(['--add', config_key, config_value])
+        elif cmd == 'set':
+            assert config_key and config_value
+            args.extend([config_key, config_value])
         elif cmd == 'get':
             args.extend(['--get', config_key])
+        elif cmd == 'get-all':
+            args.extend(['--get-all', config_key])
         elif cmd == 'unset':
             args.extend(['--unset', config_key])
         else:
             raise ValueError('unknown command %s' % cmd)
 
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            raise exc.GitException((proc.returncode, stdout, stderr))
+        stdout = check_output(args)
         lines = [line.strip() for line in stdout.split('\n') if line]
         return lines
 
@@ -152,26 +626,65 @@ class Repo(object):
         args = ['git', 'diff-index', treeish]
         if name_only:
             args.append('--name-only')
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            raise exc.GitException((proc.returncode, stdout, stderr))
+        stdout = check_output(args)
         filenames = [line.strip() for line in stdout.split('\n') if line]
         return filenames
 
     @cmd
-    def fetch(self, all=False):
+    def diff_tree(self, treeish1, treeish2, binary=False, stdout=None):
+        """Stream a diff between two trees into the `stdout` file object.
+
+        This is plumbing, so unlike `git diff` the output doesn't depend on
+        the user's diff or color config.
+        """
+        args = ['git', 'diff-tree', '-r', '-p', '--no-ext-diff', '--no-color',
+                '--src-prefix=a/', '--dst-prefix=b/']
+
+        if binary:
+            args.append('--binary')
+
+        args.extend([treeish1, treeish2])
+        check_call(args, stdout=stdout)
+
+    @cmd
+    def fetch(self, remote=None, all=False, remotes=None, refspecs=None,
+              jobs=None, filter=None, background=False):
+        """Fetch `remote`, several `remotes` at once or `all` of them.
+
+        `jobs` is how many remotes are fetched in parallel and `filter` a
+        partial-clone filter such as blob:none. With `background`, a
+        `BackgroundCommand` is returned instead of waiting for the fetch.
+        """
         args = ['git', 'fetch']
 
         if all:
             args.append('--all')
 
-        subprocess.check_call(args)
+        if remotes:
+            args.append('--multiple')
 
-    @cmd
-    def format_patch(self, since, keep_subject=False, no_numbered=False,
-                     no_stat=False):
-        """Returns a list of patch files"""
+        if jobs:
+            args.append('--jobs=%d' % jobs)
+
+        if filter:
+            args.append('--filter=%s' % filter)
+
+        if remote:
+            args.append(remote)
+
+        if remotes:
+            args.extend(remotes)
+
+        if refspecs:
+            args.extend(refspecs)
+
+        if background:
+            return BackgroundCommand(args)
+
+        check_call(args)
+
+    def _format_patch_args(self, since, keep_subject=False, no_numbered=False,
+                           no_stat=False, stdout=False):
         args = ['git', 'format-patch']
 
         if keep_subject:
@@ -183,15 +696,51 @@ class Repo(object):
         if no_stat:
             args.append('--no-stat')
 
+        if stdout:
+            args.append('--stdout')
+
         args.append(since)
+        return args
 
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            raise exc.GitException((proc.returncode, stdout, stderr))
+    @cmd
+    def format_patch(self, since, keep_subject=False, no_numbered=False,
+                     no_stat=False):
+        """Returns a list of patch files"""
+        args = self._format_patch_args(since, keep_subject=keep_subject,
+                                       no_numbered=no_numbered,
+                                       no_stat=no_stat)
+
+        stdout = check_output(args)
         filenames = [line.strip() for line in stdout.split('\n') if line]
         return filenames
 
+    def format_patch_lines(self, since, keep_subject=False, no_numbered=False,
+                           no_stat=False):
+        """Yield the lines of `git format-patch --stdout` as they're produced
+        so patches can be processed without writing any files.
+        """
+        args = self._format_patch_args(since, keep_subject=keep_subject,
+                                       no_numbered=no_numbered,
+                                       no_stat=no_stat, stdout=True)
+
+        with utils.usedir(self.path):
+            command = Command(args)
+
+        for line in command.lines():
+            yield line
+
+        if command.returncode != 0:
+            raise exc.GitException((command.returncode, 'format-patch',
+                                    command.stderr.getvalue()))
+
+    @cmd
+    def hash_object(self, *paths):
+        """Return the blob hash of each file in `paths`."""
+        args = ['git', 'hash-object', '--']
+        args.extend(paths)
+        stdout = check_output(args)
+        return stdout.split()
+
     @cmd
     def init(self, directory, quiet=None):
         if quiet is None:
@@ -203,11 +752,14 @@ class Repo(object):
             args.append('-q')
 
         args.append(directory)
-        subprocess.check_call(args)
+        check_call(args)
 
     @cmd
-    def log(self, cmd_arg=None, count=None, pretty=None, skip=None):
+    def log(self, cmd_arg=None, count=None, pretty=None, skip=None,
+            grep=None):
         args = ['git', 'log']
+        if grep:
+            args.append("--grep=%s" % grep)
         if pretty:
             args.append("--pretty=%s" % pretty)
         if count is not None:
@@ -216,12 +768,36 @@ class Repo(object):
             args.append("--skip=%d" % skip)
         if cmd_arg:
             args.append(cmd_arg)
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            raise exc.GitException((proc.returncode, stdout, stderr))
+        stdout = check_output(args)
         return stdout
 
+    @cmd
+    def ls_files(self, *paths):
+        """Return the files under `paths` that are in the index."""
+        stdout = check_output(['git', 'ls-files', '--'] + list(paths))
+        return [line for line in stdout.split('\n') if line]
+
+    @cmd
+    def ls_tree(self, treeish, recursive=False):
+        """Return a list of (mode, type, object_hash, path) tuples."""
+        args = ['git', 'ls-tree', '-z']
+
+        if recursive:
+            args.append('-r')
+
+        args.append(treeish)
+
+        stdout = check_output(args)
+
+        entries = []
+        for entry in stdout.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            mode, object_type, object_hash = info.split()
+            entries.append((mode, object_type, object_hash, path))
+        return entries
+
     @cmd
     def notes(self, command, message=None):
         args = ['git', 'notes', command]
@@ -229,7 +805,50 @@ class Repo(object):
         if message:
             args.extend(['-m', message])
 
-        subprocess.check_call(args)
+        check_call(args)
+
+    @cmd
+    def notes_list(self, ref=None):
+        """Return a list of (note_object_hash, annotated_object_hash)
+        tuples.
+        """
+        args = ['git', 'notes']
+
+        if ref:
+            args.extend(['--ref', ref])
+
+        args.append('list')
+
+        stdout = check_output(args)
+        return [tuple(line.split()) for line in stdout.split('\n') if line]
+
+    @cmd
+    def patch_id(self, patch):
+        """Return the stable patch-id of the diff in `patch`, or None if it
+        has no diff.
+        """
+        stdout = check_output(['git', 'patch-id', '--stable'], input=patch)
+        if not stdout:
+            return None
+        return stdout.split()[0]
+
+    @cmd
+    def read_tree(self, *treeishes, **kwargs):
+        index_file = kwargs.get('index_file')
+        merge = kwargs.get('merge', False)
+        update = kwargs.get('update', False)
+
+        args = ['git', 'read-tree']
+
+        if merge:
+            args.append('-m')
+
+        if update:
+            args.append('-u')
+
+        args.extend(treeishes)
+        check_call(args, env=_env(index_file),
+                   retry_index_lock=not index_file)
 
     @cmd
     def reset(self, commit, hard=False, quiet=None):
@@ -244,7 +863,31 @@ class Repo(object):
         if quiet:
             args.append('-q')
 
-        subprocess.check_call(args)
+        check_call(args, retry_index_lock=True)
+
+    @cmd
+    def rev_list(self, cmd_arg, first_parent=False, reverse=False,
+                 merges=False):
+        args = ['git', 'rev-list']
+
+        if first_parent:
+            args.append('--first-parent')
+
+        if merges:
+            args.append('--merges')
+
+        if reverse:
+            args.append('--reverse')
+
+        args.append(cmd_arg)
+
+        stdout = check_output(args)
+        return [line.strip() for line in stdout.split('\n') if line]
+
+    @cmd
+    def rev_parse(self, rev):
+        return check_output(['git', 'rev-parse', '--verify', '-q',
+                             rev]).strip()
 
     @cmd
     def rm(self, filename, quiet=None, force=False):
@@ -258,13 +901,142 @@ class Repo(object):
         if force:
             args.append('-f')
 
-        subprocess.check_call(args)
+        check_call(args, retry_index_lock=True)
+
+    @cmd
+    def sparse_checkout_disable(self):
+        check_call(['git', 'sparse-checkout', 'disable'],
+                   retry_index_lock=True)
+
+    @cmd
+    def sparse_checkout_set(self, directories):
+        """Limit the checkout to the cone of `directories`; files at the top
+        level are always checked out.
+        """
+        check_call(['git', 'sparse-checkout', 'set', '--cone', '--stdin'],
+                   input=''.join('%s\n' % directory
+                                 for directory in directories),
+                   retry_index_lock=True)
+
+    @cmd
+    def unreachable_commits(self, commits):
+        """Return those of `commits` that no ref or HEAD can reach."""
+        stdout = check_output(
+            ['git', 'rev-list', '--stdin', '--not', '--all'],
+            input=''.join('%s\n' % commit for commit in commits))
+
+        commits = set(commits)
+        return [line for line in stdout.split('\n') if line in commits]
+
+    @cmd
+    def update_index(self, refresh=False):
+        args = ['git', 'update-index', '-q']
+
+        if refresh:
+            args.append('--refresh')
+
+        # Non-zero just means some entries still need updating
+        run(args, capture=False)
+
+    @cmd
+    def update_ref(self, ref, new_value=None, old_value=None, delete=False,
+                   message=None):
+        args = ['git', 'update-ref']
+
+        if message:
+            args.extend(['-m', message])
+
+        if delete:
+            args.extend(['-d', ref])
+        else:
+            args.extend([ref, new_value])
+
+        if old_value:
+            args.append(old_value)
+
+        check_call(args)
+
+    @cmd
+    def var(self, variable):
+        return check_output(['git', 'var', variable]).strip()
+
+    @cmd
+    def write_tree(self, index_file=None):
+        return check_output(['git', 'write-tree'], env=_env(index_file),
+                            echo=False).strip()
+
+    @cmd
+    def worktree_add(self, path, commit_ish='HEAD', detach=False):
+        args = ['git', 'worktree', 'add']
+
+        if detach:
+            args.append('--detach')
+
+        if self.quiet:
+            args.append('-q')
+
+        args.extend([path, commit_ish])
+        check_call(args)
+
+    @cmd
+    def worktree_list(self):
+        """Return the paths of the repo's worktrees, main worktree first."""
+        stdout = check_output(['git', 'worktree', 'list', '--porcelain'])
+
+        return [line[len('worktree '):] for line in stdout.split('\n')
+                if line.startswith('worktree ')]
+
+    @property
+    def git_dir(self):
+        """Return the absolute path to this repo's git dir.
+
+        For a linked worktree, this is its private directory under the main
+        repo's `.git/worktrees` rather than the shared `.git`.
+        """
+        if not hasattr(self, '_git_dir'):
+            with utils.usedir(self.path):
+                stdout = check_output(['git', 'rev-parse', '--git-dir'])
+            self._git_dir = os.path.join(self.path, stdout.strip())
+        return self._git_dir
+
+    @cmd
+    def git_path(self, name):
+        """Return the absolute path git uses for `name` (e.g. 'hooks'),
+        taking worktrees and config overrides into account.
+        """
+        stdout = check_output(['git', 'rev-parse', '--git-path', name])
+        return os.path.join(self.path, stdout.strip())
+
+    def cat_file_batch(self):
+        return CatFileBatch(self.path)
+
+    def fast_import(self):
+        return FastImport(self.path)
+
+    @property
+    def git_common_dir(self):
+        """Return the absolute path to the git dir shared by all of this
+        repo's worktrees.
+        """
+        if not hasattr(self, '_git_common_dir'):
+            with utils.usedir(self.path):
+                stdout = check_output(
+                    ['git', 'rev-parse', '--git-common-dir'])
+            self._git_common_dir = os.path.join(self.path, stdout.strip())
+        return self._git_common_dir
 
     def uncommitted_changes(self):
         return len(self.diff_index('HEAD')) != 0
 
+    def sparse_checkout_enabled(self):
+        try:
+            value = self.config('get', config_key='core.sparseCheckout')[0]
+        except exc.GitException:
+            return False
+        return value.lower() == 'true'
+
     def rebase_in_progress(self):
-        return os.path.exists(os.path.join(self.path, '.git', 'rebase-apply'))
+        return os.path.exists(os.path.join(self.git_dir, 'rebase-apply'))
 
     def get_head_commit_hash(self):
         return self.log(cmd_arg='HEAD', pretty='%H', count=1).strip()
@@ -2,6 +2,10 @@ class GitException(Exception):
     pass
 
 
+class CommandTimedOut(GitException):
+    pass
+
+
 class PatchAlreadyApplied(GitException):
     pass
 
@@ -0,0 +1,206 @@
+"""
+Run ply operations from other programs without scraping their output.
+
+A `Job` wraps a restore, resolve or skip on a working-repo. Subscribers are
+called with a dict for each event as the operation makes progress:
+
+    {"event": "patch-applied", "patch": "foo.patch", "time": 1371486948.5}
+
+The events are:
+
+    restore-started   `total` patches in the series, `done` already applied
+    patch-started     `patch` is about to be applied
+    patch-applied     `patch` applied, with or without a three-way merge
+    patch-removed     `patch` was dropped, `reason` is `upstream` or `skipped`
+    patch-deferred    `patch` was set aside by a keep-going restore
+    conflict          `patch` stopped the restore, `three_way_merged` says
+                      whether the conflicts are in the worktree
+    phase             the `phase` (recover, prepare, fetch, reset, apply
+                      or commit) took `duration` seconds
+    restore-finished  the series is applied and recorded
+    finished          the job is over, `result` is `RestoreResult.as_dict()`
+
+`cancel` stops the operation before the next patch is applied. The restore
+journal is left in place, so a cancelled restore is carried on with `ply
+restore --resume`.
+
+ply runs git from the repo it's operating on, changing directory to do so,
+so a process should only run one job at a time.
+"""
+import json
+import threading
+
+from plypatch import exc
+from plypatch.git import exc as git_exc
+
+
+OPERATIONS = ('restore', 'resolve', 'skip')
+
+
+class RestoreResult(object):
+    """Outcome of a job.
+
+    `status` is one of `ok`, `conflict`, `cancelled` or `failed`.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.applied = []
+        self.removed = []
+        self.deferred = []
+        self.conflict = None
+        self.three_way_merged = None
+        self.timings = {}
+        self.error = None
+
+    def as_dict(self):
+        return {'status': self.status,
+                'applied': self.applied,
+                'removed': self.removed,
+                'deferred': self.deferred,
+                'conflict': self.conflict,
+                'three_way_merged': self.three_way_merged,
+                'timings': self.timings,
+                'error': self.error}
+
+
+class Job(object):
+    """Run `operation` on `working_repo`, passing `kwargs` along to it.
+
+    `run` blocks until the operation is over; `start` runs it on a thread
+    that `wait` joins. Either way the outcome ends up in `result`.
+    """
+
+    def __init__(self, working_repo, operation, **kwargs):
+        if operation not in OPERATIONS:
+            raise ValueError('operation must be one of: %s'
+                             % ', '.join(OPERATIONS))
+
+        self.working_repo = working_repo
+        self.operation = operation
+        self.kwargs = kwargs
+        self.events = []
+        self.result = RestoreResult()
+        self._subscribers = []
+        self._cancel_event = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """Call `callback` with each event from now on."""
+        self._subscribers.append(callback)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_in_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Wait for a started job, returning its result, or None if it's
+        still running after `timeout` seconds.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return None
+        return self.result
+
+    def _run_in_thread(self):
+        try:
+            self.run()
+        except Exception:
+            # Recorded in the result
+            pass
+
+    def run(self):
+        """Run the operation and return its result.
+
+        Conflicts and cancellation are reported through the result; any
+        other error is recorded in it as well and then raised.
+        """
+        working_repo = self.working_repo
+        saved = working_repo.progress, working_repo.cancel_event
+        working_repo.progress = self._on_event
+        working_repo.cancel_event = self._cancel_event
+
+        result = self.result
+        try:
+            getattr(working_repo, self.operation)(**self.kwargs)
+            result.status = 'ok'
+        except git_exc.PatchBlobSHA1Invalid:
+            result.status = 'conflict'
+            result.three_way_merged = False
+        except git_exc.PatchDidNotApplyCleanly:
+            result.status = 'conflict'
+            result.three_way_merged = True
+        except exc.Cancelled:
+            result.status = 'cancelled'
+        except Exception as e:
+            result.status = 'failed'
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            working_repo.progress, working_repo.cancel_event = saved
+            if result.status != 'failed':
+                result.deferred = working_repo.deferred_patches
+            self._on_event({'event': 'finished',
+                            'result': result.as_dict()})
+
+        return result
+
+    def _on_event(self, event):
+        name = event['event']
+        result = self.result
+        if name == 'patch-applied':
+            result.applied.append(event['patch'])
+        elif name == 'patch-removed':
+            result.removed.append(event['patch'])
+        elif name == 'conflict':
+            result.conflict = event['patch']
+        elif name == 'phase':
+            result.timings[event['phase']] = event['duration']
+
+        self.events.append(event)
+        for callback in self._subscribers:
+            callback(event)
+
+
+class TextProgress(object):
+    """Subscriber that draws the `Restoring i/n` counter."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.done = 0
+        self.total = 0
+
+    def __call__(self, event):
+        name = event['event']
+        if name == 'restore-started':
+            self.done = event['done']
+            self.total = event['total']
+        elif name in ('patch-applied', 'patch-removed', 'patch-deferred'):
+            # A resolve or skip reports the patch it dealt with before the
+            # rest of the restore starts, which counts it as done
+            if not self.total:
+                return
+            self.done += 1
+            self.stream.write('\rRestoring %d/%d' % (self.done, self.total))
+            self.stream.flush()
+        elif name == 'restore-finished':
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+class JsonlProgress(object):
+    """Subscriber that writes each event as a line of JSON."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __call__(self, event):
+        self.stream.write('%s\n' % json.dumps(event, sort_keys=True))
+        self.stream.flush()
+
+
+PROGRESS_REPORTERS = {'text': TextProgress, 'jsonl': JsonlProgress}
@@ -0,0 +1,111 @@
+"""
+The restore journal records everything about an in-progress restore in one
+file, so that a restore that was interrupted -- by a conflict, or by being
+killed outright -- can carry on exactly where it stopped.
+
+It holds a snapshot of the series being restored, the upstream commit it's
+being restored onto, each patch applied so far along with its commit, the
+patches skipped or found upstream, the patches a keep-going restore set
+aside, the patch-repo changes still to be committed and the counters used
+for the patch-repo commit message.
+
+Every update rewrites the whole file through an atomic rename, so a crash
+leaves either the previous or the new journal behind, never a torn one.
+"""
+import json
+import os
+
+from plypatch import utils
+
+
+VERSION = 1
+
+
+class RestoreJournal(object):
+    """An in-progress restore.
+
+    `applied` is a list of [patch_name, commit_hash] in the order the
+    patches were applied, `skipped` lists the patches that were skipped or
+    found upstream, and `removed_patches` the patches that have to be
+    removed from the patch-repo before it's committed. `conflict` names the
+    patch waiting on the user to resolve, skip or abort.
+
+    `series` only holds the patches chosen for a `partial` restore.
+
+    A keep-going restore sets conflicting patches and their dependents
+    aside in `deferred`, in series order, and only applies them once
+    `applying_deferred` is set after the rest of the series is applied.
+    """
+
+    FIELDS = {
+        'base': None,
+        'patch_rev': None,
+        'series': [],
+        'partial': False,
+        'applied': [],
+        'skipped': [],
+        'removed_patches': [],
+        'conflict': None,
+        'keep_going': False,
+        'deferred': [],
+        'applying_deferred': False,
+        'updated': 0,
+        'removed': 0,
+        'three_way_merge': True,
+        'commit_msg': None,
+        'customize_commit_msg': False,
+    }
+
+    def __init__(self, path, **fields):
+        self.path = path
+        for name, default in self.FIELDS.iteritems():
+            value = fields.get(name, default)
+            if isinstance(value, list):
+                value = list(value)
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, path):
+        """Return the journal at `path`, or None if there's no restore in
+        progress.
+        """
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            data = json.load(f)
+
+        if data.get('version') != VERSION:
+            raise ValueError('unknown restore journal version %s'
+                             % data.get('version'))
+
+        fields = dict((str(name), value) for name, value in data.iteritems()
+                      if name in cls.FIELDS)
+        return cls(path, **fields)
+
+    @property
+    def done(self):
+        """Return the set of patches that don't need applying anymore."""
+        return set(patch_name for patch_name, _ in self.applied) | \
+            set(self.skipped)
+
+    @property
+    def last_commit(self):
+        """Return the commit HEAD should be at."""
+        if self.applied:
+            return self.applied[-1][1]
+        return self.base
+
+    def add_applied(self, patch_name, commit_hash):
+        self.applied.append([patch_name, commit_hash])
+        self.save()
+
+    def save(self):
+        data = dict((name, getattr(self, name)) for name in self.FIELDS)
+        data['version'] = VERSION
+        with utils.atomic_write(self.path) as f:
+            json.dump(data, f, sort_keys=True)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,263 @@
+"""
+Every `ply` invocation appends one JSON record of what it cost to a metrics
+file in the working-repo's git dir:
+
+    {"time": 1371486948, "command": "restore", "status": 0,
+     "wall_time": 1.52, "git_commands": 41, "git_time": 1.21,
+     "patches_applied": 12, "patches_removed": 0, "patches_updated": 1,
+     "conflicts": 1, "patch_bytes_read": 48213, "patch_bytes_written": 3904}
+
+A command answered by `ply daemon` is recorded by the ply that asked for it;
+the daemon itself, like `ply metrics`, isn't recorded.
+
+Once the file grows past `MAX_BYTES` it's rotated to `<name>.1`, so the
+history kept is bounded to about twice that. `ply metrics` aggregates the
+history per command, as a summary of percentiles or as a node-exporter
+textfile for Prometheus.
+
+Counters are bumped with `count`, which does nothing unless a command is
+being recorded, so library users of ply pay nothing for them.
+"""
+import collections
+import contextlib
+import errno
+import json
+import math
+import os
+import time
+
+from plypatch import utils
+
+
+METRICS_NAME = 'metrics.jsonl'
+
+# Size past which the metrics file is rotated
+MAX_BYTES = 1024 * 1024
+
+COUNTERS = ('git_commands', 'git_time', 'patches_applied',
+            'patches_removed', 'patches_updated', 'conflicts',
+            'patch_bytes_read', 'patch_bytes_written')
+
+PERCENTILES = (50, 90, 99)
+
+_recorder = None
+
+
+class Recorder(object):
+    """The counters for a single command."""
+
+    def __init__(self, command):
+        self.command = command
+        self.start = time.time()
+        self.counters = dict((name, 0) for name in COUNTERS)
+        self.discarded = False
+        self._git_depth = 0
+
+    def discard(self):
+        """Don't record the command after all."""
+        self.discarded = True
+
+    @contextlib.contextmanager
+    def git_command(self):
+        # Repo methods call each other, so only the outermost is timed
+        self.counters['git_commands'] += 1
+        self._git_depth += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._git_depth -= 1
+            if not self._git_depth:
+                self.counters['git_time'] += time.time() - start
+
+    def record(self, status):
+        record = dict(self.counters, time=int(self.start),
+                      command=self.command, status=status,
+                      wall_time=time.time() - self.start)
+        for name in ('wall_time', 'git_time'):
+            record[name] = round(record[name], 6)
+        return record
+
+
+def count(name, value=1):
+    """Add `value` to a counter of the command being recorded, if any."""
+    if _recorder is not None:
+        _recorder.counters[name] += value
+
+
+@contextlib.contextmanager
+def git_command():
+    """Count and time a git command run on behalf of the command being
+    recorded, if any.
+    """
+    if _recorder is None:
+        yield
+        return
+
+    with _recorder.git_command():
+        yield
+
+
+@contextlib.contextmanager
+def recording(command, get_path):
+    """Record the cost of the command run in the block, appending it to the
+    metrics file returned by `get_path` once the block exits.
+
+    The exit status is taken from `SystemExit`; any other exception counts
+    as a failure. Metrics are best-effort and never fail the command.
+    """
+    global _recorder
+    _recorder = recorder = Recorder(command)
+
+    status = 0
+    try:
+        yield recorder
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            status = 1
+        raise
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        _recorder = None
+        if not recorder.discarded:
+            try:
+                append(get_path(), recorder.record(status))
+            except Exception:
+                pass
+
+
+def append(path, record):
+    """Append `record` to the metrics file, rotating it if it's full."""
+    line = '%s\n' % json.dumps(record, sort_keys=True)
+
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+
+    if size and size + len(line) > MAX_BYTES:
+        try:
+            os.rename(path, '%s.1' % path)
+        except OSError as e:
+            # Another ply rotated it first
+            if e.errno != errno.ENOENT:
+                raise
+
+    with open(path, 'a') as f:
+        f.write(line)
+
+
+def read(path):
+    """Return the recorded history, oldest first, skipping torn lines."""
+    records = []
+    for filename in ('%s.1' % path, path):
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def percentile(values, pct):
+    """Return the nearest-rank `pct` percentile of `values`."""
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def by_command(records):
+    """Group records by command, in command order."""
+    grouped = collections.OrderedDict()
+    for record in sorted(records, key=lambda r: r['command']):
+        grouped.setdefault(record['command'], []).append(record)
+    return grouped
+
+
+def summary(records):
+    """Return a list of dicts summarizing each command's history."""
+    rows = []
+    for command, runs in by_command(records).iteritems():
+        wall_times = [r['wall_time'] for r in runs]
+        row = {'command': command,
+               'runs': len(runs),
+               'failures': len([r for r in runs if r['status']]),
+               'git_commands': percentile(
+                   [r['git_commands'] for r in runs], 50)}
+        for pct in PERCENTILES:
+            row['p%d' % pct] = percentile(wall_times, pct)
+        rows.append(row)
+    return rows
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _metric(lines, name, metric_type, help_text, samples):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    for labels, value in samples:
+        label_text = ','.join('%s="%s"' % (key, label_value)
+                              for key, label_value in labels)
+        lines.append('%s{%s} %s' % (name, label_text, _format_value(value)))
+
+
+def prometheus(records):
+    """Return the recorded history aggregated in the node-exporter textfile
+    format.
+
+    Since the history is rotated, the totals can go down and are exported
+    as gauges.
+    """
+    grouped = by_command(records)
+    lines = []
+
+    samples = []
+    for command, runs in grouped.iteritems():
+        wall_times = [r['wall_time'] for r in runs]
+        for pct in PERCENTILES:
+            samples.append(((('command', command),
+                             ('quantile', '%.2f' % (pct / 100.0))),
+                            percentile(wall_times, pct)))
+    _metric(lines, 'ply_command_duration_seconds', 'summary',
+            'Wall time of ply commands.', samples)
+    for command, runs in grouped.iteritems():
+        lines.append('ply_command_duration_seconds_sum{command="%s"} %s' % (
+            command, _format_value(float(sum(r['wall_time'] for r in runs)))))
+        lines.append('ply_command_duration_seconds_count{command="%s"} %d' % (
+            command, len(runs)))
+
+    _metric(lines, 'ply_command_failures', 'gauge',
+            'Number of ply commands that exited non-zero.',
+            [((('command', command), ),
+              len([r for r in runs if r['status']]))
+             for command, runs in grouped.iteritems()])
+
+    for name in COUNTERS:
+        _metric(lines, 'ply_%s' % name, 'gauge',
+                'Total %s of ply commands.' % name.replace('_', ' '),
+                [((('command', command), ), sum(r.get(name, 0)
+                                                for r in runs))
+                 for command, runs in grouped.iteritems()])
+
+    return '%s\n' % '\n'.join(lines)
+
+
+def write_prometheus(path, records):
+    """Write the textfile atomically, as node-exporter requires."""
+    with utils.atomic_write(path) as f:
+        # node-exporter usually runs as another user
+        os.fchmod(f.fileno(), 0o644)
+        f.write(prometheus(records))
@@ -1,8 +1,13 @@
 import contextlib
+import difflib
+import errno
+import fcntl
 import fnmatch
 import os
 import re
 import subprocess
+import tempfile
+import time
 
 
 RE_PATCH_IDENTIFIER = re.compile('Ply-Patch: (.*)')
@@ -18,6 +23,67 @@ def usedir(path):
         os.chdir(orig_path)
 
 
+@contextlib.contextmanager
+def atomic_write(path):
+    """Yield a file object whose contents replace `path` in one atomic rename
+    once the block exits without raising.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s-' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yield f
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def backoff(timeout, initial=0.05, maximum=1.0):
+    """Yield sleep intervals that double up to `maximum` until `timeout`
+    seconds have passed.
+    """
+    deadline = time.time() + timeout
+    delay = initial
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, maximum)
+
+
+def config_true(value):
+    """Return whether a git config value, possibly unset, is true."""
+    return value is not None and value.lower() in ('true', 'yes', 'on', '1')
+
+
+def flock(f, exclusive=True, timeout=None):
+    """Take an flock(2) lock on an open file.
+
+    Rather than blocking indefinitely, we poll with backoff for up to
+    `timeout` seconds. Returns False if the lock couldn't be had in time.
+    """
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if timeout is None:
+        fcntl.flock(f, operation)
+        return True
+
+    delays = backoff(timeout)
+    while True:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        delay = next(delays, None)
+        if delay is None:
+            return False
+        time.sleep(delay)
+
+
 def get_patch_annotation(commit_msg):
     """Return the Ply-Patch annotation if present in the commit msg.
 
@@ -30,6 +96,28 @@ def get_patch_annotation(commit_msg):
     return matches.group(1)
 
 
+def stripspace(msg):
+    """Clean up a commit message the same way `git stripspace` does.
+
+    Trailing whitespace is removed from every line, runs of blank lines are
+    collapsed into one, leading and trailing blank lines are dropped and the
+    result ends in a newline. We need this to predict, byte-for-byte, the
+    message git will record for a commit.
+    """
+    lines = []
+    empties = 0
+    for line in msg.split('\n'):
+        line = line.rstrip(' \t\r')
+        if not line:
+            empties += 1
+            continue
+        if empties and lines:
+            lines.append('')
+        empties = 0
+        lines.append(line)
+    return ''.join('%s\n' % line for line in lines)
+
+
 def recursive_glob(path, glob):
     """Glob against a directory recursively.
 
@@ -53,6 +141,20 @@ def path_exists_case_sensitive(path):
     return basename in os.listdir(dirname)
 
 
+def _same_contents(source_file, dest_path, chunk_size=64 * 1024):
+    """Compare a file object against a file on disk without reading either
+    fully into memory.
+    """
+    source_file.seek(0)
+    with open(dest_path) as dest_file:
+        while True:
+            source_chunk = source_file.read(chunk_size)
+            if source_chunk != dest_file.read(chunk_size):
+                return False
+            if not source_chunk:
+                return True
+
+
 def meaningful_diff(source_path, dest_path, diff_output=None):
     """Determines whether a patch changed in a 'meaningful' way.
 
@@ -60,14 +162,28 @@ def meaningful_diff(source_path, dest_path, diff_output=None):
     the only changes to a patch-file are around context and index hash
     changes.
 
+    `source_path` may also be a file object, in which case the patch is
+    compared without having to be written to disk first.
+
     `diff_output` is used for testing and makes `source_path` and `dest_path`
     non-applicable fields.
     """
-    if diff_output is None:
+    proc = None
+    if diff_output is None and hasattr(source_path, 'read'):
+        if _same_contents(source_path, dest_path):
+            return False
+
+        source_path.seek(0)
+        proc = subprocess.Popen(['diff', '-U', '0', '-', dest_path],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        diff_output = proc.communicate(source_path.read())[0]
+    elif diff_output is None:
         proc = subprocess.Popen(['diff', '-U', '0', source_path, dest_path],
                                 stdout=subprocess.PIPE)
         diff_output = proc.communicate()[0]
 
+    if proc is not None:
         if proc.returncode == 0:
             return False
         elif proc.returncode != 1:
@@ -98,8 +214,41 @@ def meaningful_diff(source_path, dest_path, diff_output=None):
             else:
                 return True
         else:
-            # Ensure all -index lines have matching +index lines
-            assert last_index_perms is None
+            # A -index line without a matching +index line means more than
+            # the hashes changed
             return True
 
     return False
+
+
+def meaningful_hunks(source, dest, context=3):
+    """Return the unified diff hunks between two versions of a patch,
+    leaving out the ones `meaningful_diff` doesn't consider meaningful.
+
+    Each hunk is a list of lines, starting with its @@ header.
+    """
+    source_lines = source.splitlines(True)
+    dest_lines = dest.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, source_lines, dest_lines,
+                                      autojunk=False)
+
+    hunks = []
+    for group in matcher.get_grouped_opcodes(context):
+        first, last = group[0], group[-1]
+        hunk = ['@@ -%d,%d +%d,%d @@\n' % (
+            first[1] + 1, last[2] - first[1], first[3] + 1,
+            last[4] - first[3])]
+        changes = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                hunk.extend(' %s' % line for line in source_lines[i1:i2])
+                continue
+            removed = ['-%s' % line for line in source_lines[i1:i2]]
+            added = ['+%s' % line for line in dest_lines[j1:j2]]
+            hunk.extend(removed + added)
+            changes.extend(removed + added)
+
+        if meaningful_diff(None, None, diff_output=''.join(changes)):
+            hunks.append(hunk)
+
+    return hunks
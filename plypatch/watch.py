@@ -0,0 +1,194 @@
+"""
+`ply watch` keeps an eye on upstream so broken patches show up early.
+
+Every `interval` seconds the watcher fetches, resolves the upstream ref and,
+if it moved, queues the range of new commits as a single batch; a burst of
+pushes between two polls is therefore simulated once, against its tip. The
+restore itself is simulated in a scratch index, exactly like `ply
+bisect-upstream` does, so the working-repo's checkout is never touched.
+
+Batches wait in a bounded queue. When simulating falls behind, the oldest
+two batches are merged rather than dropped, so every upstream commit is
+still covered by some result.
+
+Each simulated batch appends one JSON object to the results log:
+
+    {"time": 1371486948, "base": "<sha1>", "revision": "<sha1>",
+     "commits": 3, "status": "conflict", "conflicts": ["foo.patch"],
+     "upstream": [], "culprits": [["<sha1>", ["foo.patch"]]]}
+
+`culprits` is only present for batches that broke patches which applied at
+the previous revision, and pins each breakage to a single upstream commit.
+"""
+import collections
+import json
+import os
+import time
+
+from plypatch import git
+
+
+# Number of batches waiting to be simulated before the oldest are merged
+MAX_QUEUE = 16
+
+LOG_NAME = 'watch.jsonl'
+LAST_SEEN_NAME = 'watch-last-seen'
+
+
+class Watcher(object):
+    """Periodically simulate restoring the series onto an upstream ref.
+
+    `remote` is fetched before each poll; with no remote, upstream is
+    fetched as `ply restore` would, unless the working-repo has fetching
+    turned off.
+    """
+
+    def __init__(self, working_repo, ref, remote=None, interval=300,
+                 max_queue=MAX_QUEUE, log_path=None):
+        if max_queue < 2:
+            raise ValueError('max_queue must be at least 2')
+
+        self.working_repo = working_repo
+        self.ref = ref
+        self.remote = remote
+        self.interval = interval
+        self.max_queue = max_queue
+        self.log_path = log_path or working_repo._state_path(LOG_NAME)
+        self.queue = collections.deque()
+        self.stopped = False
+
+    @property
+    def _last_seen_path(self):
+        return self.working_repo._state_path(LAST_SEEN_NAME)
+
+    def _read_last_seen(self):
+        if not os.path.exists(self._last_seen_path):
+            return None
+        with open(self._last_seen_path) as f:
+            return f.read().strip() or None
+
+    def _write_last_seen(self, revision):
+        with open(self._last_seen_path, 'w') as f:
+            f.write('%s\n' % revision)
+
+    def _fetch(self):
+        if self.remote:
+            self.working_repo.fetch(remote=self.remote)
+        elif self.working_repo.fetch_remotes:
+            self.working_repo.fetch_upstream()
+
+    def enqueue(self, base, revision):
+        """Queue the upstream commits in `base`..`revision` as one batch.
+
+        If the queue is full, the two oldest batches are merged into one
+        covering both ranges.
+        """
+        self.queue.append((base, revision))
+        if len(self.queue) > self.max_queue:
+            first_base = self.queue.popleft()[0]
+            self.queue[0] = (first_base, self.queue[0][1])
+
+    def poll(self):
+        """Fetch and queue whatever landed upstream since the last poll.
+
+        Returns whether a new batch was queued.
+        """
+        try:
+            self._fetch()
+        except Exception as e:
+            self._log({'status': 'error', 'error': 'fetch failed: %s' % e})
+            return False
+
+        try:
+            revision = self.working_repo.rev_parse('%s^{commit}' % self.ref)
+        except git.exc.GitException:
+            self._log({'status': 'error',
+                       'error': 'unknown ref %s' % self.ref})
+            return False
+
+        if self.queue:
+            last_seen = self.queue[-1][1]
+        else:
+            last_seen = self._read_last_seen()
+
+        if revision == last_seen:
+            return False
+
+        self.enqueue(last_seen, revision)
+        return True
+
+    def _count_commits(self, base, revision):
+        if not base:
+            return 1
+        try:
+            return len(self.working_repo.rev_list(
+                '%s..%s' % (base, revision), first_parent=True))
+        except git.exc.GitException:
+            # Upstream was rewound past `base`
+            return 1
+
+    def simulate(self, base, revision):
+        """Simulate restoring onto `revision` and return the result that is
+        logged for it.
+        """
+        working_repo = self.working_repo
+        results = working_repo._simulate_restore(revision)[1]
+
+        conflicts = [pn for pn, r in results.iteritems() if r == 'conflict']
+        upstream = [pn for pn, r in results.iteritems() if r == 'upstream']
+
+        entry = {'base': base,
+                 'revision': revision,
+                 'commits': self._count_commits(base, revision),
+                 'status': 'conflict' if conflicts else 'clean',
+                 'conflicts': conflicts,
+                 'upstream': upstream}
+
+        if conflicts and base:
+            try:
+                entry['culprits'] = working_repo.bisect_upstream(base,
+                                                                 revision)
+            except git.exc.GitException:
+                pass
+
+        return entry
+
+    def _log(self, entry):
+        entry = dict(entry, time=int(time.time()))
+        with open(self.log_path, 'a') as f:
+            f.write('%s\n' % json.dumps(entry, sort_keys=True))
+        return entry
+
+    def drain(self):
+        """Simulate every queued batch, oldest first, and return the logged
+        results.
+        """
+        logged = []
+        while self.queue and not self.stopped:
+            base, revision = self.queue[0]
+            logged.append(self._log(self.simulate(base, revision)))
+            self.queue.popleft()
+            self._write_last_seen(revision)
+        return logged
+
+    def run(self, once=False, callback=None):
+        """Poll and simulate until `stop` is called or we're interrupted.
+
+        `callback` is called with each logged result.
+        """
+        try:
+            while not self.stopped:
+                self.poll()
+                for entry in self.drain():
+                    if callback:
+                        callback(entry)
+
+                if once:
+                    break
+
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        self.stopped = True
@@ -1,10 +1,22 @@
+import contextlib
+import cStringIO
 import glob
+import json
 import os
 import re
 import shutil
+import subprocess
+import sys
+import tarfile
+import threading
 import unittest
 
 import plypatch
+from plypatch import cli
+from plypatch import daemon
+from plypatch import jobs
+from plypatch import metrics
+from plypatch import watch
 
 
 class FunctionalTestCase(unittest.TestCase):
@@ -470,6 +482,1239 @@ class FunctionalTestCase(unittest.TestCase):
         with self.assertRaises(plypatch.exc.RestoreInProgress):
             self.working_repo.restore()
 
+    def test_restore_resume(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        with self.assertRaises(plypatch.exc.NothingToResume):
+            self.working_repo.restore(resume=True)
+
+        # Interrupt the restore while it reads the second patch
+        patch_repo = self.working_repo.patch_repo
+        patch_path = patch_repo.patch_path
+
+        def interrupted_patch_path(patch_name):
+            if patch_name == 'Add-exclamation-point.patch':
+                raise KeyboardInterrupt
+            return patch_path(patch_name)
+
+        patch_repo.patch_path = interrupted_patch_path
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.working_repo.restore()
+        finally:
+            del patch_repo.patch_path
+
+        # ...and pretend it was killed right after `git am` committed the
+        # second patch, before the patch could be annotated
+        with patch_path('Add-exclamation-point.patch') as path:
+            self.working_repo.am(path)
+
+        def fetch(*args, **kwargs):
+            self.fail('A resumed restore fetched')
+
+        self.working_repo.fetch = fetch
+        self.working_repo.restore(resume=True)
+
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country!')
+        self.assert_based_on(self.upstream_hash)
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assertEqual(2, len(self.working_repo._applied_patches()))
+        self.assertFalse(os.path.exists(self.working_repo._journal_path))
+
+    def test_resolve_conflict_left_by_previous_release(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of there country. Fin.',
+                          commit_msg='Trunk changed')
+        new_upstream_hash = self.working_repo.get_head_commit_hash()
+
+        with self.assertRaises(plypatch.git.exc.PatchDidNotApplyCleanly):
+            self.working_repo.restore()
+
+        # Older plys kept the conflict in the checkout rather than a journal
+        os.unlink(self.working_repo._journal_path)
+        conflict_path = os.path.join(self.working_repo_path,
+                                     '.patch-conflict')
+        stats_path = os.path.join(self.working_repo_path, '.restore-stats')
+        with open(conflict_path, 'w') as f:
+            f.write('There-Their.patch\n')
+        with open(stats_path, 'w') as f:
+            f.write('1 0\n')
+
+        self.assertEqual('restore-in-progress', self.working_repo.status)
+        self.assertFalse(os.path.exists(conflict_path))
+        self.assertFalse(os.path.exists(stats_path))
+
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country. Fin.')
+        self.working_repo.add('README')
+        self.working_repo.resolve()
+
+        self.assert_based_on(new_upstream_hash)
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        commit_msg = self.patch_repo.log(count=1, pretty='%B')
+        self.assertIn('1 updated', commit_msg)
+
+    def test_restore_delta(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        first_commit = self.working_repo.rev_parse('HEAD^')
+
+        # Nothing changed, so nothing is reapplied. Reapplied commits would
+        # get a different committer date and so a different hash.
+        head = self.working_repo.get_head_commit_hash()
+        os.environ['GIT_COMMITTER_DATE'] = '1371486948 -0500'
+        try:
+            self.working_repo.restore(delta=True)
+            self.assertEqual(head, self.working_repo.get_head_commit_hash())
+
+            # Change the last patch behind the working-repo's back
+            patch_path = os.path.join(self.patch_repo_path,
+                                      'Add-exclamation-point.patch')
+            with open(patch_path) as f:
+                patch = f.read()
+            with open(patch_path, 'w') as f:
+                f.write(patch.replace('country!', 'country?'))
+            self.patch_repo.add('Add-exclamation-point.patch')
+            self.patch_repo.commit(msgs=['Question it'])
+
+            self.working_repo.restore(delta=True)
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country?')
+        self.assertEqual(first_commit, self.working_repo.rev_parse('HEAD^'))
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+    def test_fetch_upstream(self):
+        for remote in ('r1', 'r2'):
+            remote_path = os.path.abspath(os.path.join(self.SANDBOX, remote))
+            subprocess.check_call(['git', 'init', '-q', '--bare',
+                                   remote_path])
+            subprocess.check_call(['git', 'remote', 'add', remote,
+                                   remote_path],
+                                  cwd=self.working_repo_path)
+            subprocess.check_call(['git', 'push', '-q', remote,
+                                   'HEAD:refs/heads/master'],
+                                  cwd=self.working_repo_path)
+            # Pushing updates the remote-tracking ref, which we're after
+            self.working_repo.update_ref('refs/remotes/%s/master' % remote,
+                                         delete=True)
+
+        def fetched(ref):
+            try:
+                self.working_repo.rev_parse(ref)
+            except plypatch.git.exc.GitException:
+                return False
+            return True
+
+        self.working_repo.config('set', config_key='ply.fetch.remotes',
+                                 config_value='r1')
+        self.working_repo.restore()
+        self.assertTrue(fetched('refs/remotes/r1/master'))
+        self.assertFalse(fetched('refs/remotes/r2/master'))
+
+        self.working_repo.config('set', config_key='ply.fetch.remotes',
+                                 config_value='r1 r2')
+        self.working_repo.config('set', config_key='ply.fetch.jobs',
+                                 config_value='2')
+        self.working_repo.fetch_upstream()
+        self.assertTrue(fetched('refs/remotes/r2/master'))
+
+        self.working_repo.config('add', config_key='ply.fetch.refspec',
+                                 config_value='refs/heads/master:refs/narrow')
+        with self.assertRaises(plypatch.exc.FetchConfigInvalid):
+            self.working_repo.fetch_upstream()
+
+        self.working_repo.config('set', config_key='ply.fetch.remotes',
+                                 config_value='r2')
+        self.working_repo.fetch_upstream(background=True).wait()
+        self.assertEqual(self.upstream_hash,
+                         self.working_repo.rev_parse('refs/narrow'))
+
+    def test_failed_fetch_leaves_checkout_alone(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save()
+        head = self.working_repo.get_head_commit_hash()
+
+        # Rewrite the second patch, so a delta restore would rewind to it
+        patch_path = os.path.join(self.patch_repo_path,
+                                  'Add-exclamation-point.patch')
+        with open(patch_path, 'a') as f:
+            f.write('\n')
+        self.patch_repo.add('Add-exclamation-point.patch')
+        self.patch_repo.commit(msgs=['Touch patch'])
+
+        missing_path = os.path.abspath(os.path.join(self.SANDBOX, 'missing'))
+        subprocess.check_call(['git', 'remote', 'add', 'missing',
+                               missing_path], cwd=self.working_repo_path)
+        self.working_repo.config('set', config_key='ply.fetch.remotes',
+                                 config_value='missing')
+
+        with open(os.devnull, 'w') as devnull:
+            stderr = os.dup(2)
+            os.dup2(devnull.fileno(), 2)
+            try:
+                with self.assertRaises(subprocess.CalledProcessError):
+                    self.working_repo.restore(delta=True)
+
+                # A preparation error isn't hidden by the failed fetch
+                self.write_readme('Uncommitted')
+                with self.assertRaises(plypatch.exc.UncommittedChanges):
+                    self.working_repo.restore(delta=True)
+            finally:
+                os.dup2(stderr, 2)
+                os.close(stderr)
+
+        self.assertEqual(head, self.working_repo.get_head_commit_hash())
+        self.assertFalse(os.path.exists(self.working_repo._journal_path))
+
+    def test_restore_keep_going(self):
+        news_path = os.path.join(self.working_repo_path, 'NEWS')
+        with open(news_path, 'w') as f:
+            f.write('Nothing yet.')
+        self.working_repo.add('NEWS')
+        self.working_repo.commit(msgs=['Add NEWS'])
+        upstream_hash = self.working_repo.get_head_commit_hash()
+
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        with open(news_path, 'w') as f:
+            f.write('Something happened.')
+        self.working_repo.add('NEWS')
+        self.working_repo.commit(msgs=['Write NEWS'])
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(upstream_hash)
+        self.working_repo.rollback()
+
+        self.write_readme('Completely different line.',
+                          commit_msg='Upstream changed')
+
+        # Both README patches are set aside and NEWS is written first
+        with self.assertRaises(plypatch.git.exc.PatchDidNotApplyCleanly):
+            self.working_repo.restore(keep_going=True)
+
+        self.assertEqual(['There-Their.patch', 'Add-exclamation-point.patch'],
+                         self.working_repo.deferred_patches)
+        with open(news_path) as f:
+            self.assertEqual('Something happened.', f.read())
+
+        self.write_readme('Completely different line, theirs.')
+        self.working_repo.add('README')
+        with self.assertRaises(plypatch.git.exc.PatchDidNotApplyCleanly):
+            self.working_repo.resolve()
+
+        self.assertEqual(['Add-exclamation-point.patch'],
+                         self.working_repo.deferred_patches)
+        self.working_repo.skip()
+
+        # The commits end up in series order
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assertEqual(['Write NEWS', 'There -> Their'],
+                         self.working_repo.log(
+                             count=2, pretty='%s').strip().split('\n'))
+        self.assert_readme('Completely different line, theirs.')
+        with open(news_path) as f:
+            self.assertEqual('Something happened.', f.read())
+        self.assertEqual(['There-Their.patch', 'Write-NEWS.patch'],
+                         self.patch_repo.series)
+
+    def test_restore_sparse(self):
+        def write(path, contents):
+            path = os.path.join(self.working_repo_path, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+
+        for path in ('src/main.c', 'docs/guide.txt', 'lib/util.c'):
+            write(path, 'Original.')
+            self.working_repo.add(path)
+        self.working_repo.commit(msgs=['Add sources'])
+        upstream_hash = self.working_repo.get_head_commit_hash()
+
+        write('src/main.c', 'Patched.')
+        self.working_repo.add('src/main.c')
+        self.working_repo.commit(msgs=['Patch main'])
+        self.working_repo.save(upstream_hash)
+        self.working_repo.rollback()
+
+        self.working_repo.restore(sparse=True, sparse_paths=['lib'])
+
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        with open(os.path.join(self.working_repo_path, 'src/main.c')) as f:
+            self.assertEqual('Patched.', f.read())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.working_repo_path, 'lib/util.c')))
+        self.assertTrue(os.path.exists(self.readme_path))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.working_repo_path, 'docs/guide.txt')))
+
+        self.working_repo.rollback(full=True)
+
+        self.assertFalse(self.working_repo.sparse_checkout_enabled())
+        self.assertEqual(upstream_hash,
+                         self.working_repo.get_head_commit_hash())
+        with open(os.path.join(self.working_repo_path,
+                               'docs/guide.txt')) as f:
+            self.assertEqual('Original.', f.read())
+
+    def test_range_diff(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        news_path = os.path.join(self.working_repo_path, 'NEWS')
+        with open(news_path, 'w') as f:
+            f.write('Nothing yet.\n')
+        self.working_repo.add('NEWS')
+        self.working_repo.commit(msgs=['Add NEWS'])
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        rev1 = self.patch_repo.get_head_commit_hash()
+
+        def edit_patch(patch_name, old, new):
+            path = os.path.join(self.patch_repo_path, patch_name)
+            with open(path) as f:
+                contents = f.read()
+            self.assertTrue(re.search(old, contents))
+            with open(path, 'w') as f:
+                f.write(re.sub(old, new, contents, count=1))
+            self.patch_repo.add(patch_name)
+
+        # Only index-hash churn
+        edit_patch('There-Their.patch', r'index \w+\.\.\w+',
+                   'index 1234567..89abcde')
+        edit_patch('Add-exclamation-point.patch', 'country!',
+                   'country!!')
+        os.rename(os.path.join(self.patch_repo_path, 'Add-NEWS.patch'),
+                  os.path.join(self.patch_repo_path, 'Add-the-NEWS.patch'))
+        self.patch_repo.rm('Add-NEWS.patch')
+        self.patch_repo.add('Add-the-NEWS.patch')
+        with open(os.path.join(self.patch_repo_path, 'series'), 'w') as f:
+            f.write('Add-the-NEWS.patch\nThere-Their.patch\n'
+                    'Add-exclamation-point.patch\n')
+        self.patch_repo.add('series')
+        self.patch_repo.commit(msgs=['Churn'])
+
+        diff = self.patch_repo.range_diff(rev1, 'HEAD', jobs=2)
+
+        self.assertEqual(
+            [('renamed', 'Add-the-NEWS.patch', 'Add-NEWS.patch'),
+             ('reordered', 'Add-the-NEWS.patch', None),
+             ('changed', 'Add-exclamation-point.patch')],
+            [entry[:2] if entry[0] == 'changed' else entry
+             for entry in diff])
+        hunks = diff[-1][2]
+        self.assertEqual(1, len(hunks))
+        self.assertIn('++Now is the time for all good men to come to the aid'
+                      ' of their country!!\n', hunks[0])
+
+        self.assertEqual([], self.patch_repo.range_diff(rev1, rev1))
+
+    def test_binary_blobs(self):
+        self.working_repo.config('set', config_key='ply.binaryblobs',
+                                 config_value='true')
+        logo = ''.join(chr(i % 256) for i in xrange(4096))
+        logo_path = os.path.join(self.working_repo_path, 'logo.bin')
+        with open(logo_path, 'wb') as f:
+            f.write(logo)
+        self.working_repo.add('logo.bin')
+        self.working_repo.commit(msgs=['Add logo'])
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+
+        patch_path = os.path.join(self.patch_repo_path, 'Add-logo.patch')
+        with open(patch_path) as f:
+            patch = f.read()
+        self.assertIn('GIT binary patch\nply-blob ', patch)
+        self.assertNotIn('literal', patch)
+        blob_names = self.patch_repo.ls_files('blobs')
+        self.assertEqual(1, len(blob_names))
+
+        self.working_repo.rollback()
+        self.working_repo.restore()
+        with open(logo_path, 'rb') as f:
+            self.assertEqual(logo, f.read())
+
+        # Re-saving an unchanged binary rewrites nothing
+        self.working_repo.save(self.upstream_hash)
+        with open(patch_path) as f:
+            self.assertEqual(patch, f.read())
+        self.assertEqual(blob_names, self.patch_repo.ls_files('blobs'))
+
+        self.working_repo.rollback()
+        self.working_repo.restore(patch_rev='HEAD')
+        with open(logo_path, 'rb') as f:
+            self.assertEqual(logo, f.read())
+
+        # Blobs no patch refers to anymore are dropped
+        self.working_repo.rollback()
+        self.working_repo.config('unset', config_key='ply.binaryblobs')
+        self.working_repo.restore()
+        self.working_repo.save(self.upstream_hash)
+        self.assertEqual([], self.patch_repo.ls_files('blobs'))
+        with open(patch_path) as f:
+            self.assertIn('literal', f.read())
+
+    def test_binary_blobs_stored_under_lock(self):
+        self.working_repo.config('set', config_key='ply.binaryblobs',
+                                 config_value='true')
+        logo = ''.join(chr(i % 256) for i in xrange(4096))
+        with open(os.path.join(self.working_repo_path, 'logo.bin'),
+                  'wb') as f:
+            f.write(logo)
+        self.working_repo.add('logo.bin')
+        self.working_repo.commit(msgs=['Add logo'])
+
+        # Another working-repo syncs, dropping unreferenced blobs, after
+        # our patches were formatted but before we get the lock
+        patch_repo = self.working_repo.patch_repo
+        lock = patch_repo.lock
+        blobs_path = os.path.join(self.patch_repo_path, 'blobs')
+
+        synced = []
+
+        @contextlib.contextmanager
+        def contended_lock(exclusive=True):
+            if exclusive and not synced:
+                synced.append(True)
+                self.assertFalse(os.path.exists(blobs_path))
+                with lock():
+                    patch_repo._sync_blobs()
+            with lock(exclusive=exclusive):
+                yield
+
+        patch_repo.lock = contended_lock
+        try:
+            self.working_repo.save(self.upstream_hash)
+        finally:
+            del patch_repo.lock
+
+        self.assertEqual(1, len(self.patch_repo.ls_files('blobs')))
+        self.working_repo.rollback()
+        self.working_repo.restore()
+        with open(os.path.join(self.working_repo_path, 'logo.bin'),
+                  'rb') as f:
+            self.assertEqual(logo, f.read())
+
+    def test_partial_restore(self):
+        news_path = os.path.join(self.working_repo_path, 'NEWS')
+
+        def write_news(txt, commit_msg):
+            with open(news_path, 'w') as f:
+                f.write(txt)
+            self.working_repo.add('NEWS')
+            self.working_repo.commit(msgs=[commit_msg])
+
+        def applied():
+            return [patch_name for _, patch_name
+                    in reversed(self.working_repo._applied_patches())]
+
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        write_news('Nothing yet.', 'Add NEWS')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        write_news('Something happened.', 'Write NEWS')
+        self.working_repo.save(self.upstream_hash)
+        series = ['There-Their.patch', 'Add-NEWS.patch',
+                  'Add-exclamation-point.patch', 'Write-NEWS.patch']
+        self.assertEqual(series, self.patch_repo.series)
+        self.working_repo.rollback()
+
+        self.working_repo.restore(upto='Add-NEWS.patch')
+        self.assertEqual(series[:2], applied())
+        self.assertEqual('some-patches-applied', self.working_repo.status)
+
+        # The patches left out aren't removed by a save
+        self.working_repo.save()
+        self.assertEqual(series, self.patch_repo.series)
+
+        self.working_repo.restore()
+        self.assertEqual(series, applied())
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+        # The patches the exclamation point depends on come along
+        self.working_repo.rollback()
+        self.working_repo.restore(only=['Add-exclamation-point.patch'])
+        self.assertEqual(['There-Their.patch', 'Add-exclamation-point.patch'],
+                         applied())
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country!')
+        self.assertFalse(os.path.exists(news_path))
+
+        # A new patch lands after the patches it followed in the branch
+        with open(os.path.join(self.working_repo_path, 'TODO'), 'w') as f:
+            f.write('Everything.')
+        self.working_repo.add('TODO')
+        self.working_repo.commit(msgs=['Add TODO'])
+        self.working_repo.save()
+        series.append('Add-TODO.patch')
+        self.assertEqual(series, self.patch_repo.series)
+        self.assertEqual('some-patches-applied', self.working_repo.status)
+
+        # Restoring the whole series starts over from upstream
+        self.working_repo.restore()
+        self.assertEqual(series, applied())
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        with open(news_path) as f:
+            self.assertEqual('Something happened.', f.read())
+
+        with self.assertRaises(plypatch.exc.PatchNotInSeries):
+            self.working_repo.restore(only=['missing/'])
+
+    def test_restore_metrics(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        metrics_path = self.working_repo._state_path(metrics.METRICS_NAME)
+        with metrics.recording('restore', lambda: metrics_path):
+            self.working_repo.restore()
+
+        record = metrics.read(metrics_path)[-1]
+        self.assertEqual('restore', record['command'])
+        self.assertEqual(0, record['status'])
+        self.assertEqual(1, record['patches_applied'])
+        self.assertEqual(0, record['conflicts'])
+        self.assertTrue(record['patch_bytes_read'] > 0)
+        self.assertTrue(record['git_commands'] > 0)
+        self.assertTrue(record['wall_time'] >= record['git_time'])
+
+    def test_restore_job(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        events = []
+        job = jobs.Job(self.working_repo, 'restore')
+        job.subscribe(events.append)
+        result = job.run()
+
+        self.assertEqual('ok', result.status)
+        self.assertEqual(['There-Their.patch', 'Add-exclamation-point.patch'],
+                         result.applied)
+        self.assertEqual(job.events, events)
+        phases = [e['phase'] for e in events if e['event'] == 'phase']
+        self.assertEqual(['prepare', 'reset', 'apply', 'commit'],
+                         [phase for phase in phases if phase != 'fetch'])
+        self.assertEqual(set(phases), set(result.timings))
+
+        started = [e for e in events if e['event'] == 'restore-started']
+        self.assertEqual([2], [e['total'] for e in started])
+        self.assertEqual('restore-finished', events[-2]['event'])
+        self.assertEqual('finished', events[-1]['event'])
+        self.assertEqual(result.as_dict(), events[-1]['result'])
+        self.assertIsNone(self.working_repo.progress)
+
+        # A conflict is reported through the result, ready for `resolve`
+        self.working_repo.rollback()
+        self.write_readme('Completely different line.',
+                          commit_msg='Upstream changed')
+        result = jobs.Job(self.working_repo, 'restore').run()
+        self.assertEqual('conflict', result.status)
+        self.assertEqual('There-Their.patch', result.conflict)
+        self.assertTrue(result.three_way_merged)
+        self.assertEqual('restore-in-progress', self.working_repo.status)
+
+        # ...and anything else is raised
+        job = jobs.Job(self.working_repo, 'restore')
+        with self.assertRaises(plypatch.exc.RestoreInProgress):
+            job.run()
+        self.assertEqual('failed', job.result.status)
+        self.assertIn('RestoreInProgress', job.result.error)
+
+    def test_cancel_restore_job(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        job = jobs.Job(self.working_repo, 'restore')
+
+        def cancel_after_first_patch(event):
+            if event['event'] == 'patch-applied':
+                job.cancel()
+
+        job.subscribe(cancel_after_first_patch)
+        job.start()
+        result = job.wait(60)
+
+        self.assertEqual('cancelled', result.status)
+        self.assertEqual(['There-Their.patch'], result.applied)
+        self.assertTrue(os.path.exists(self.working_repo._journal_path))
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country.')
+
+        # A cancelled restore carries on where it stopped
+        result = jobs.Job(self.working_repo, 'restore', resume=True).run()
+        self.assertEqual('ok', result.status)
+        self.assertEqual(['Add-exclamation-point.patch'], result.applied)
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country!')
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assertFalse(os.path.exists(self.working_repo._journal_path))
+
+    def test_bisect_upstream(self):
+        lines = list('ABCDEFGHIJKL')
+
+        def write_lines(commit_msg):
+            self.write_readme('\n'.join(lines) + '\n', commit_msg=commit_msg)
+
+        write_lines('Add A-L')
+        good_hash = self.working_repo.get_head_commit_hash()
+
+        lines[0] = 'a'
+        write_lines('A -> a')
+        lines[5] = 'f'
+        write_lines('F -> f')
+        self.working_repo.save(good_hash)
+        self.working_repo.rollback()
+
+        lines[0], lines[5] = 'A', 'F'
+        lines.append('M')
+        write_lines('Upstream 1')
+        lines.append('N')
+        write_lines('Upstream 2')
+        lines[5] = 'FF'
+        write_lines('Upstream 3: F -> FF')
+        culprit_hash = self.working_repo.get_head_commit_hash()
+        lines.append('O')
+        write_lines('Upstream 4')
+        bad_hash = self.working_repo.get_head_commit_hash()
+
+        culprits = self.working_repo.bisect_upstream(good_hash, bad_hash)
+        self.assertEqual([(culprit_hash, ['F-f.patch'])], culprits)
+
+        # Simulating must leave the working-repo untouched
+        self.assertEqual(bad_hash, self.working_repo.get_head_commit_hash())
+        self.assertFalse(self.working_repo.uncommitted_changes())
+        self.assert_readme('\n'.join(lines) + '\n')
+
+    def test_watch(self):
+        lines = list('ABCDEFGHIJKL')
+
+        def write_lines(commit_msg):
+            self.write_readme('\n'.join(lines) + '\n', commit_msg=commit_msg)
+
+        write_lines('Add A-L')
+        good_hash = self.working_repo.get_head_commit_hash()
+        lines[5] = 'f'
+        write_lines('F -> f')
+        self.working_repo.save(good_hash)
+        self.working_repo.rollback()
+
+        self.working_repo.fetch_remotes = False
+        log_path = os.path.join(self.SANDBOX, 'watch.jsonl')
+        watcher = watch.Watcher(self.working_repo, 'HEAD', log_path=log_path)
+
+        watcher.run(once=True)
+        self.assertFalse(watcher.poll())
+
+        # A burst of upstream commits is simulated as a single batch
+        lines.append('M')
+        write_lines('Upstream 1')
+        lines[5] = 'FF'
+        write_lines('Upstream 2: F -> FF')
+        culprit_hash = self.working_repo.get_head_commit_hash()
+        lines.append('N')
+        write_lines('Upstream 3')
+        bad_hash = self.working_repo.get_head_commit_hash()
+        watcher.run(once=True)
+
+        with open(log_path) as f:
+            results = [json.loads(line) for line in f]
+
+        self.assertEqual(2, len(results))
+        self.assertEqual((good_hash, 'clean', []),
+                         (results[0]['revision'], results[0]['status'],
+                          results[0]['conflicts']))
+        self.assertEqual((good_hash, bad_hash, 3, 'conflict', ['F-f.patch']),
+                         (results[1]['base'], results[1]['revision'],
+                          results[1]['commits'], results[1]['status'],
+                          results[1]['conflicts']))
+        self.assertEqual([[culprit_hash, ['F-f.patch']]],
+                         results[1]['culprits'])
+
+        # When the queue overflows the oldest batches are merged
+        watcher = watch.Watcher(self.working_repo, 'HEAD', max_queue=2,
+                                log_path=log_path)
+        for base, revision in [('a', 'b'), ('b', 'c'), ('c', 'd')]:
+            watcher.enqueue(base, revision)
+        self.assertEqual([('a', 'c'), ('c', 'd')], list(watcher.queue))
+
+    def test_patch_repo_lock(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+
+        other = plypatch.PatchRepo(self.patch_repo_path, quiet=True)
+        other.lock_timeout = 0.2
+
+        # Readers share the lock...
+        with self.patch_repo.lock(exclusive=False):
+            self.assertEqual(['There-Their.patch'], other.series)
+            self.assertEqual('ok', other.check()[0])
+            with self.assertRaises(plypatch.exc.PatchRepoLocked):
+                other.remove_patch('There-Their.patch')
+
+            # ...and can't upgrade to an exclusive lock
+            with self.assertRaises(ValueError):
+                with self.patch_repo.lock():
+                    pass
+
+        # ...but writers exclude everyone, except themselves
+        with self.patch_repo.lock():
+            with self.assertRaises(plypatch.exc.PatchRepoLocked):
+                other.check()
+            self.assertEqual('ok', self.patch_repo.check()[0])
+
+        other.remove_patch('There-Their.patch')
+        self.assertEqual([], self.patch_repo.series)
+
+    def test_index_lock_is_retried(self):
+        index_lock = os.path.abspath(os.path.join(
+            self.patch_repo_path, '.git', 'index.lock'))
+        open(index_lock, 'w').close()
+        timer = threading.Timer(0.3, os.unlink, [index_lock])
+        timer.start()
+        try:
+            with open(os.path.join(self.patch_repo_path, 'foo.patch'),
+                      'w') as f:
+                f.write('foo')
+            self.patch_repo.add('foo.patch')
+        finally:
+            timer.join()
+
+        self.assertTrue(self.patch_repo.uncommitted_changes())
+
+    def test_restore_patch_rev(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        first_rev = self.patch_repo.get_head_commit_hash()
+
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save()
+        patch_head = self.patch_repo.get_head_commit_hash()
+        self.working_repo.rollback()
+
+        revision = self.patch_repo.at(first_rev)
+        try:
+            self.assertEqual(['There-Their.patch'], revision.series)
+            with self.assertRaises(plypatch.exc.PathNotFound):
+                revision.read_patch('Add-exclamation-point.patch')
+        finally:
+            revision.close()
+
+        self.working_repo.restore(patch_rev=first_rev)
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country.')
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+        # The patch-repo is left exactly as it was
+        self.assertEqual(patch_head, self.patch_repo.get_head_commit_hash())
+        self.assertEqual(['There-Their.patch', 'Add-exclamation-point.patch'],
+                         self.patch_repo.series)
+        self.assertFalse(self.patch_repo.uncommitted_changes())
+
+    def test_restore_into_worktree(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        worktree_path = os.path.join(self.SANDBOX, 'worktree')
+        worktree = self.working_repo.worktree(worktree_path,
+                                              base=self.upstream_hash)
+        worktree.restore()
+
+        with open(os.path.join(worktree_path, 'README')) as f:
+            self.assertEqual('Now is the time for all good men to come to the'
+                             ' aid of their country.', f.read())
+        self.assertEqual('all-patches-applied', worktree.status)
+
+        # Main checkout is left alone
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of there country.')
+        self.assertEqual(self.upstream_hash,
+                         self.working_repo.get_head_commit_hash())
+        self.assertEqual('no-patches-applied', self.working_repo.status)
+
+        # Reusing the worktree resets it to the requested base
+        worktree = self.working_repo.worktree(worktree_path,
+                                              base=self.upstream_hash)
+        self.assertEqual('no-patches-applied', worktree.status)
+
+    def test_worktree_must_be_a_worktree(self):
+        head = self.working_repo.get_head_commit_hash()
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+
+        # A plain directory inside the checkout would resolve to the main
+        # worktree, which must not be reset
+        build_path = os.path.join(self.working_repo_path, 'build')
+        os.mkdir(build_path)
+        with self.assertRaises(plypatch.exc.NotAWorktree):
+            self.working_repo.worktree(build_path, base=head)
+        self.assertNotEqual(head, self.working_repo.get_head_commit_hash())
+
+    def test_conflict_state_is_per_worktree(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        worktree_path = os.path.join(self.SANDBOX, 'worktree')
+        worktree = self.working_repo.worktree(worktree_path)
+        with open(os.path.join(worktree_path, 'README'), 'w') as f:
+            f.write('Completely different line.')
+        worktree.add('README')
+        worktree.commit(msgs=['Upstream changed'])
+
+        with self.assertRaises(plypatch.git.exc.PatchDidNotApplyCleanly):
+            worktree.restore()
+
+        self.assertEqual('restore-in-progress', worktree.status)
+        self.assertEqual('no-patches-applied', self.working_repo.status)
+
+        self.working_repo.restore()
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+    def test_export(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        export_path = os.path.join(self.SANDBOX, 'export')
+        self.working_repo.export(format='dir', output=export_path)
+        with open(os.path.join(export_path, 'README')) as f:
+            self.assertEqual('Now is the time for all good men to come to the'
+                             ' aid of their country.', f.read())
+
+        tar_path = os.path.join(self.SANDBOX, 'export.tar')
+        self.working_repo.export(format='tar', output=tar_path)
+        with tarfile.open(tar_path) as archive:
+            self.assertEqual('Now is the time for all good men to come to the'
+                             ' aid of their country.',
+                             archive.extractfile('README').read())
+
+        # Exporting never touches the checkout
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of there country.')
+        self.assertFalse(self.working_repo.uncommitted_changes())
+
+    def test_export_reuses_restore_result(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+
+        patch_head = self.patch_repo.get_head_commit_hash()
+        self.assertEqual(
+            self.working_repo.rev_parse('HEAD^{tree}'),
+            self.working_repo._cached_restore_tree(self.upstream_hash,
+                                                   patch_head))
+
+    def test_export_with_conflicts(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+        self.write_readme('Completely different line.',
+                          commit_msg='Upstream changed')
+
+        with self.assertRaises(plypatch.exc.PatchesDidNotApply) as cm:
+            self.working_repo.export(
+                format='tar', output=os.path.join(self.SANDBOX, 'x.tar'))
+
+        self.assertEqual(['There-Their.patch'], cm.exception.patch_names)
+
+    def test_export_patch(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        # User diff config mustn't leak into the exported patch
+        self.working_repo.config('set', config_key='diff.noprefix',
+                                 config_value='true')
+        self.working_repo.config('set', config_key='color.ui',
+                                 config_value='always')
+
+        combined_path = os.path.join(self.SANDBOX, 'combined.diff')
+        self.working_repo.export_patch('combined', output=combined_path)
+        with open(combined_path) as f:
+            combined = f.read()
+        self.assertIn('--- a/README\n+++ b/README\n', combined)
+        self.assertNotIn('\x1b[', combined)
+        self.assertIn('-Now is the time for all good men to come to the aid'
+                      ' of there country.', combined)
+        self.assertIn('+Now is the time for all good men to come to the aid'
+                      ' of their country!', combined)
+
+        mbox_path = os.path.join(self.SANDBOX, 'series.mbox')
+        self.working_repo.export_patch('mbox', output=mbox_path)
+        with open(mbox_path) as f:
+            mbox = f.read()
+        self.assertEqual(2, mbox.count('From ply '))
+        self.assertLess(mbox.index('Subject: There -> Their'),
+                        mbox.index('Subject: Add exclamation point!'))
+
+        # Second export is served from the patch-repo's cache
+        cache_dir = os.path.join(self.patch_repo.git_dir, 'ply-cache')
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+        self.working_repo.export_patch('mbox', output=mbox_path)
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+    def test_fast_apply_matches_git_am(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        os.mkdir(os.path.join(self.working_repo_path, 'docs'))
+        with open(os.path.join(self.working_repo_path, 'docs', 'NEWS'),
+                  'w') as f:
+            f.write('Nothing new.\n')
+        self.working_repo.add('docs/NEWS')
+        self.working_repo.commit(msgs=['Add NEWS', 'With a longer body.'])
+        self.working_repo.save(self.upstream_hash)
+
+        os.environ['GIT_COMMITTER_DATE'] = '1371486948 -0500'
+        try:
+            self.working_repo.rollback()
+            self.working_repo.restore()
+            fast_hash = self.working_repo.get_head_commit_hash()
+            reflog = self.working_repo.log(cmd_arg='-g', count=1,
+                                           pretty='%gs')
+            self.assertEqual('ply: fast-apply', reflog.strip())
+
+            self.working_repo.config('add', config_key='ply.fastapply',
+                                     config_value='false')
+            self.working_repo.rollback()
+            self.working_repo.restore()
+            self.assertEqual(fast_hash,
+                             self.working_repo.get_head_commit_hash())
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country.')
+        self.assertFalse(self.working_repo.uncommitted_changes())
+
+    def test_fast_apply_falls_back_when_checkout_is_blocked(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        new_path = os.path.join(self.working_repo_path, 'NEW')
+        with open(new_path, 'w') as f:
+            f.write('New file.\n')
+        self.working_repo.add('NEW')
+        self.working_repo.commit(msgs=['Add NEW'])
+        self.working_repo.save(self.upstream_hash)
+        self.working_repo.rollback()
+
+        # An untracked file is in the way of checking out the fast path's
+        # commits, so the patches are replayed through `git am`
+        with open(new_path, 'w') as f:
+            f.write('Untracked.\n')
+
+        with self.assertRaises(plypatch.git.exc.PatchDidNotApplyCleanly):
+            self.working_repo.restore()
+
+        self.assertEqual('restore-in-progress', self.working_repo.status)
+        self.assertEqual('There -> Their', self.working_repo.log(
+            count=1, pretty='%s').strip())
+        with self.assertRaises(plypatch.git.exc.GitException):
+            self.working_repo.rev_parse('refs/ply/fast-apply')
+
+        self.working_repo.abort()
+        os.unlink(new_path)
+        self.working_repo.restore()
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+    def test_save_writes_only_changed_patches(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        long_subject = 'A very long subject line that format-patch will' \
+                       ' truncate when naming the patch file'
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg=long_subject)
+
+        # Patch names match the files format-patch would have written
+        filenames = self.working_repo.format_patch(
+            'HEAD~2', keep_subject=True, no_numbered=True, no_stat=True)
+        for filename in filenames:
+            os.unlink(os.path.join(self.working_repo_path, filename))
+        expected = [filename.split('-', 1)[1] for filename in filenames]
+
+        self.working_repo.save(self.upstream_hash)
+        self.assertEqual(expected, self.patch_repo.series)
+        self.assertEqual(['.git', 'README'],
+                         sorted(os.listdir(self.working_repo_path)))
+
+        # Saving again leaves the unchanged patch files alone
+        patch_path = os.path.join(self.patch_repo_path, expected[0])
+        before = os.stat(patch_path)
+        self.working_repo.save()
+        after = os.stat(patch_path)
+        self.assertEqual((before.st_ino, before.st_mtime),
+                         (after.st_ino, after.st_mtime))
+        self.assertEqual(expected, self.patch_repo.series)
+
+    def test_save_with_jobs_matches_serial_save(self):
+        for idx in range(6):
+            self.write_readme('\nLine %d' % idx, mode='a',
+                              commit_msg='Add line %d' % idx)
+        self.working_repo.save(self.upstream_hash, jobs=3)
+        self.assertEqual(['Add-line-%d.patch' % idx for idx in range(6)],
+                         self.patch_repo.series)
+        commit_msg = self.patch_repo.log(count=1, pretty='%B')
+        self.assertIn('added 6, updated 0, removed 0', commit_msg)
+
+        # Change one patch in the middle and drop the last one
+        self.working_repo.reset('HEAD~3', hard=True)
+        self.write_readme('\nLine 3 changed', mode='a',
+                          commit_msg='Add line 3')
+        self.write_readme('\nLine 4', mode='a', commit_msg='Add line 4')
+        self.working_repo.save(jobs=3)
+        self.assertEqual(['Add-line-%d.patch' % idx for idx in range(5)],
+                         self.patch_repo.series)
+        commit_msg = self.patch_repo.log(count=1, pretty='%B')
+        self.assertIn('added 0, updated 2, removed 1', commit_msg)
+
+    def test_save_with_jobs_classifies_under_lock(self):
+        for idx in range(4):
+            self.write_readme('\nLine %d' % idx, mode='a',
+                              commit_msg='Add line %d' % idx)
+        self.working_repo.save(self.upstream_hash, jobs=2)
+
+        # Another working-repo rewrites a patch after ours were formatted
+        # but before we get the lock
+        patch_repo = self.working_repo.patch_repo
+        lock = patch_repo.lock
+        patch_path = os.path.join(self.patch_repo_path, 'Add-line-2.patch')
+
+        rewritten = []
+
+        @contextlib.contextmanager
+        def contended_lock(exclusive=True):
+            if exclusive and not rewritten:
+                rewritten.append(True)
+                with open(patch_path, 'a') as f:
+                    f.write('rewritten\n')
+                patch_repo.add('Add-line-2.patch')
+                patch_repo.commit(msgs=['Concurrent save'])
+            with lock(exclusive=exclusive):
+                yield
+
+        patch_repo.lock = contended_lock
+        try:
+            self.working_repo.save(jobs=2)
+        finally:
+            del patch_repo.lock
+
+        with open(patch_path) as f:
+            self.assertNotIn('rewritten', f.read())
+        commit_msg = self.patch_repo.log(count=1, pretty='%B')
+        self.assertIn('added 0, updated 1, removed 0', commit_msg)
+
+    def test_save_rewrites_commit_messages_in_place(self):
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country!',
+                          commit_msg='Add exclamation point!')
+        trees = self.working_repo.log(count=2, pretty='%T')
+        readme_mtime = os.stat(self.readme_path).st_mtime
+
+        self.working_repo.save(self.upstream_hash)
+
+        # Same trees, annotated messages and the worktree wasn't touched
+        self.assertEqual(trees, self.working_repo.log(count=2, pretty='%T'))
+        self.assertEqual(
+            'Add exclamation point!\n\n'
+            'Ply-Patch: Add-exclamation-point.patch',
+            self.working_repo.log(count=1, pretty='%B').strip())
+        self.assertEqual(readme_mtime, os.stat(self.readme_path).st_mtime)
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assert_based_on(self.upstream_hash)
+
+        # Saving again with nothing changed leaves the commits alone
+        head = self.working_repo.get_head_commit_hash()
+        self.working_repo.save()
+        self.assertEqual(head, self.working_repo.get_head_commit_hash())
+
+    def test_notes_annotations(self):
+        self.working_repo.config('set', config_key='ply.annotations',
+                                 config_value='notes')
+        self.write_readme('Now is the time for all good men to come to the'
+                          ' aid of their country.',
+                          commit_msg='There -> Their')
+        self.working_repo.save(self.upstream_hash)
+
+        commit_msg = self.working_repo.log(count=1, pretty='%B')
+        self.assertNotIn('Ply-Patch', commit_msg)
+        self.assertEqual('There-Their.patch', self.working_repo.log(
+            count=1, pretty='%N', cmd_arg='--notes=ply').strip())
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assert_based_on(self.upstream_hash)
+
+        # Restore annotates through notes too, dropping the notes of the
+        # commits that were rolled back
+        try:
+            for idx in range(3):
+                os.environ['GIT_COMMITTER_DATE'] = '%d -0500' % (
+                    1371486948 + idx)
+                self.working_repo.rollback()
+                self.working_repo.restore()
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+        self.assertNotIn('Ply-Patch',
+                         self.working_repo.log(count=1, pretty='%B'))
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+        self.assertEqual(1, len(self.working_repo.notes_list(
+            ref=plypatch.NOTES_REF)))
+
+        # Migrate to commit messages and back
+        self.assertEqual(1, self.working_repo.migrate_annotations('message'))
+        self.assertIn('Ply-Patch: There-Their.patch',
+                      self.working_repo.log(count=1, pretty='%B'))
+        self.assertEqual('all-patches-applied', self.working_repo.status)
+
+        self.assertEqual(1, self.working_repo.migrate_annotations('notes'))
+        self.assertNotIn('Ply-Patch',
+                         self.working_repo.log(count=1, pretty='%B'))
+
+        working_repo = plypatch.WorkingRepo(self.working_repo_path)
+        self.assertEqual('notes', working_repo.annotations)
+        self.assertEqual('all-patches-applied', working_repo.status)
+        self.assert_readme('Now is the time for all good men to come to the'
+                           ' aid of their country.')
+
+    def test_daemon(self):
+        metrics_path = self.working_repo._state_path(metrics.METRICS_NAME)
+        server = daemon.Daemon(self.working_repo_path, cli.build_parser)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertTrue(server.listening.wait(10))
+            self.assertEqual((1, 'No patches applied\n'),
+                             daemon.request(['status'],
+                                            path=self.working_repo_path))
+
+            # Saving applies a patch, which the daemon has to notice
+            self.write_readme('Now is the time for all good men to come to'
+                              ' the aid of their country.',
+                              commit_msg='There -> Their')
+            self.working_repo.save(self.upstream_hash)
+            self.assertEqual((1, 'All patches applied\n'),
+                             daemon.request(['status'],
+                                            path=self.working_repo_path))
+
+            # Anything that isn't read-only is left to the client
+            self.assertIsNone(daemon.request(['rollback'],
+                                             path=self.working_repo_path))
+
+            # Commands the daemon answers are still recorded, by the client
+            self.assertEqual((1, 'All patches applied\n'),
+                             self._run_cli(['status']))
+            records = metrics.read(metrics_path)
+            self.assertEqual([('status', 1)], [(r['command'], r['status'])
+                                              for r in records])
+        finally:
+            server.stop()
+            thread.join()
+
+        self.assertFalse(os.path.exists(server.socket_path))
+        self.assertIsNone(daemon.request(['status'],
+                                         path=self.working_repo_path))
+
+        # ...and only once when there's no daemon to ask
+        self.assertEqual((1, 'All patches applied\n'),
+                         self._run_cli(['status']))
+        self.assertEqual(2, len(metrics.read(metrics_path)))
+
+    def _run_cli(self, argv):
+        """Run `ply` in the working-repo, returning its exit code and
+        output.
+        """
+        saved = sys.argv, sys.stdout, os.getcwd()
+        sys.argv = ['ply'] + argv
+        sys.stdout = cStringIO.StringIO()
+        os.chdir(self.working_repo_path)
+        try:
+            cli.main()
+            code = 0
+        except SystemExit as e:
+            code = e.code
+        finally:
+            output = sys.stdout.getvalue()
+            sys.argv, sys.stdout = saved[:2]
+            os.chdir(saved[2])
+        return code, output
+
 
 if __name__ == '__main__':
     unittest.main()
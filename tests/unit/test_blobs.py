@@ -0,0 +1,78 @@
+import cStringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+from plypatch import blobs
+
+
+class BlobsTestCase(unittest.TestCase):
+    PATCH = """\
+From ply Mon Sep 17 00:00:00 2001
+Subject: Add logo
+
+diff --git a/logo.bin b/logo.bin
+new file mode 100644
+index 0000000..7d9cb5a
+GIT binary patch
+literal 16
+XcmZQzWMXDvWn<^y<l^Sx<>TiU2m=5BBLDyZ
+
+literal 0
+HcmV?d00001
+
+diff --git a/README b/README
+index 3a9479c..d1fa4b9 100644
+--- a/README
++++ b/README
+@@ -1 +1 @@
+-Foo
++Bar
+-- 
+1.8.3
+
+"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deflate(self, patch):
+        output = cStringIO.StringIO()
+        deflater = blobs.Deflater(output, self.path)
+        # Written in odd-sized pieces, the way the normalizer writes lines
+        for idx in xrange(0, len(patch), 7):
+            deflater.write(patch[idx:idx + 7])
+        deflater.close()
+        return output.getvalue()
+
+    def read_blob(self, blob_hash):
+        with open(os.path.join(self.path, blobs.blob_name(blob_hash))) as f:
+            return f.read()
+
+    def test_round_trip(self):
+        deflated = self.deflate(self.PATCH)
+
+        self.assertNotIn('literal', deflated)
+        self.assertIn('diff --git a/README b/README\n', deflated)
+        blob_hashes = blobs.references(deflated.splitlines(True))
+        self.assertEqual(1, len(blob_hashes))
+        self.assertEqual(
+            self.PATCH,
+            ''.join(blobs.inflate(deflated.splitlines(True),
+                                  self.read_blob)))
+
+    def test_same_payload_same_blob(self):
+        self.assertEqual(self.deflate(self.PATCH), self.deflate(self.PATCH))
+        self.assertEqual(1, len(os.listdir(
+            os.path.join(self.path, blobs.BLOBS_DIR))))
+
+    def test_text_patch_unchanged(self):
+        patch = self.PATCH.split('diff --git a/README')[0].split(
+            'diff --git a/logo.bin')[0]
+        self.assertEqual(patch, self.deflate(patch))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, blobs.BLOBS_DIR)))
@@ -0,0 +1,95 @@
+import unittest
+
+from plypatch import fast_apply
+from plypatch import utils
+
+
+class FastApplyTestCase(unittest.TestCase):
+    PATCH = """\
+From: Rick Harris <rconradharris@gmail.com>
+Date: Mon, 17 Jun 2013 11:35:48 -0500
+Subject: Bar
+
+Longer description.
+
+
+diff --git a/README b/README
+index 3bd1f0e..d4b7b8d 100644
+--- a/README
++++ b/README
+@@ -1,3 +1,3 @@
+ foo
+-bar
++baz
+ qux
+--
+1.8.3.1.245.g39fd762
+
+"""
+
+    def test_parse_mail(self):
+        name, email, date, message, patch_lines = fast_apply.parse_mail(
+            self.PATCH)
+        self.assertEqual('Rick Harris', name)
+        self.assertEqual('rconradharris@gmail.com', email)
+        self.assertEqual('1371486948 -0500', date)
+        self.assertEqual('Bar\n\nLonger description.\n', message)
+        self.assertEqual('diff --git a/README b/README', patch_lines[0])
+
+    def test_parse_mail_unsupported_subject(self):
+        patch = self.PATCH.replace('Subject: Bar', 'Subject: [PATCH] Bar')
+        with self.assertRaises(fast_apply.Unsupported):
+            fast_apply.parse_mail(patch)
+
+    def test_parse_mail_unsupported_encoding(self):
+        patch = self.PATCH.replace('Subject: Bar', 'Subject: =?UTF-8?q?B=C3?=')
+        with self.assertRaises(fast_apply.Unsupported):
+            fast_apply.parse_mail(patch)
+
+    def test_apply(self):
+        patch_lines = fast_apply.parse_mail(self.PATCH)[4]
+        file_patches = fast_apply.parse_diff(patch_lines)
+        self.assertEqual(['README'], [fp.path for fp in file_patches])
+        self.assertEqual('foo\nbaz\nqux\n', fast_apply.apply_hunks(
+            'foo\nbar\nqux\n', file_patches[0].hunks))
+
+    def test_apply_needs_offset(self):
+        patch_lines = fast_apply.parse_mail(self.PATCH)[4]
+        file_patches = fast_apply.parse_diff(patch_lines)
+        with self.assertRaises(fast_apply.Unsupported):
+            fast_apply.apply_hunks('new\nfoo\nbar\nqux\n',
+                                   file_patches[0].hunks)
+
+    def test_apply_no_newline_at_end_of_file(self):
+        patch_lines = """\
+diff --git a/README b/README
+index 3bd1f0e..d4b7b8d 100644
+--- a/README
++++ b/README
+@@ -1 +1 @@
+-foo
+\\ No newline at end of file
++bar
+""".split('\n')
+        file_patches = fast_apply.parse_diff(patch_lines)
+        self.assertEqual('bar\n', fast_apply.apply_hunks(
+            'foo', file_patches[0].hunks))
+
+    def test_rename_unsupported(self):
+        patch_lines = """\
+diff --git a/README b/README2
+similarity index 100%
+rename from README
+rename to README2
+""".split('\n')
+        with self.assertRaises(fast_apply.Unsupported):
+            fast_apply.parse_diff(patch_lines)
+
+    def test_blob_hash(self):
+        # echo foo | git hash-object --stdin
+        self.assertEqual('257cc5642cb1a054f08cc83f2d943e56fd3ebe99',
+                         fast_apply.blob_hash('foo\n'))
+
+    def test_stripspace(self):
+        self.assertEqual('Subject\n\nBody  line\n', utils.stripspace(
+            '\n\nSubject  \n\n\n\nBody  line\t\n\n'))
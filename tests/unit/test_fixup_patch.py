@@ -1,9 +1,81 @@
+import cStringIO
 import unittest
 
 import plypatch
 from plypatch import fixup_patch
 
 
+# List-based reference implementation of each fixup, which the streaming
+# `PatchNormalizer` must match byte for byte
+
+
+def _replace_from_sha1(lines):
+    """The SHA1 on the 'From' line of the patch will differ each time the
+    patch file is regenerated. To keep this from causing chatty diffs,
+    replace the SHA1 with a hardcoded value.
+    """
+    for line_idx, line in enumerate(lines):
+        if line.startswith('From'):
+            break
+    else:
+        raise Exception("Malformed patch: 'From' not found")
+
+    parts = lines[line_idx].split(' ')
+    parts[1] = fixup_patch.FROM_SHA1_VALUE
+
+    lines[line_idx] = ' '.join(parts)
+
+
+def _replace_git_version(lines):
+    """The version of git is embedded in the patch which will differ causing
+    chatty-diffs and unecessary conflicts.
+
+    It's terribly evil, but hardcoding this is the easiest way to avoid these
+    conflicts.
+    """
+    for reverse_line_idx, line in enumerate(reversed(lines)):
+        if not line:
+            continue
+        if line[0].isdigit() and '.' in line:
+            break
+    else:
+        raise Exception("Malformed patch: Git version not found")
+
+    # The last line counting backwards (0) becomes -(0) - 1 which becomes -1
+    # counting foward
+    line_idx = -reverse_line_idx - 1
+    lines[line_idx] = fixup_patch.PATCH_GIT_VERSION
+
+
+def _remove_ply_patch_annotation(lines):
+    match_idxs = []
+    for idx, line in enumerate(lines):
+        if 'Ply-Patch:' in line:
+            match_idxs.append(idx)
+
+    for idx in reversed(match_idxs):
+        del lines[idx]
+
+
+def _remove_trailing_extra_blank_lines_from_subject(lines):
+    """Different versions of git will output different amounts of trailing
+    whitespace at the end of a subject headers, so we normalize it by only
+    allowing a single trailing blank line.
+    """
+    for idx, line in enumerate(lines):
+        if line.startswith('diff --git'):
+            break
+    else:
+        return
+
+    if idx < 2:
+        return
+
+    # If we have two blanks above first `diff --git` remove one of them
+    if not lines[idx - 1].strip() and not lines[idx - 2].strip():
+        del lines[idx - 1]
+
+
 class FixupPatchTestCase(unittest.TestCase):
     ORIGINAL = """\
 From 15f7e0465065ad2140c0a3bcb45a74cb99763a14 Mon Sep 17 00:00:00 2001
@@ -82,7 +154,7 @@ index bc56c4d..ebd7525 100644
 1.8.3.1.245.g39fd762
 
 """
-        self.assertReplacement(fixup_patch._replace_from_sha1,
+        self.assertReplacement(_replace_from_sha1,
                                expected)
 
 
@@ -107,7 +179,7 @@ index bc56c4d..ebd7525 100644
 1.8.3
 
 """
-        self.assertReplacement(fixup_patch._replace_git_version,
+        self.assertReplacement(_replace_git_version,
                                expected)
 
     def test_remove_ply_patch_annotation(self):
@@ -130,7 +202,7 @@ index bc56c4d..ebd7525 100644
 1.8.3.1.245.g39fd762
 
 """
-        self.assertReplacement(fixup_patch._remove_ply_patch_annotation,
+        self.assertReplacement(_remove_ply_patch_annotation,
                                expected)
 
     def test_remove_trailing_extra_blank_lines_from_subject(self):
@@ -153,5 +225,54 @@ index bc56c4d..ebd7525 100644
 1.8.3.1.245.g39fd762
 
 """
-        func = fixup_patch._remove_trailing_extra_blank_lines_from_subject
+        func = _remove_trailing_extra_blank_lines_from_subject
         self.assertReplacement(func, expected)
+
+    def _list_fixup_patch(self, original):
+        lines = original.split('\n')
+        _replace_from_sha1(lines)
+        _replace_git_version(lines)
+        _remove_ply_patch_annotation(lines)
+        _remove_trailing_extra_blank_lines_from_subject(lines)
+        return '\n'.join(lines)
+
+    def test_streaming_matches_list_fixups(self):
+        originals = [
+            self.ORIGINAL,
+            self.ORIGINAL.rstrip('\n'),
+            self.ORIGINAL.replace('Subject: Bar\n', 'Subject: Bar\n\n\n'),
+            self.ORIGINAL.replace('Subject: Bar\n\n',
+                                  'Subject: Bar\n\n2.0 released.\n'),
+            self.ORIGINAL.replace('1.8.3.1.245.g39fd762',
+                                  '2.1 Ply-Patch: foo.patch'),
+            self.ORIGINAL.replace('Ply-Patch: foo.patch\n', ''),
+        ]
+
+        for original in originals:
+            expected = self._list_fixup_patch(original)
+            self.assertLongMatch(expected, fixup_patch.fixup_patch(original))
+
+            # Feeding a byte at a time must give the same result
+            output = cStringIO.StringIO()
+            normalizer = fixup_patch.PatchNormalizer(output)
+            for c in original:
+                normalizer.feed(c)
+            normalizer.close()
+            self.assertLongMatch(expected, output.getvalue())
+
+    def test_streaming_spools_held_lines(self):
+        original = self.ORIGINAL.replace(
+            'Subject: Bar\n\n', 'Subject: Bar\n\n2.0 released.\n')
+        original = original.replace('+Bar\n', '+Bar\n' * 1000)
+
+        from_file = cStringIO.StringIO(original)
+        to_file = cStringIO.StringIO()
+        old_max_size = fixup_patch.SPOOL_MAX_SIZE
+        fixup_patch.SPOOL_MAX_SIZE = 16
+        try:
+            fixup_patch.fixup_patch_file(from_file, to_file)
+        finally:
+            fixup_patch.SPOOL_MAX_SIZE = old_max_size
+
+        self.assertLongMatch(self._list_fixup_patch(original),
+                             to_file.getvalue())
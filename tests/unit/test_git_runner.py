@@ -0,0 +1,58 @@
+import subprocess
+import unittest
+
+from plypatch import git
+from plypatch.git import exc
+
+
+class GitRunnerTestCase(unittest.TestCase):
+    def test_lines(self):
+        command = git.Command(['sh', '-c', 'printf "a\\nb\\nc"'])
+        self.assertEqual(['a\n', 'b\n', 'c'], list(command.lines()))
+        self.assertEqual(0, command.returncode)
+
+    def test_input(self):
+        data = 'x' * 1024 * 1024
+        self.assertEqual(data, git.check_output(['cat'], input=data))
+
+    def test_stderr_tail_is_bounded(self):
+        command = git.Command(
+            ['sh', '-c', 'head -c 200000 /dev/zero | tr "\\0" e >&2; '
+                         'echo end >&2; exit 3'],
+            echo=False)
+        self.assertEqual('', command.read())
+        self.assertEqual(3, command.returncode)
+        stderr = command.stderr.getvalue()
+        self.assertEqual(git.STDERR_LIMIT, len(stderr))
+        self.assertTrue(stderr.endswith('eeend\n'))
+
+    def test_timeout(self):
+        with self.assertRaises(exc.CommandTimedOut):
+            git.run(['sleep', '10'], timeout=0.2)
+
+    def test_closing_early_kills_command(self):
+        command = git.Command(['yes'])
+        chunks = command.chunks()
+        next(chunks)
+        chunks.close()
+        self.assertIsNotNone(command.returncode)
+
+    def test_check_call_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            git.check_call(['false'])
+
+    def test_check_output_failure(self):
+        with self.assertRaises(exc.GitException):
+            git.check_output(['sh', '-c', 'echo oops >&2; exit 1'],
+                             echo=False)
+
+    def test_interactive_commands_are_not_timed_out(self):
+        old_timeout = git.COMMAND_TIMEOUT
+        git.COMMAND_TIMEOUT = 0.1
+        try:
+            git.check_call_interactive(['sleep', '0.3'])
+        finally:
+            git.COMMAND_TIMEOUT = old_timeout
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            git.check_call_interactive(['false'])
@@ -0,0 +1,34 @@
+import cStringIO
+import json
+import unittest
+
+from plypatch import jobs
+
+
+class ProgressTestCase(unittest.TestCase):
+    def test_text_progress(self):
+        stream = cStringIO.StringIO()
+        progress = jobs.TextProgress(stream)
+        progress({'event': 'patch-applied', 'patch': 'resolved.patch'})
+        progress({'event': 'restore-started', 'total': 3, 'done': 1})
+        progress({'event': 'patch-started', 'patch': 'a.patch'})
+        progress({'event': 'patch-applied', 'patch': 'a.patch'})
+        progress({'event': 'patch-removed', 'patch': 'b.patch',
+                  'reason': 'upstream'})
+        progress({'event': 'restore-finished'})
+        self.assertEqual('\rRestoring 2/3\rRestoring 3/3\n',
+                         stream.getvalue())
+
+    def test_jsonl_progress(self):
+        stream = cStringIO.StringIO()
+        progress = jobs.JsonlProgress(stream)
+        events = [{'event': 'patch-started', 'patch': 'a.patch'},
+                  {'event': 'phase', 'phase': 'apply', 'duration': 0.5}]
+        for event in events:
+            progress(event)
+        self.assertEqual(events, [json.loads(line) for line
+                                  in stream.getvalue().splitlines()])
+
+    def test_unknown_operation(self):
+        with self.assertRaises(ValueError):
+            jobs.Job(None, 'save')
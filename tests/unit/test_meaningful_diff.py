@@ -57,3 +57,18 @@ class MeaningfulDiffTestCase(unittest.TestCase):
         meaningful = utils.meaningful_diff('notused', 'notused',
                                            diff_output=diff_output)
         self.assertEqual(True, meaningful)
+
+    def test_meaningful_hunks(self):
+        lines = ['line %d\n' % i for i in xrange(20)]
+        source = ''.join(['index 1111111..2222222 100644\n'] + lines)
+        dest_lines = list(lines)
+        dest_lines[15] = 'changed\n'
+        dest = ''.join(['index 3333333..4444444 100644\n'] + dest_lines)
+
+        hunks = utils.meaningful_hunks(source, dest)
+        self.assertEqual(1, len(hunks))
+        self.assertEqual('@@ -14,7 +14,7 @@\n', hunks[0][0])
+        self.assertIn('-line 15\n', hunks[0])
+        self.assertIn('+changed\n', hunks[0])
+
+        self.assertEqual([], utils.meaningful_hunks(source, source))
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from plypatch import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, metrics.METRICS_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, metrics.percentile(values, 50))
+        self.assertEqual(99, metrics.percentile(values, 99))
+        self.assertEqual(7, metrics.percentile([7], 90))
+
+    def test_count_outside_recording_is_a_noop(self):
+        metrics.count('patches_applied')
+        with metrics.git_command():
+            pass
+
+    def test_recording(self):
+        with self.assertRaises(SystemExit):
+            with metrics.recording('restore', lambda: self.path):
+                metrics.count('patches_applied', 3)
+                with metrics.git_command():
+                    with metrics.git_command():
+                        pass
+                raise SystemExit(1)
+
+        with metrics.recording('status', lambda: self.path):
+            pass
+
+        restore, status = metrics.read(self.path)
+        self.assertEqual(('restore', 1, 3, 2), (
+            restore['command'], restore['status'],
+            restore['patches_applied'], restore['git_commands']))
+        self.assertEqual(('status', 0), (status['command'],
+                                         status['status']))
+
+    def test_rotation(self):
+        orig_max_bytes = metrics.MAX_BYTES
+        metrics.MAX_BYTES = 200
+        try:
+            for idx in range(5):
+                metrics.append(self.path, {'command': 'status',
+                                           'wall_time': idx, 'status': 0,
+                                           'padding': 'x' * 50})
+        finally:
+            metrics.MAX_BYTES = orig_max_bytes
+
+        self.assertTrue(os.path.exists('%s.1' % self.path))
+        self.assertTrue(os.path.getsize(self.path) <= 200)
+        wall_times = [r['wall_time'] for r in metrics.read(self.path)]
+        self.assertEqual(wall_times, sorted(wall_times))
+        self.assertEqual(4, wall_times[-1])
+
+    def test_prometheus(self):
+        records = [dict(metrics.Recorder('restore').record(0),
+                        wall_time=float(idx), patches_applied=2)
+                   for idx in range(1, 5)]
+        records.append(dict(metrics.Recorder('save').record(1)))
+
+        text = metrics.prometheus(records)
+        self.assertIn('# TYPE ply_command_duration_seconds summary', text)
+        self.assertIn('ply_command_duration_seconds{command="restore",'
+                      'quantile="0.50"} 2.0', text)
+        self.assertIn('ply_command_duration_seconds_count{command="restore"}'
+                      ' 4', text)
+        self.assertIn('ply_patches_applied{command="restore"} 8', text)
+        self.assertIn('ply_command_failures{command="save"} 1', text)
+        self.assertTrue(text.endswith('\n'))
+
+        metrics.write_prometheus(self.path, records)
+        with open(self.path) as f:
+            self.assertEqual(text, f.read())